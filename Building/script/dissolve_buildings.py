@@ -1,26 +1,26 @@
 import os
-import geopandas as gpd
+import sys
+
+sys.path.append(r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git")
+from osm_pipeline.dissolve import dissolve_files
 
 input_directory = 'C:/Users/Asus/OneDrive/Pulpit/Rozne/QGIS/Git/Building/SHP/fixed'
 output_directory = 'C:/Users/Asus/OneDrive/Pulpit/Rozne/QGIS/Git/Building/SHP/dissolved'
 
+# Read each tile straight from disk instead of loading whole files (for agglomerations)
+STREAMING = False
+
 # Create the output directory if it does not exist
 if not os.path.exists(output_directory):
     os.makedirs(output_directory)
 
-# Process each shapefile in the directory
-for filename in os.listdir(input_directory):
-    if filename.endswith('.shp'):
-        file_path = os.path.join(input_directory, filename)
-        output_file_path = os.path.join(output_directory, filename)
-
-        # Read the shapefile
-        gdf = gpd.read_file(file_path)
-
-        # Dissolve by 'building' column
-        dissolved_gdf = gdf.dissolve(by='building')
-
-        # Save the dissolved shapefile
-        dissolved_gdf.to_file(output_file_path)
+if __name__ == "__main__":
+    # Dissolve every shapefile by the 'building' column, all files and tiles share the cores
+    paths = [
+        (os.path.join(input_directory, filename), os.path.join(output_directory, filename))
+        for filename in os.listdir(input_directory)
+        if filename.endswith('.shp')
+    ]
+    dissolve_files(paths, by='building', streaming=STREAMING)
 
-print("Dissolving complete.")
\ No newline at end of file
+    print("Dissolving complete.")
@@ -1,10 +1,11 @@
 import geopandas as gpd
-import overpy
 import json
-import time
+import sys
+
+sys.path.append(r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git")
+from osm_pipeline.element_store import fetch_store
 
 def fetch_buildings(bbox, name_en):
-    api = overpy.Overpass()
     try:
         query = f'''
         [out:json][timeout:2000];
@@ -15,21 +16,32 @@ def fetch_buildings(bbox, name_en):
         (._;>;);
         out body;
         '''
-        result = api.query(query)
+        store = fetch_store(query, bbox=bbox)
+        xy, offsets = store.way_coords()
         geojson_features = []
 
-        for building in result.ways + result.relations:
-            if isinstance(building, overpy.Relation) and building.tags.get("type") == "multipolygon":
+        for i in range(store.count("way")):
+            coordinates = xy[offsets[i]:offsets[i + 1]].tolist()
+            geojson_features.append({
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [coordinates]
+                },
+                "properties": {"building": store.element_tags("way", i).get("building", None)}
+            })
+
+        for r in range(store.count("relation")):
+            tags = store.element_tags("relation", r)
+            if tags.get("type") == "multipolygon":
                 outer_coords = []
                 inner_coords = []
 
-                for member in building.members:
-                    if member.role == "outer" or member.role == "inner":
-                        member_coords = [[float(node.lon), float(node.lat)] for node in member.resolve().nodes]
-                        if member.role == "outer":
-                            outer_coords.append(member_coords)
-                        else:
-                            inner_coords.append(member_coords)
+                for role, member_coords, _ in store.relation_ways(r):
+                    if role == "outer":
+                        outer_coords.append(member_coords)
+                    elif role == "inner":
+                        inner_coords.append(member_coords)
 
                 if outer_coords:
                     coordinates = [outer_coords] if not inner_coords else [outer_coords, inner_coords]
@@ -39,18 +51,8 @@ def fetch_buildings(bbox, name_en):
                             "type": "MultiPolygon",
                             "coordinates": coordinates
                         },
-                        "properties": {"building": building.tags.get("building", None)}
+                        "properties": {"building": tags.get("building", None)}
                     })
-            elif isinstance(building, overpy.Way):
-                coordinates = [[float(node.lon), float(node.lat)] for node in building.nodes]
-                geojson_features.append({
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Polygon",
-                        "coordinates": [coordinates]
-                    },
-                    "properties": {"building": building.tags.get("building", None)}
-                })
 
         output_file = f"buildings_{name_en}.geojson"
         with open(output_file, 'w') as f:
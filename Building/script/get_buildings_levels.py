@@ -1,7 +1,14 @@
 import geopandas as gpd
-import overpy
 import json
-import time
+import pandas as pd
+import sys
+
+sys.path.append(r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git")
+from osm_pipeline.cache import get_default_cache
+from osm_pipeline.element_store import fetch_store
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.scheduler import run_concurrently
+from osm_pipeline.tags import parse_levels
 
 def transform_to_wgs84(gdf):
     """Transform GeoDataFrame to WGS 84 coordinate system."""
@@ -9,7 +16,6 @@ def transform_to_wgs84(gdf):
     return gdf
 
 def fetch_buildings(bbox, name_en):
-    api = overpy.Overpass()
     try:
         query = f'''
         [out:json][timeout:2000];
@@ -22,47 +28,50 @@ def fetch_buildings(bbox, name_en):
         (._;>;);
         out body;
         '''
-        result = api.query(query)
+        # fetch_store retries with backoff itself
+        store = fetch_store(query, bbox=bbox)
+        xy, offsets = store.way_coords()
 
         geojson_features = []
-        for building in result.ways + result.relations:
-            building_levels = building.tags.get("building:levels")
-            if building_levels:
-                levels = int(building_levels) if building_levels.isdigit() else 1
-                if isinstance(building, overpy.Relation) and building.tags.get("type") == "multipolygon":
-                    outer_coords = []
-                    inner_coords = []
-
-                    for member in building.members:
-                        if member.role == "outer" or member.role == "inner":
-                            member_coords = [[float(node.lon), float(node.lat)] for node in member.resolve().nodes]
-                            if member.role == "outer":
-                                outer_coords.append(member_coords)
-                            else:
-                                inner_coords.append(member_coords)
-
-                    if outer_coords:
-                        coordinates = [outer_coords] if not inner_coords else [outer_coords, inner_coords]
-                        geojson_features.append({
-                            "type": "Feature",
-                            "geometry": {
-                                "type": "MultiPolygon",
-                                "coordinates": coordinates
-                            },
-                            "properties": {"building": building.tags.get("building", None)}
-                        })
-                elif isinstance(building, overpy.Way):
-                    coordinates = [[float(node.lon), float(node.lat)] for node in building.nodes]
+        raw_levels = store.tag_values("way", "building:levels")
+        # Parse building:levels for every building at once, 1 when it is not a plain count
+        levels_list = parse_levels(pd.Series(raw_levels)).tolist()
+        for i, (raw, levels) in enumerate(zip(raw_levels, levels_list)):
+            if raw:
+                coordinates = xy[offsets[i]:offsets[i + 1]].tolist()
+                geojson_features.append({
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Polygon",
+                        "coordinates": [coordinates]
+                    },
+                    "properties": {
+                        "building": store.element_tags("way", i).get("building", None),
+                        "building:levels": levels
+                    }
+                })
+
+        for r in range(store.count("relation")):
+            tags = store.element_tags("relation", r)
+            if tags.get("building:levels") and tags.get("type") == "multipolygon":
+                outer_coords = []
+                inner_coords = []
+
+                for role, member_coords, _ in store.relation_ways(r):
+                    if role == "outer":
+                        outer_coords.append(member_coords)
+                    elif role == "inner":
+                        inner_coords.append(member_coords)
+
+                if outer_coords:
+                    coordinates = [outer_coords] if not inner_coords else [outer_coords, inner_coords]
                     geojson_features.append({
                         "type": "Feature",
                         "geometry": {
-                            "type": "Polygon",
-                            "coordinates": [coordinates]
+                            "type": "MultiPolygon",
+                            "coordinates": coordinates
                         },
-                        "properties": {
-                            "building": building.tags.get("building", None),
-                            "building:levels": levels
-                        }
+                        "properties": {"building": tags.get("building", None)}
                     })
 
         if len(geojson_features) == 0:
@@ -85,17 +94,20 @@ gdf = gpd.read_file(shapefile_path)
 # Transform the GeoDataFrame to WGS 84 coordinate system
 gdf = transform_to_wgs84(gdf)
 
-# Iterate over each feature
-for index, row in gdf.iterrows():
+def fetch_frame(index_row):
+    index, row = index_row
     bbox = row['geometry'].bounds  # (minx, miny, maxx, maxy)
-    name_en = row['Name_EN']
+    with get_default_recorder().span("frame", row['Name_EN'], bbox=bbox):
+        return fetch_buildings(bbox, row['Name_EN'])
 
-    output_file = fetch_buildings(bbox, name_en)
+# Fetch several frames at once, the shared rate limiter paces the requests
+for (index, row), output_file, error in run_concurrently(fetch_frame, gdf.iterrows(), max_workers=2):
+    name_en = row['Name_EN']
     if output_file:
         print(f"Saved buildings data to {output_file}")
     else:
         print(f"Failed to fetch buildings for {name_en}")
 
-    time.sleep(30)  # Delay between city requests
-
-print("Data fetching complete.")
\ No newline at end of file
+print(f"Overpass cache: {get_default_cache().stats()}")
+get_default_recorder().print_summary()
+print("Data fetching complete.")
@@ -0,0 +1,27 @@
+import geopandas as gpd
+import os
+import sys
+
+sys.path.append(r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git")
+from osm_pipeline.footgraph import DEFAULT_GRAPH_DIR, FootGraph, compute_isochrones, walking_bbox
+from osm_pipeline.isochrones import IsochroneJournal
+
+# Offline alternative to 03_fetch_isochrones_graphhopper_api.py: no API key, no rate limit
+file_path = r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git\Rail_transit_availability\SHP\Warszawa\stops_M3.shp"
+tram_stops = gpd.read_file(file_path)
+
+output_file_path = r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git\Rail_transit_availability\SHP\Warszawa\isochrones_M3_offline.shp"
+journal_path = os.path.splitext(output_file_path)[0] + "_journal.sqlite"
+
+# The foot network is fetched once per frame and kept as a CSR graph
+frame_name = os.path.splitext(os.path.basename(file_path))[0]
+graph_path = os.path.join(DEFAULT_GRAPH_DIR, f"foot_{frame_name}.npz")
+
+if __name__ == "__main__":
+    graph = FootGraph.load_or_fetch(graph_path, walking_bbox(tram_stops.total_bounds))
+    print(f"Foot graph: {len(graph)} nodes")
+
+    with IsochroneJournal(journal_path) as journal:
+        compute_isochrones(tram_stops, journal, graph)
+        count = journal.export(output_file_path)
+        print(f"Saved {count} isochrones to {output_file_path}")
@@ -1,110 +1,96 @@
 import geopandas as gpd
-import overpy
-import json
-import time
-from shapely.geometry import Polygon, MultiPolygon
-from shapely.ops import unary_union
+from functools import partial
+from shapely.geometry import Polygon
+import os
+import sys
+
+sys.path.append(r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git")
+from osm_pipeline.cache import get_default_cache
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.rings import assemble_multipolygon
+from osm_pipeline.scheduler import run_concurrently
+from osm_pipeline.streaming import stream_query
+from osm_pipeline.tiling import DEFAULT_PLAN_DIR, fetch_tiled
+from osm_pipeline.writers import frame_output_path, open_writer
+
+OUTPUT_FORMAT = "gpkg"  # or "geojson"
 
 def transform_to_wgs84(gdf):
     """Transform GeoDataFrame to WGS 84 coordinate system."""
     return gdf.to_crs(epsg=4326)
 
-def assemble_multipolygon(relation, result):
-    outer_polys = []
-    inner_polys = []
-
-    for member in relation.members:
-        if isinstance(member, overpy.RelationWay):
-            way = result.get_way(member.ref)  # Get the actual 'Way' object
-            coords = [(node.lon, node.lat) for node in way.nodes]
-            if member.role == 'outer':
-                outer_polys.append(Polygon(coords))
-            elif member.role == 'inner':
-                inner_polys.append(Polygon(coords))
-
-    # Attempt to create a unified outer boundary
-    unified_outer = unary_union(outer_polys)
-
-    # Create the final multipolygon, accounting for inner polygons
-    if isinstance(unified_outer, Polygon):
-        return MultiPolygon([unified_outer.difference(unary_union(inner_polys))])
-    elif isinstance(unified_outer, MultiPolygon):
-        return MultiPolygon([poly.difference(unary_union(inner_polys)) for poly in unified_outer])
-
+def water_geometry(element, geometry):
+    tags = element.get("tags", {})
+    if element["type"] == "relation" and tags.get("type") == "multipolygon":
+        multipolygon, broken = assemble_multipolygon(geometry)
+        if broken:
+            print(f"Relation {element['id']}: {len(broken)} broken ring(s)")
+        return multipolygon
+    elif element["type"] == "way" and tags.get("natural") == "water" and len(geometry) >= 4:
+        return Polygon(geometry)
     return None
 
-# In fetch_water_bodies function, pass 'result' to 'assemble_multipolygon':
-# ...
-
-# ...
-
-
-def fetch_water_bodies(bbox, max_retries=3):
-    api = overpy.Overpass()
-    geojson_features = []
-
-    south, west, north, east = bbox[1], bbox[0], bbox[3], bbox[2]
-
-    retries = 0
-    while retries < max_retries:
-        try:
-            query = f'''
-            [out:json][timeout:2000];
-            (
-                way["natural"="water"]({south},{west},{north},{east});
-                relation["natural"="water"]({south},{west},{north},{east});
-            );
-            (._;>;);
-            out body;
-            '''
-            result = api.query(query)
-
-            for water_body in result.ways + result.relations:
-                if isinstance(water_body, overpy.Relation) and water_body.tags.get("type") == "multipolygon":
-                    geometry = assemble_multipolygon(water_body, result)
-                elif isinstance(water_body, overpy.Way):
-                    coordinates = [(node.lon, node.lat) for node in water_body.nodes]
-                    geometry = Polygon(coordinates)
-
-                if geometry:
-                    geojson_features.append({
-                        "type": "Feature",
-                        "geometry": geometry.__geo_interface__,
-                        "properties": {"name": water_body.tags.get("name", "Unknown")}
-                    })
-
-            break  # Exit the retry loop on success
-        except Exception as e:
-            retries += 1
-            print(f"Retry {retries}/{max_retries}: {e}")
-            time.sleep(10)  # Wait before retrying
-
-    return geojson_features
-
-def save_to_file(features, filename):
-    """Save GeoJSON features to a file."""
-    with open(filename, 'w') as f:
-        json.dump({"type": "FeatureCollection", "features": features}, f)
+def fetch_water_tile(region, max_retries=3, **query_options):
+    south, west, north, east = region[1], region[0], region[3], region[2]
+
+    query = f'''
+    [out:json][timeout:2000];
+    (
+        way["natural"="water"]({south},{west},{north},{east});
+        relation["natural"="water"]({south},{west},{north},{east});
+    );
+    (._;>;);
+    out body;
+    '''
+    recorder = get_default_recorder()
+    for element, geometry in stream_query(query, max_retries=max_retries, **query_options):
+        with recorder.stage("assemble"):
+            water_geom = water_geometry(element, geometry)
+        if water_geom:
+            yield (element["type"], element["id"]), {
+                "type": "Feature",
+                "geometry": water_geom.__geo_interface__,
+                "properties": {"name": element.get("tags", {}).get("name", "Unknown")}
+            }
+
+def fetch_water_bodies(bbox, output_file, max_retries=3, max_workers=2, plan_dir=DEFAULT_PLAN_DIR, **query_options):
+    """
+    query_options (url, cache, limiter) go to stream_query for every tile.
+
+    A tile that fails, also half way through its response, raises
+    TileFetchError once the other tiles are written: the layer is incomplete.
+    """
+    name = os.path.splitext(os.path.basename(output_file))[0]
+    plan_path = os.path.join(plan_dir, f"water_bodies_{name}.json")
+    fetch_tile = partial(fetch_water_tile, max_retries=max_retries, **query_options)
+
+    # Features go to disk as they are parsed, the frame is never held in memory
+    with get_default_recorder().span("frame", os.path.basename(output_file), bbox=bbox) as span, \
+            open_writer(output_file, "water_bodies", {"name": "TEXT"}, "MULTIPOLYGON") as writer:
+        fetch_tiled(bbox, fetch_tile, plan_path, writer.write, max_workers=max_workers)
+        span.add("features", writer.count)
+
+    return writer.count
 
 def main():
     shapefile_path = r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git\_Ogolne\Arkusze_Aglomeracje.shp"
     gdf = gpd.read_file(shapefile_path)
     gdf_wgs84 = transform_to_wgs84(gdf)
 
-    for index, row in gdf_wgs84.iterrows():
-        bbox = row['geometry'].bounds
-        name_en = row['Name_EN']
+    def fetch_frame(index_row):
+        index, row = index_row
+        return fetch_water_bodies(row['geometry'].bounds, frame_output_path(row['Name_EN'], "water_bodies", OUTPUT_FORMAT))
 
-        water_bodies = fetch_water_bodies(bbox)
-        if water_bodies:
-            output_file = f"water_bodies_{name_en}.geojson"
-            save_to_file(water_bodies, output_file)
-            print(f"Saved water bodies data to {output_file}")
+    # Fetch several frames at once, the shared rate limiter paces the requests
+    for (index, row), count, error in run_concurrently(fetch_frame, gdf_wgs84.iterrows(), max_workers=2):
+        name_en = row['Name_EN']
+        if count:
+            print(f"Saved water bodies data to {frame_output_path(name_en, 'water_bodies', OUTPUT_FORMAT)}")
         else:
-            print(f"Failed to fetch water bodies for {name_en}")
-
-        time.sleep(15)  # Delay between city requests
+            print(f"Failed to fetch water bodies for {name_en}: {error}")
 
+    print(f"Overpass cache: {get_default_cache().stats()}")
+    get_default_recorder().print_summary()
     print("Data fetching complete.")
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+"""
+Compare per-feature polygon handling with the vectorized PolygonBatch.
+
+Per feature: Polygon(), is_valid/buffer(0), __geo_interface__ and GeoPackage
+write through the GeoJSON encoder. Batch: PolygonBatch.encode() straight to WKB.
+
+    python benchmarks/bench_polygons.py [count]
+"""
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+from shapely import Polygon
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from osm_pipeline.geometry_batch import PolygonBatch
+from osm_pipeline.writers import GeoPackage
+
+
+def synthetic_buildings(count, seed=0):
+    """Small closed rings around Warsaw, every 50th one self-intersecting (a bow tie)."""
+    rng = random.Random(seed)
+    for i in range(count):
+        x, y = 20.9 + rng.random() * 0.3, 52.1 + rng.random() * 0.2
+        size = 0.0001 + rng.random() * 0.0003
+        if i % 50 == 0:
+            ring = [(x, y), (x + size, y + size), (x + size, y), (x, y + size), (x, y)]
+        else:
+            sides = rng.randint(4, 12)
+            ring = [
+                (x + size * math.cos(2 * math.pi * k / sides), y + size * math.sin(2 * math.pi * k / sides))
+                for k in range(sides)
+            ]
+            ring.append(ring[0])
+        yield ("way", i), ring, {"building": "yes", "levels": "2", "height": "unknown"}
+
+
+def per_feature(buildings, layer):
+    for key, ring, properties in buildings:
+        polygon = Polygon(ring)
+        if not polygon.is_valid:
+            polygon = polygon.buffer(0)
+        if polygon.is_valid and not polygon.is_empty:
+            layer.write({"type": "Feature", "geometry": polygon.__geo_interface__, "properties": properties})
+
+
+def batched(buildings, layer, batch_size=20000):
+    batch = PolygonBatch()
+    for key, ring, properties in buildings:
+        batch.add(key, ring, properties)
+        if len(batch) >= batch_size:
+            for _, feature in batch.encode():
+                layer.write(feature)
+            batch = PolygonBatch()
+    for _, feature in batch.encode():
+        layer.write(feature)
+
+
+def run(name, fn, buildings, directory):
+    gpkg = GeoPackage(os.path.join(directory, f"{name}.gpkg"))
+    layer = gpkg.layer("buildings", geometry_type="MULTIPOLYGON")
+    start = time.perf_counter()
+    fn(buildings, layer)
+    layer.close()
+    elapsed = time.perf_counter() - start
+    gpkg.close()
+    print(f"{name:12} {layer.count:8d} features  {elapsed:7.2f}s  {layer.count / elapsed:10.0f} features/s")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    buildings = list(synthetic_buildings(count))
+    with tempfile.TemporaryDirectory() as directory:
+        slow = run("per-feature", per_feature, buildings, directory)
+        fast = run("batch", batched, buildings, directory)
+    print(f"speedup      {slow / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Stage by stage timings and memory peaks of the fetchers.
+
+Every pipeline runs the fetch function of one fetcher script against the
+fixtures (see fixtures.py) served by a local stand-in server (see
+server.py), so the benchmarks time the code the scripts run:
+
+    buildings       Building/script/get_buidlings_overpass.py fetch_buildings, then dissolve_files
+    water_bodies    Water/get_water.py fetch_water_bodies
+    structures      Tunnels/_query_inside_frames_combined.txt fetch_osm_data
+    roads           Roads/_query_inside_frames_roads_lanes.txt fetch_osm_data
+    transit         Rail_transit_availability/script/01_query_inside_frames_subway.txt fetch_osm_data
+    transit_routes  Public_transit_map/_query_inside_frames_transit_lines.txt fetch_osm_data
+    isochrones      osm_pipeline.isochrones fetch_isochrones, as 03_fetch_isochrones_graphhopper_api.py runs it
+
+A fetch function runs as the "fetch" stage, always on an empty cache,
+under a recorder of its own (see osm_pipeline.instrumentation). The stages
+it records become stages of the results next to it: first_byte (until the
+response starts, retries included) and transfer of the download, then
+parse, assemble, validate, filter and serialize, as far as the fetcher has
+them. The scripts stream, so these interleave; each is the time summed
+over the tiles, which may run in parallel. The QGIS console scripts (.txt)
+are imported as modules, their frame loop only runs from the console.
+Timings are the best of --repeat runs without tracing, the memory peaks
+(tracemalloc, Python allocations of this process only) come from one more
+traced run. Results are written as JSON, compare two of them to spot the
+stage that regressed between commits:
+
+    python benchmarks/bench_suite.py run [--scales small city] [--pipelines buildings roads] [--repeat 3]
+    python benchmarks/bench_suite.py compare old.json new.json [--threshold 0.1]
+"""
+import argparse
+import contextlib
+import functools
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from importlib.machinery import SourceFileLoader
+
+import pandas as pd
+import pyogrio
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_DIR)
+from osm_pipeline.cache import OverpassCache
+from osm_pipeline.dissolve import dissolve_files
+from osm_pipeline.instrumentation import Recorder, set_default_recorder
+from osm_pipeline.isochrones import IsochroneCache, IsochroneJournal, RateLimitPacer, fetch_isochrones
+from osm_pipeline.scheduler import EndpointLimiter
+
+from fixtures import ROOT_DIR, SCALES, fixture_path, load_isochrones
+from server import StandInServer
+
+RESULTS_DIR = os.path.join(ROOT_DIR, "results")
+FRAME_NAME = "benchmark"
+# Counters of the recorded query spans reported as stages, the *_seconds ones are stages by name
+COUNTER_STAGES = {"latency": "first_byte", "transfer_seconds": "transfer"}
+
+
+class Run:
+    """One run of a pipeline: a scratch directory, an empty cache and the stage measurements."""
+
+    def __init__(self, directory, memory=False):
+        self.directory = directory
+        self.memory = memory
+        self.cache = OverpassCache(os.path.join(directory, "overpass"))
+        # The stand-in is local, no pacing
+        self.limiter = EndpointLimiter(rate=1e6, capacity=1e6)
+        self.stages = {}
+        self.counts = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def query_options(self, url):
+        """The url, cache and limiter every fetch function passes on to its Overpass query."""
+        return {"url": url, "cache": self.cache, "limiter": self.limiter}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.memory:
+            tracemalloc.start()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            measurement = {"seconds": time.perf_counter() - start, "cpu_seconds": time.process_time() - cpu_start}
+            if self.memory:
+                measurement["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.stages[name] = measurement
+
+
+@functools.lru_cache(maxsize=None)
+def load_script(relative_path):
+    """Import a fetcher script of the repository, a QGIS console .txt script included, as a module."""
+    name = os.path.splitext(os.path.basename(relative_path))[0].lstrip("_")
+    loader = SourceFileLoader(f"fetcher_{name}", os.path.join(REPO_DIR, relative_path))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+def _fetch(run, fetch, *args, **kwargs):
+    """
+    Run a fetch function as the "fetch" stage, the stages it records as stages of their own.
+
+    The scripts report failures by returning None.
+    """
+    recorder = Recorder(trace_memory=run.memory)
+    previous = set_default_recorder(recorder)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        with recorder.span("fetch") as span:
+            output = fetch(*args, **kwargs)
+    finally:
+        set_default_recorder(previous)
+        if run.memory:
+            tracemalloc.stop()
+    run.stages["fetch"] = {"seconds": time.perf_counter() - start, "cpu_seconds": time.process_time() - cpu_start}
+    counters = span.counters
+    if run.memory:
+        run.stages["fetch"]["peak_bytes"] = counters.get("peak_bytes", 0)
+    for counter, value in counters.items():
+        name = COUNTER_STAGES.get(counter)
+        if name is None and counter.endswith("_seconds"):
+            name = counter[:-len("_seconds")]
+        if name is None:
+            continue
+        run.stages[name] = {"seconds": value}
+        if f"{name}_peak_bytes" in counters:
+            run.stages[name]["peak_bytes"] = counters[f"{name}_peak_bytes"]
+    if not output:
+        raise RuntimeError(f"{fetch.__module__}.{fetch.__name__} wrote nothing")
+    return output
+
+
+def _count_geojson(run, path):
+    with open(path) as f:
+        run.counts["features"] = len(json.load(f)["features"])
+
+
+def buildings(run, server, scale):
+    script = load_script("Building/script/get_buidlings_overpass.py")
+    output = _fetch(run, script.fetch_buildings, SCALES[scale]["bbox"], FRAME_NAME, plan_dir=run.directory,
+                    output_dir=run.directory, **run.query_options(server.overpass_url(scale, "buildings")))
+    run.counts["features"] = pyogrio.read_info(output, layer="buildings")["features"]
+    with run.stage("dissolve"):
+        dissolve_files([(output, run.path("dissolved.gpkg"))], by="building")
+
+
+def water_bodies(run, server, scale):
+    script = load_script("Water/get_water.py")
+    run.counts["features"] = _fetch(run, script.fetch_water_bodies, SCALES[scale]["bbox"], run.path("water_bodies.gpkg"),
+                                    plan_dir=run.directory,
+                                    **run.query_options(server.overpass_url(scale, "water_bodies")))
+
+
+def _qgis_script(relative_path, theme):
+    """A pipeline running the fetch_osm_data of a QGIS console script for theme."""
+    def pipeline(run, server, scale):
+        script = load_script(relative_path)
+        output = _fetch(run, script.fetch_osm_data, SCALES[scale]["bbox"], FRAME_NAME, output_dir=run.directory,
+                        **run.query_options(server.overpass_url(scale, theme)))
+        _count_geojson(run, output)
+    pipeline.__name__ = theme
+    return pipeline
+
+
+structures = _qgis_script("Tunnels/_query_inside_frames_combined.txt", "structures")
+roads = _qgis_script("Roads/_query_inside_frames_roads_lanes.txt", "roads")
+transit = _qgis_script("Rail_transit_availability/script/01_query_inside_frames_subway.txt", "transit")
+transit_routes = _qgis_script("Public_transit_map/_query_inside_frames_transit_lines.txt", "transit_routes")
+
+
+def isochrones(run, server, scale):
+    stops = pd.DataFrame(load_isochrones(scale)[0])
+    with run.stage("download"), IsochroneJournal(run.path("journal.sqlite")) as journal:
+        cache = IsochroneCache(run.path("isochrones.sqlite"))
+        run.counts["stops"] = fetch_isochrones(stops, journal, "benchmark", server.graphhopper_url(scale),
+                                               pacer=RateLimitPacer(min_interval=0), cache=cache)
+        cache.close()
+    with run.stage("serialize"), IsochroneJournal(run.path("journal.sqlite")) as journal:
+        run.counts["features"] = journal.export(run.path("isochrones.gpkg"))
+
+
+PIPELINES = {
+    "buildings": buildings,
+    "water_bodies": water_bodies,
+    "structures": structures,
+    "roads": roads,
+    "transit": transit,
+    "transit_routes": transit_routes,
+    "isochrones": isochrones,
+}
+
+
+def run_pipeline(pipeline, server, scale, memory=False, quiet=True):
+    with tempfile.TemporaryDirectory() as directory:
+        run = Run(directory, memory)
+        output = io.StringIO() if quiet else sys.stdout
+        with contextlib.redirect_stdout(output):
+            PIPELINES[pipeline](run, server, scale)
+        return run
+
+
+def benchmark(pipeline, server, scale, repeat=1, memory=True):
+    """Best-of-repeat stage timings, plus the memory peaks of one traced run."""
+    runs = [run_pipeline(pipeline, server, scale) for _ in range(repeat)]
+    stages = {}
+    for name in runs[0].stages:
+        measurements = [run.stages[name] for run in runs if name in run.stages]
+        seconds = [measurement["seconds"] for measurement in measurements]
+        stages[name] = {"seconds": min(seconds), "runs": seconds}
+        # Only the stages timed by the suite itself have a CPU time, not those the recorder reports
+        if all("cpu_seconds" in measurement for measurement in measurements):
+            stages[name]["cpu_seconds"] = min(measurement["cpu_seconds"] for measurement in measurements)
+    if memory:
+        traced = run_pipeline(pipeline, server, scale, memory=True)
+        for name, measurement in traced.stages.items():
+            if name in stages and "peak_bytes" in measurement:
+                stages[name]["peak_bytes"] = measurement["peak_bytes"]
+    return {"pipeline": pipeline, "scale": scale, "stages": stages, "counts": runs[0].counts}
+
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("-dirty" if dirty else "")
+
+
+def _format_bytes(value):
+    return "" if value is None else f"{value / 2 ** 20:.1f} MiB"
+
+
+def print_table(results):
+    print(f"{'pipeline':15} {'scale':13} {'stage':10} {'seconds':>9} {'peak':>12}")
+    for result in results:
+        for name, measurement in result["stages"].items():
+            print(f"{result['pipeline']:15} {result['scale']:13} {name:10} {measurement['seconds']:9.3f} "
+                  f"{_format_bytes(measurement.get('peak_bytes')):>12}")
+
+
+def run(scales, pipelines, repeat=1, memory=True, output=None):
+    revision = git_revision()
+    output = output or os.path.join(RESULTS_DIR, f"{revision}.json")
+    # Generate missing synthetic fixtures up front, not inside the first download
+    for scale in scales:
+        for pipeline in pipelines:
+            fixture_path(scale, pipeline)
+    results = []
+    with StandInServer() as server:
+        for scale in scales:
+            for pipeline in pipelines:
+                start = time.perf_counter()
+                results.append(benchmark(pipeline, server, scale, repeat, memory))
+                print(f"{pipeline} at {scale} scale: {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    document = {
+        "revision": revision,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": repeat,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(document, f, indent=1)
+    print_table(results)
+    print(f"Results saved to {output}")
+    return document
+
+
+def compare(old_path, new_path, threshold=0.1):
+    """Print the change of every stage present in both files; returns the regressions beyond threshold."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    before = {(r["pipeline"], r["scale"], stage): m for r in old["results"] for stage, m in r["stages"].items()}
+    regressions = []
+    print(f"{old['revision']} -> {new['revision']}")
+    print(f"{'pipeline':15} {'scale':13} {'stage':10} {'old s':>9} {'new s':>9} {'change':>8} {'old peak':>12} {'new peak':>12}")
+    for result in new["results"]:
+        for stage, measurement in result["stages"].items():
+            key = (result["pipeline"], result["scale"], stage)
+            if key not in before:
+                continue
+            previous = before[key]
+            change = measurement["seconds"] / previous["seconds"] - 1 if previous["seconds"] else 0.0
+            flag = ""
+            if change > threshold:
+                flag = " slower"
+                regressions.append((key, change))
+            print(f"{key[0]:15} {key[1]:13} {stage:10} {previous['seconds']:9.3f} {measurement['seconds']:9.3f} "
+                  f"{change:+8.0%} {_format_bytes(previous.get('peak_bytes')):>12} "
+                  f"{_format_bytes(measurement.get('peak_bytes')):>12}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=list(SCALES))
+    run_parser.add_argument("--pipelines", nargs="+", choices=list(PIPELINES), default=list(PIPELINES))
+    run_parser.add_argument("--repeat", type=int, default=1)
+    run_parser.add_argument("--no-memory", action="store_true", help="skip the traced run")
+    run_parser.add_argument("--output", help=f"results file, {RESULTS_DIR}/<revision>.json by default")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="slowdown flagged as a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        run(args.scales, args.pipelines, args.repeat, not args.no_memory, args.output)
+    elif compare(args.old, args.new, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""
+Replayable Overpass and GraphHopper responses at three scales.
+
+Every (scale, theme) fixture is a gzipped Overpass JSON response, printed
+the way the fetcher's own query prints it (nodes, then ways, then relations
+for the recursed "out body" themes). A fixture recorded from the live API
+(record_overpass) takes precedence; without one a deterministic synthetic
+response of the same shape is generated once and reused.
+
+The isochrone fixture is a list of stops and, once recorded, the GraphHopper
+answers keyed by the requests fetch_isochrones sends; the stand-in server
+synthesizes the answers that were not recorded.
+
+    python benchmarks/fixtures.py build [scale ...]
+    python benchmarks/fixtures.py record scale [theme ...]
+    python benchmarks/fixtures.py record-isochrones scale API_KEY
+"""
+import gzip
+import json
+import math
+import os
+import random
+import sys
+from urllib.request import urlopen
+
+import overpy
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from osm_pipeline.compiler import compile_themes
+from osm_pipeline.isochrones import GRAPHHOPPER_URL, coalesce_stops, get_isochrone_data, get_time_limit
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_cache", "benchmarks")
+RECORDED_DIR = os.path.join(ROOT_DIR, "recorded")
+SYNTHETIC_DIR = os.path.join(ROOT_DIR, "synthetic")
+
+# Central Warsaw, Warsaw and its agglomeration; factor scales the synthetic feature counts
+SCALES = {
+    "small": {"bbox": (21.00, 52.225, 21.03, 52.24), "factor": 1},
+    "city": {"bbox": (20.85, 52.10, 21.27, 52.37), "factor": 20},
+    "agglomeration": {"bbox": (20.60, 51.95, 21.50, 52.50), "factor": 60},
+}
+
+# Synthetic features per theme at factor 1
+BASE_COUNTS = {
+    "buildings": 2000,
+    "water_bodies": 40,
+    "structures": 300,
+    "roads": 600,
+    "transit": 60,
+    "transit_routes": 8,
+    "isochrones": 15,
+}
+
+THEMES = ("buildings", "water_bodies", "structures", "roads", "transit", "transit_routes")
+
+
+def _bbox_ql(bbox):
+    return f"{bbox[1]},{bbox[0]},{bbox[3]},{bbox[2]}"
+
+
+def theme_query(theme, bbox):
+    """The query each fetcher sends for a frame, see the scripts named in the comments."""
+    area = _bbox_ql(bbox)
+    if theme == "buildings":  # Building/script/get_buidlings_overpass.py
+        statements = [f'way["building"]({area});', f'relation["building"]({area});']
+    elif theme == "water_bodies":  # Water/get_water.py
+        statements = [f'way["natural"="water"]({area});', f'relation["natural"="water"]({area});']
+    elif theme == "structures":  # Tunnels/_query_inside_frames_combined.txt
+        statements = []
+        for key, values in (("highway", "primary|secondary|tertiary|motorway|trunk"),
+                            ("construction", "primary|secondary|tertiary|motorway|trunk"),
+                            ("railway", "rail|subway|tram|light_rail|construction"),
+                            ("construction", "rail|subway|tram|light_rail")):
+            statements.append(f'way["{key}"~"{values}"]["tunnel"="yes"]({area});')
+            statements.append(f'way["{key}"~"{values}"]["bridge"]["bridge"!="no"]({area});')
+    elif theme == "roads":  # Roads/_query_inside_frames_roads_lanes.txt
+        statements = [f'way["highway"~"primary|secondary|tertiary|motorway|motorway_link|trunk"]({area});']
+    elif theme == "transit_routes":  # Public_transit_map/_query_inside_frames_transit_lines.txt
+        statements = [f'relation["type"="route"]["route"~"bus|tram|train|subway|railway|ferry"]({area});']
+    elif theme == "transit":  # Rail_transit_availability/script/01_query_inside_frames_subway.txt
+        return compile_themes(["transit"], bbox, timeout=50, mode="center")
+    else:
+        raise ValueError(f"Unknown fixture theme {theme!r}")
+    body = "\n".join("        " + statement for statement in statements)
+    return f"""
+    [out:json][timeout:2000];
+    (
+{body}
+    );
+    (._;>;);
+    out body;
+    """
+
+
+class _Response:
+    """Collects the elements of a synthetic response in the order Overpass prints them."""
+
+    def __init__(self):
+        self.nodes = []
+        self.ways = []
+        self.relations = []
+        self.next_id = 1
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def node(self, lon, lat, tags=None):
+        element = {"type": "node", "id": self.new_id(), "lat": round(lat, 7), "lon": round(lon, 7)}
+        if tags:
+            element["tags"] = tags
+        self.nodes.append(element)
+        return element["id"]
+
+    def way(self, coords, tags=None, closed=False):
+        refs = [self.node(lon, lat) for lon, lat in coords]
+        if closed:
+            refs.append(refs[0])
+        return self.way_refs(refs, tags)
+
+    def way_refs(self, refs, tags=None):
+        element = {"type": "way", "id": self.new_id(), "nodes": refs}
+        if tags:
+            element["tags"] = tags
+        self.ways.append(element)
+        return element["id"]
+
+    def relation(self, members, tags):
+        self.relations.append({
+            "type": "relation",
+            "id": self.new_id(),
+            "members": [{"type": "way", "ref": ref, "role": role} for role, ref in members],
+            "tags": tags,
+        })
+
+    def dump(self, path):
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump({"version": 0.6, "generator": "benchmarks/fixtures.py",
+                       "elements": self.nodes + self.ways + self.relations}, f)
+
+
+def _ring(x, y, size, sides, rng):
+    return [
+        (x + size * (0.8 + 0.4 * rng.random()) * math.cos(2 * math.pi * k / sides),
+         y + size * (0.8 + 0.4 * rng.random()) * math.sin(2 * math.pi * k / sides))
+        for k in range(sides)
+    ]
+
+
+def _line(x, y, length, points, rng):
+    heading = rng.random() * 2 * math.pi
+    coords = [(x, y)]
+    for _ in range(points - 1):
+        heading += rng.uniform(-0.3, 0.3)
+        x, y = x + length / points * math.cos(heading), y + length / points * math.sin(heading)
+        coords.append((x, y))
+    return coords
+
+
+def _point(bbox, rng):
+    return bbox[0] + rng.random() * (bbox[2] - bbox[0]), bbox[1] + rng.random() * (bbox[3] - bbox[1])
+
+
+def _split_ring(response, ring, parts):
+    """Ids of open ways sharing their end nodes that join into the closed ring, like multipolygon members."""
+    refs = [response.node(lon, lat) for lon, lat in ring]
+    refs.append(refs[0])
+    step = max(1, len(ring) // parts)
+    cuts = list(range(0, len(ring), step))[:parts] + [len(ring)]
+    return [response.way_refs(refs[start:end + 1]) for start, end in zip(cuts, cuts[1:])]
+
+
+def _buildings(response, bbox, count, rng):
+    for i in range(count):
+        x, y = _point(bbox, rng)
+        size = 0.00008 + rng.random() * 0.0003
+        tags = {"building": rng.choice(("yes", "house", "apartments", "residential", "commercial"))}
+        if rng.random() < 0.5:
+            tags["building:levels"] = str(rng.randint(1, 12))
+        if i % 100 == 0:
+            # A multipolygon with a courtyard, its outer ring split into two ways
+            outer = _ring(x, y, size * 3, 12, rng)
+            members = [("outer", ref) for ref in _split_ring(response, outer, 2)]
+            members.append(("inner", response.way(_ring(x, y, size, 6, rng), closed=True)))
+            response.relation(members, {"type": "multipolygon", **tags})
+        elif i % 50 == 0:
+            # A bow tie, repaired by the validation stage
+            response.way([(x, y), (x + size, y + size), (x + size, y), (x, y + size)], tags, closed=True)
+        else:
+            response.way(_ring(x, y, size, rng.randint(4, 12), rng), tags, closed=True)
+
+
+def _water_bodies(response, bbox, count, rng):
+    for i in range(count):
+        x, y = _point(bbox, rng)
+        size = 0.001 + rng.random() * 0.01
+        tags = {"natural": "water", "name": f"Water {i}"}
+        ring = _ring(x, y, size, rng.randint(40, 400), rng)
+        if i % 4 == 0:
+            members = [("outer", ref) for ref in _split_ring(response, ring, 3)]
+            members.append(("inner", response.way(_ring(x, y, size / 4, 30, rng), closed=True)))
+            response.relation(members, {"type": "multipolygon", **tags})
+        else:
+            response.way(ring, tags, closed=True)
+
+
+def _structures(response, bbox, count, rng):
+    for _ in range(count):
+        x, y = _point(bbox, rng)
+        if rng.random() < 0.6:
+            tags = {"highway": rng.choice(("primary", "secondary", "tertiary", "motorway", "trunk"))}
+        else:
+            tags = {"railway": rng.choice(("rail", "subway", "tram", "light_rail", "construction"))}
+        if rng.random() < 0.5:
+            tags["tunnel"] = "yes"
+        else:
+            tags["bridge"] = rng.choice(("yes", "viaduct"))
+        # A third are shorter than the 50 m the length filter keeps
+        length = rng.choice((0.0002, 0.002, 0.01))
+        response.way(_line(x, y, length, rng.randint(2, 20), rng), tags)
+
+
+def _roads(response, bbox, count, rng):
+    for _ in range(count):
+        x, y = _point(bbox, rng)
+        tags = {"highway": rng.choice(("primary", "secondary", "tertiary", "motorway", "motorway_link", "trunk"))}
+        tags["lanes"] = rng.choice(("1", "2", "3", "4", "2;3", "6", "unknown"))
+        tags["oneway"] = rng.choice(("yes", "no"))
+        response.way(_line(x, y, 0.005, rng.randint(2, 40), rng), tags)
+
+
+def _transit_routes(response, bbox, count, rng):
+    # Routes share their ways, as bus lines do on main streets
+    ways = [response.way(_line(*_point(bbox, rng), 0.004, rng.randint(5, 30), rng)) for _ in range(count * 20)]
+    for i in range(count):
+        members = [("", ref) for ref in rng.sample(ways, 40)]
+        response.relation(members, {"type": "route", "route": rng.choice(("bus", "tram", "train", "subway")), "ref": str(i)})
+
+
+def _transit(bbox, count, rng):
+    """Stops as printed by "out center": nodes, and ways that carry only their center."""
+    elements = []
+    for i in range(count):
+        lon, lat = _point(bbox, rng)
+        if i % 5 == 0:
+            tags = {"railway": "station", rng.choice(("subway", "tram", "light_rail")): "yes", "name": f"Station {i}"}
+            elements.append({"type": "way", "id": 10 ** 9 + i, "center": {"lat": lat, "lon": lon}, "tags": tags})
+        else:
+            tags = {"railway": rng.choice(("tram_stop", "station", "halt")), "name": f"Stop {i}"}
+            if tags["railway"] != "tram_stop":
+                tags["train"] = "yes"
+            elements.append({"type": "node", "id": i + 1, "lat": lat, "lon": lon, "tags": tags})
+    return elements
+
+
+def _build_overpass(scale, theme, path):
+    spec = SCALES[scale]
+    rng = random.Random(f"{scale}/{theme}")
+    count = BASE_COUNTS[theme] * spec["factor"]
+    if theme == "transit":
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump({"version": 0.6, "generator": "benchmarks/fixtures.py", "elements": _transit(spec["bbox"], count, rng)}, f)
+        return
+    response = _Response()
+    builders = {
+        "buildings": _buildings,
+        "water_bodies": _water_bodies,
+        "structures": _structures,
+        "roads": _roads,
+        "transit_routes": _transit_routes,
+    }
+    builders[theme](response, spec["bbox"], count, rng)
+    response.dump(path)
+
+
+def isochrone_key(point, time_limit):
+    """Key of a GraphHopper answer, from the "point" and "time_limit" request parameters."""
+    return f"{point},{time_limit}"
+
+
+def synthetic_isochrone(point, time_limit):
+    """A wobbly circle of the distance walked at 5 km/h, the same for the same request."""
+    rng = random.Random(isochrone_key(point, time_limit))
+    latitude, longitude = (float(value) for value in point.split(","))
+    radius = float(time_limit) * 5 / 3.6 / 111320
+    coords = [
+        [longitude + radius * (0.7 + 0.3 * rng.random()) * math.cos(2 * math.pi * k / 60) / math.cos(math.radians(latitude)),
+         latitude + radius * (0.7 + 0.3 * rng.random()) * math.sin(2 * math.pi * k / 60)]
+        for k in range(60)
+    ]
+    coords.append(coords[0])
+    return {"polygons": [{"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [coords]},
+                          "properties": {"bucket": 0}}]}
+
+
+def _build_isochrones(scale, path):
+    spec = SCALES[scale]
+    rng = random.Random(f"{scale}/isochrones")
+    stops = []
+    for i in range(BASE_COUNTS["isochrones"] * spec["factor"]):
+        lon, lat = _point(spec["bbox"], rng)
+        railway = rng.choice(("tram", "subway", "train", "light_rail"))
+        stops.append({"id": i + 1, "latitude": lat, "longitude": lon, "railway": railway})
+        # A second platform a few metres away, coalesced into the same request
+        if i % 3 == 0:
+            stops.append({"id": 100000 + i, "latitude": lat + 0.00005, "longitude": lon, "railway": railway})
+    # No recorded answers, the stand-in server synthesizes them
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump({"stops": stops, "responses": {}}, f)
+
+
+def load_isochrones(scale):
+    """(stops, {request key: GraphHopper answer}) of a scale."""
+    with gzip.open(fixture_path(scale, "isochrones"), "rt", encoding="utf-8") as f:
+        fixture = json.load(f)
+    return fixture["stops"], fixture["responses"]
+
+
+def fixture_path(scale, theme):
+    """Path of the fixture for a scale and theme ("isochrones" included), recorded if available."""
+    recorded = os.path.join(RECORDED_DIR, scale, f"{theme}.json.gz")
+    if os.path.exists(recorded):
+        return recorded
+    path = os.path.join(SYNTHETIC_DIR, scale, f"{theme}.json.gz")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        if theme == "isochrones":
+            _build_isochrones(scale, tmp_path)
+        else:
+            _build_overpass(scale, theme, tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+
+def record_overpass(scale, theme, url=overpy.Overpass.default_url):
+    """Save the live response of a fetcher's query for a scale's bbox as its fixture."""
+    path = os.path.join(RECORDED_DIR, scale, f"{theme}.json.gz")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    query = theme_query(theme, SCALES[scale]["bbox"])
+    with urlopen(url, query.encode("utf-8")) as response, gzip.open(path + ".tmp", "wb") as f:
+        while True:
+            chunk = response.read(1 << 16)
+            if not chunk:
+                break
+            f.write(chunk)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def record_isochrones(scale, api_key, url=GRAPHHOPPER_URL):
+    """Record live GraphHopper answers for the requests fetch_isochrones sends for a scale's stops."""
+    stops, _ = load_isochrones(scale)
+    responses = {}
+    for cluster in coalesce_stops(pd.DataFrame(stops)):
+        # Rounded like IsochroneCache.point, so the keys match what fetch_isochrones asks for
+        latitude, longitude = round(float(cluster["latitude"]), 4), round(float(cluster["longitude"]), 4)
+        key = isochrone_key(f"{latitude},{longitude}", get_time_limit(cluster["railway"]))
+        if key not in responses:
+            response = get_isochrone_data(api_key, latitude, longitude, cluster["railway"], url)
+            response.raise_for_status()
+            responses[key] = response.json()
+    path = os.path.join(RECORDED_DIR, scale, "isochrones.json.gz")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump({"stops": stops, "responses": responses}, f)
+    return path
+
+
+def main(argv):
+    command = argv[0] if argv else "build"
+    if command == "build":
+        for scale in argv[1:] or SCALES:
+            for theme in THEMES + ("isochrones",):
+                print(f"{scale}/{theme}: {fixture_path(scale, theme)}")
+    elif command == "record":
+        for theme in argv[2:] or THEMES:
+            print(f"{argv[1]}/{theme}: {record_overpass(argv[1], theme)}")
+    elif command == "record-isochrones":
+        print(f"{argv[1]}/isochrones: {record_isochrones(argv[1], argv[2])}")
+    else:
+        raise SystemExit(__doc__)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
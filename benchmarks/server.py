@@ -0,0 +1,191 @@
+"""
+Local stand-in for the Overpass and GraphHopper APIs, serving the fixtures.
+
+    POST /overpass/<scale>/<theme>      the (scale, theme) Overpass fixture, whatever the query
+    GET  /overpass/status               status_text, as the /status of an Overpass instance
+    GET  /graphhopper/<scale>/isochrone the recorded answer for point/time_limit, else a synthetic one
+
+Responses are streamed in chunks; latency (seconds before the first byte)
+and bandwidth (bytes per second) emulate a remote server when set. Every
+GraphHopper answer spends one of credits (X-RateLimit-Remaining), fail()
+makes the next requests to an API answer with an error status instead,
+cut_off() ends the next Overpass responses half way and respond() answers
+the next Overpass requests with a given body instead of the fixture.
+"""
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from fixtures import fixture_path, isochrone_key, load_isochrones, synthetic_isochrone
+
+CHUNK_SIZE = 1 << 16
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, path=None, headers=None, limit=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        if path is not None:
+            # Length unknown until decompressed, close the connection to end the body
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if path is None:
+            self.wfile.write(body)
+            return
+        sent = 0
+        with gzip.open(path, "rb") as f:
+            while limit is None or sent < limit:
+                chunk = f.read(CHUNK_SIZE if limit is None else min(CHUNK_SIZE, limit - sent))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if server.bandwidth:
+                    time.sleep(len(chunk) / server.bandwidth)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "overpass":
+            self._send(404, b'{"remark": "unknown fixture"}')
+            return
+        status = self.server.count(parts[0])
+        if status is not None:
+            self._send(status, b'{"remark": "injected failure"}')
+            return
+        body = self.server.response(parts[0])
+        if body is not None:
+            self._send(200, body)
+            return
+        self._send(200, path=fixture_path(parts[1], parts[2]), limit=self.server.cut(parts[0]))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/overpass/status":
+            self._send(200, self.server.status_text.encode("utf-8"))
+            return
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "graphhopper" or parts[2] != "isochrone":
+            self._send(404, b'{"message": "unknown fixture"}')
+            return
+        status = self.server.count(parts[0])
+        headers = {"X-RateLimit-Remaining": self.server.spend(), "X-RateLimit-Reset": self.server.reset}
+        if status is not None:
+            self._send(status, b'{"message": "injected failure"}', headers=headers)
+            return
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        responses = self.server.isochrones(parts[1])
+        key = isochrone_key(params["point"], params["time_limit"])
+        answer = responses.get(key) or synthetic_isochrone(params["point"], params["time_limit"])
+        self._send(200, json.dumps(answer).encode("utf-8"), headers=headers)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Serves the fixtures on 127.0.0.1 in a background thread; use as a context manager."""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, bandwidth=None, port=0, credits=100000, reset=1):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # Plenty of credits by default, the pacer never waits on the stand-in
+        self.credits = credits
+        self.reset = reset
+        self.status_text = "Rate limit: 2\n2 slots available now.\n"
+        self.requests = {}
+        self._failures = {}
+        self._cut_offs = {}
+        self._responses = {}
+        self._isochrones = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def overpass_url(self, scale, theme):
+        return f"{self.url}/overpass/{scale}/{theme}"
+
+    def graphhopper_url(self, scale):
+        return f"{self.url}/graphhopper/{scale}/isochrone"
+
+    @property
+    def overpass_status_endpoint(self):
+        """An endpoint whose scheduler.status_url is the stand-in's /overpass/status."""
+        return f"{self.url}/overpass/interpreter"
+
+    def fail(self, api, status, times=1):
+        """Answer the next times requests to api ("overpass" or "graphhopper") with status."""
+        with self._lock:
+            self._failures.setdefault(api, []).extend([status] * times)
+
+    def cut_off(self, api, size, times=1):
+        """End the body of the next times successful answers of api after size bytes."""
+        with self._lock:
+            self._cut_offs.setdefault(api, []).extend([size] * times)
+
+    def respond(self, api, body, times=1):
+        """Answer the next times successful requests to api with body (bytes, or JSON to encode)."""
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        with self._lock:
+            self._responses.setdefault(api, []).extend([body] * times)
+
+    def response(self, api):
+        """Body to answer this request with, or None for the fixture."""
+        with self._lock:
+            responses = self._responses.get(api)
+            return responses.pop(0) if responses else None
+
+    def cut(self, api):
+        """Bytes after which to end this answer, or None for the whole of it."""
+        with self._lock:
+            cut_offs = self._cut_offs.get(api)
+            return cut_offs.pop(0) if cut_offs else None
+
+    def count(self, api):
+        """Count a request; returns the status to fail it with, or None."""
+        with self._lock:
+            self.requests[api] = self.requests.get(api, 0) + 1
+            failures = self._failures.get(api)
+            return failures.pop(0) if failures else None
+
+    def spend(self):
+        """Credits left after one more GraphHopper request."""
+        with self._lock:
+            self.credits = max(0, self.credits - 1)
+            return self.credits
+
+    def isochrones(self, scale):
+        with self._lock:
+            if scale not in self._isochrones:
+                self._isochrones[scale] = load_isochrones(scale)[1]
+            return self._isochrones[scale]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1 @@
+"""Shared helpers for the Overpass fetchers and PyQGIS frame scripts."""
@@ -0,0 +1,216 @@
+"""
+Headless export of one PNG per frame of a sheet layer from Mapa_OSM.qgz.
+
+Every worker process starts QGIS without a GUI, loads the project once and
+renders the frames it is handed with QgsMapRendererParallelJob (the layers
+of a frame are drawn in parallel threads). Frames are spread over a process
+pool, the threads split evenly between the workers. Each worker keeps one
+QgsMapRendererCache and renders all themes of a frame back to back, so a
+layer shared by several themes is drawn once per frame. The cache does not
+know about map theme styles: a layer whose style override changes from one
+theme to the next is dropped from it before it is drawn again. Nor does it
+carry over between frames: the next frame has another extent and is drawn
+from scratch.
+
+    python -m osm_pipeline.atlas Arkusze_Miasta Building/PNG
+    python -m osm_pipeline.atlas Arkusze_Miasta Public_transit_map/PNG --theme Cities_transit_schwarzplan_PL
+
+QGIS' Python must be importable (the OSGeo4W shell, or --qgis-prefix).
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import shapely
+
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.multitheme import GIT_DIR
+from osm_pipeline.sheets import read_sheet
+
+PROJECT_PATH = os.path.join(GIT_DIR, "Mapa_OSM.qgz")
+SHEET_DIR = os.path.join(GIT_DIR, "_Ogolne")
+NAME_FIELD = "City_Name"  # the PNGs in the repo are named after it
+
+_worker = None
+
+
+class AtlasRenderer:
+    """A headless QGIS with the project loaded, rendering frame extents to images."""
+
+    def __init__(self, project_path=PROJECT_PATH, prefix_path=None, threads=None):
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from qgis.core import QgsApplication, QgsMapRendererCache, QgsProject
+        from qgis.PyQt.QtCore import QThreadPool
+
+        if prefix_path:
+            QgsApplication.setPrefixPath(prefix_path, True)
+        self.app = QgsApplication([], False)
+        self.app.initQgis()
+        if threads:
+            QThreadPool.globalInstance().setMaxThreadCount(threads)
+        self.project = QgsProject.instance()
+        if not self.project.read(project_path):
+            raise RuntimeError(f"Could not read {project_path}: {self.project.error()}")
+        self.cache = QgsMapRendererCache()
+        self.style_overrides = {}  # {layer id: style} of the images in the cache
+
+    def map_settings(self, extent, width, dpi, theme=None):
+        """Map settings of the project for an extent in the project CRS, visible layers or a map theme."""
+        from qgis.core import QgsMapSettings
+        from qgis.PyQt.QtCore import QSize
+
+        project = self.project
+        settings = QgsMapSettings()
+        settings.setDestinationCrs(project.crs())
+        settings.setTransformContext(project.transformContext())
+        settings.setEllipsoid(project.ellipsoid())
+        settings.setPathResolver(project.pathResolver())
+        settings.setLabelingEngineSettings(project.labelingEngineSettings())
+        settings.setBackgroundColor(project.backgroundColor())
+        if theme is None:
+            root = project.layerTreeRoot()
+            settings.setLayers([layer for layer in root.layerOrder() if root.findLayer(layer.id()).isVisible()])
+        else:
+            themes = project.mapThemeCollection()
+            if not themes.hasMapTheme(theme):
+                raise ValueError(f"No map theme {theme!r} in the project")
+            settings.setLayers(themes.mapThemeVisibleLayers(theme))
+            settings.setLayerStyleOverrides(themes.mapThemeStyleOverrides(theme))
+        settings.setOutputDpi(dpi)
+        settings.setOutputSize(QSize(width, max(1, round(width * extent.height() / extent.width()))))
+        settings.setExtent(extent)
+        settings.setFlag(QgsMapSettings.Antialiasing, True)
+        settings.setFlag(QgsMapSettings.DrawLabeling, True)
+        return settings
+
+    def extent(self, wkb):
+        """Bounding box in the project CRS of a WGS 84 frame geometry."""
+        from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsGeometry
+
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        transform = QgsCoordinateTransform(QgsCoordinateReferenceSystem("EPSG:4326"), self.project.crs(), self.project)
+        geometry.transform(transform)
+        return geometry.boundingBox()
+
+    def render(self, extent, path, width, dpi, theme=None):
+        """Render one image to path; returns the renderer's error messages."""
+        from qgis.core import QgsMapRendererParallelJob
+
+        settings = self.map_settings(extent, width, dpi, theme)
+        self.invalidate_restyled(settings.layerStyleOverrides())
+        job = QgsMapRendererParallelJob(settings)
+        job.setCache(self.cache)
+        job.start()
+        job.waitForFinished()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if not job.renderedImage().save(path, "png"):
+            raise OSError(f"Could not write {path}")
+        return [f"{error.layerID}: {error.message}" for error in job.errors()]
+
+    def invalidate_restyled(self, style_overrides):
+        """Drop the cached images of the layers drawn with another style override than the one coming."""
+        for layer_id in self.style_overrides.keys() | style_overrides.keys():
+            if self.style_overrides.get(layer_id) != style_overrides.get(layer_id):
+                layer = self.project.mapLayer(layer_id)
+                if layer is not None:
+                    self.cache.invalidateCacheForLayer(layer)
+        self.style_overrides = dict(style_overrides)
+
+    def close(self):
+        self.app.exitQgis()
+
+
+def _init_worker(project_path, prefix_path, threads):
+    global _worker
+    _worker = AtlasRenderer(project_path, prefix_path, threads)
+
+
+def _render_frame(wkb, outputs, width, dpi):
+    """Every (theme, path) output of one frame in this worker, back to back so the cache is reused."""
+    extent = _worker.extent(wkb)
+    results = []
+    for theme, path in outputs:
+        start = time.perf_counter()
+        errors = _worker.render(extent, path, width, dpi, theme)
+        results.append((theme, path, time.perf_counter() - start, errors))
+    return results
+
+
+def sheet_frames(sheet, name_field=NAME_FIELD, sheet_dir=SHEET_DIR):
+    """(name, WGS 84 WKB) of every frame of a sheet layer in _Ogolne, named as in sheets.read_sheet."""
+    path = os.path.join(sheet_dir, f"{sheet}.shp")
+    return [(name, shapely.to_wkb(geometry)) for name, geometry in read_sheet(path, (name_field,))]
+
+
+def output_path(output_dir, name, theme=None, themes=1):
+    """<output_dir>/<name>.png, or <output_dir>/<theme>/<name>.png when several themes are rendered."""
+    if themes > 1:
+        return os.path.join(output_dir, theme or "visible", f"{name}.png")
+    return os.path.join(output_dir, f"{name}.png")
+
+
+def export_sheet(sheet, output_dir, themes=(None,), width=4000, dpi=300, project_path=PROJECT_PATH,
+                 name_field=NAME_FIELD, max_workers=None, prefix_path=None):
+    """
+    Render every frame of a sheet layer for every map theme (None: the visible layers).
+
+    Returns the number of images written.
+    """
+    frames = sheet_frames(sheet, name_field)
+    themes = list(themes)
+    cpu_count = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers or cpu_count, len(frames)))
+    threads = max(1, cpu_count // max_workers)
+    print(f"{len(frames)} frames x {len(themes)} theme(s) on {max_workers} worker(s) of {threads} thread(s)")
+
+    recorder = get_default_recorder()
+    written = 0
+    # QGIS does not survive a fork, every worker starts its own
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                             initargs=(project_path, prefix_path, threads)) as executor:
+        futures = {}
+        for name, wkb in frames:
+            outputs = [(theme, output_path(output_dir, name, theme, len(themes))) for theme in themes]
+            futures[executor.submit(_render_frame, wkb, outputs, width, dpi)] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"Failed to render {name}: {e}")
+                recorder.record("render", name=name, sheet=sheet, error=repr(e))
+                continue
+            for theme, path, seconds, errors in results:
+                written += 1
+                recorder.record("render", name=name, sheet=sheet, theme=theme, seconds=round(seconds, 4), path=path)
+                for error in errors:
+                    print(f"{name}: {error}")
+                print(f"{name}{f' ({theme})' if theme else ''}: {path} in {seconds:.1f} s")
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sheet", help="sheet layer in _Ogolne, e.g. Arkusze_Miasta")
+    parser.add_argument("output_dir")
+    parser.add_argument("--theme", action="append", dest="themes",
+                        help="map theme to render, repeat for several (default: the visible layers)")
+    parser.add_argument("--width", type=int, default=4000, help="image width in pixels")
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--name-field", default=NAME_FIELD)
+    parser.add_argument("--project", default=PROJECT_PATH)
+    parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--qgis-prefix", help="QGIS install prefix, if QGIS' Python is not set up already")
+    args = parser.parse_args(argv)
+
+    written = export_sheet(args.sheet, args.output_dir, args.themes or [None], args.width, args.dpi, args.project,
+                           args.name_field, args.workers, args.qgis_prefix)
+    print(f"{written} image(s) written")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""On-disk cache of raw Overpass responses shared by every fetcher."""
+import gzip
+import hashlib
+import os
+import re
+import threading
+import time
+
+import overpy
+
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.scheduler import get_default_limiter
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_cache", "overpass")
+
+
+def normalize_query(query):
+    """Collapse whitespace and drop settings that do not change the response."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8")
+    query = re.sub(r"\[(timeout|maxsize):\d+\]", "", query)
+    return " ".join(query.split())
+
+
+class OverpassCache:
+    """
+    Content-addressed store of gzip-compressed responses.
+
+    The file mtime records when a response was downloaded (used for max_age),
+    the atime records when it was last read (used for LRU eviction).
+
+    The directory is scanned on the first put and then only when the running
+    total of the sizes written passes max_bytes. The total only counts this
+    process' writes, each scan brings it back in line with the directory.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=5 * 1024 ** 3, max_age=30 * 24 * 3600, compresslevel=6):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compresslevel = compresslevel
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # bytes in the directory as of the last scan, plus the puts since
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, query, bbox=None):
+        text = normalize_query(query)
+        if bbox is not None:
+            text += "|" + ",".join(f"{coord:.7f}" for coord in bbox)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json.gz")
+
+    def get_path(self, key):
+        """Path of a fresh entry (counted as a hit) or None (counted as a miss)."""
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+
+        now = time.time()
+        if self.max_age is not None and now - stat.st_mtime > self.max_age:
+            self._remove(path)
+            self._count(hit=False)
+            return None
+
+        os.utime(path, (now, stat.st_mtime))
+        self._count(hit=True)
+        return path
+
+    def get(self, key):
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with gzip.open(path, "rb") as f:
+                return f.read()
+        except (OSError, EOFError):
+            # Truncated or corrupted entry, treat it as missing
+            self._remove(path)
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wb", compresslevel=self.compresslevel) as f:
+            f.write(data)
+        size = os.path.getsize(tmp_path)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += size - replaced
+            scan = self._size is None or self._size > self.max_bytes
+        if scan:
+            self.evict()
+
+    def evict(self):
+        """Remove expired entries, then least recently used ones until under max_bytes."""
+        now = time.time()
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json.gz"):
+                continue
+            stat = entry.stat()
+            if self.max_age is not None and now - stat.st_mtime > self.max_age:
+                self._remove(entry.path)
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+        with self._lock:
+            self._size = total
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """Return the process-wide cache used when a fetcher does not pass its own."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = OverpassCache()
+        return _default_cache
+
+
+class CachedOverpass(overpy.Overpass):
+    """Drop-in replacement for overpy.Overpass that serves repeated queries from disk."""
+
+    def __init__(self, cache=None, limiter=None, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache if cache is not None else get_default_cache()
+        self.limiter = limiter if limiter is not None else get_default_limiter()
+        self._pending = threading.local()
+
+    def query(self, query, bbox=None):
+        """Answer from the cache or the server, recorded as a "query" span (see instrumentation)."""
+        with get_default_recorder().span("query", bbox=bbox) as span:
+            start = time.perf_counter()
+            key = self.cache.key(query, bbox)
+            data = self.cache.get(key)
+            if data is not None:
+                span.add("cache_hits")
+                result = self.parse_json(data)
+            else:
+                span.add("cache_misses")
+                # Only real requests count against the endpoint's rate limit
+                self.limiter.acquire(self.url)
+                self._pending.key = key
+                try:
+                    result = super().query(query)
+                finally:
+                    self._pending.key = None
+            # Everything but parsing: rate limit waits, server time and transfer
+            span.add("latency", time.perf_counter() - start - span.counters.get("parse_seconds", 0.0))
+            span.add("elements", len(result.nodes) + len(result.ways) + len(result.relations))
+            return result
+
+    def parse_json(self, data, encoding="utf-8"):
+        start = time.perf_counter()
+        result = super().parse_json(data, encoding=encoding)
+        get_default_recorder().add("parse_seconds", time.perf_counter() - start)
+        get_default_recorder().add("bytes", len(data))
+        # Only responses without a runtime error/remark get this far
+        key = getattr(self._pending, "key", None)
+        if key is not None:
+            self.cache.put(key, data if isinstance(data, bytes) else data.encode(encoding))
+        return result
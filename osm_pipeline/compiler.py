@@ -0,0 +1,190 @@
+"""
+Compile theme specs (see themes.py) into one Overpass query per frame.
+
+Clauses that differ only in the value of one key are folded into a single
+regex union, clauses with the same conditions on several element types are
+merged into nw/wr/nwr statements, every theme is collected into a named set
+and the bbox is given once in the settings. The response holds every theme;
+multitheme.split_themes sorts it back into layers on the client.
+
+The output mode picks the cheapest form the themes can be built from:
+"center" (one coordinate per element) for point themes, "geom" (inline
+coordinates) for line themes, "tags" for attribute-only lookups and "body"
+with the recursed skeleton for polygons, whose rings are assembled by node id.
+
+For incremental refreshes (incremental.py) the same sets can be restricted
+to what changed since a timestamp, printed with versions and timestamps
+("meta"), and listed as bare ids to find what was deleted.
+"""
+from osm_pipeline.themes import OUTPUT_MODES, THEMES
+
+TYPE_CODES = {"node": "n", "way": "w", "relation": "r"}
+TYPE_ORDER = "nwr"
+# Out statement of each output mode, the inline modes are sorted by quadtile (cheaper on the server)
+OUT_STATEMENTS = {"body": "out body;", "center": "out center qt;", "geom": "out geom qt;", "tags": "out tags qt;"}
+# The same with element versions and timestamps
+META_STATEMENTS = {"body": "out meta;", "center": "out meta center qt;", "geom": "out meta geom qt;"}
+# A mode also serves the themes of every mode to its left
+MODE_ORDER = ("tags", "center", "geom", "body")
+REGEX_SPECIALS = set(".^$|()[]*+?{}\\")
+
+
+def _escape_regex(value):
+    return "".join("\\" + char if char in REGEX_SPECIALS else char for char in value)
+
+
+def _quote(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _pattern(condition):
+    """Regex fragment matching what an "=" or "~" condition matches."""
+    _, op, value = condition
+    return f"^{_escape_regex(value)}$" if op == "=" else value
+
+
+def _condition_key(condition):
+    return tuple("" if part is None else part for part in condition)
+
+
+def merge_values(clauses):
+    """
+    Fold clauses equal but for one "="/"~" condition on the same key into one "~" union.
+
+    [("way", [("amenity", "=", "bar")]), ("way", [("amenity", "=", "pub")])]
+    becomes [("way", [("amenity", "~", "^bar$|^pub$")])]. Matches the same
+    elements, just in fewer statements. Condition order is kept.
+    """
+    clauses = [(element_type, list(conditions)) for element_type, conditions in clauses]
+    while True:
+        groups = {}
+        for index, (element_type, conditions) in enumerate(clauses):
+            for position, condition in enumerate(conditions):
+                if condition[1] not in ("=", "~"):
+                    continue
+                rest = frozenset(_condition_key(c) for i, c in enumerate(conditions) if i != position)
+                if len(rest) != len(conditions) - 1:
+                    continue  # repeated conditions, leave the clause alone
+                groups.setdefault((element_type, condition[0], rest), []).append((index, position))
+        best = max(groups.values(), key=len, default=[])
+        if len(best) < 2 or len({index for index, _ in best}) < len(best):
+            return clauses
+        first_index, first_position = best[0]
+        element_type, conditions = clauses[first_index]
+        patterns = []
+        for index, position in best:
+            pattern = _pattern(clauses[index][1][position])
+            if pattern not in patterns:
+                patterns.append(pattern)
+        merged = list(conditions)
+        merged[first_position] = (conditions[first_position][0], "~", "|".join(patterns))
+        members = {index for index, _ in best}
+        clauses = [(element_type, merged) if index == first_index else clause
+                   for index, clause in enumerate(clauses) if index == first_index or index not in members]
+
+
+def merge_types(clauses):
+    """Merge clauses with identical conditions on several element types into "nw", "wr", "nwr"... statements."""
+    types = {}
+    for element_type, conditions in clauses:
+        key = frozenset(_condition_key(condition) for condition in conditions)
+        entry = types.setdefault(key, [set(), conditions])
+        entry[0].add(TYPE_CODES[element_type])
+    merged = []
+    for codes, conditions in types.values():
+        statement = "".join(code for code in TYPE_ORDER if code in codes)
+        merged.append(({"n": "node", "w": "way", "r": "relation"}.get(statement, statement), conditions))
+    return merged
+
+
+def condition_ql(condition):
+    key, op, value = condition
+    if op == "exists":
+        return f"[{_quote(key)}]"
+    if op in ("=", "!=", "~"):
+        return f"[{_quote(key)}{op}{_quote(value)}]"
+    raise ValueError(f"Unknown tag operator {op!r}")
+
+
+def clause_ql(statement, conditions):
+    return statement + "".join(condition_ql(condition) for condition in conditions) + ";"
+
+
+def optimize(clauses):
+    return merge_types(merge_values(clauses))
+
+
+def theme_set_name(name):
+    return "t_" + "".join(char if char.isalnum() else "_" for char in name)
+
+
+def output_mode(names, themes=THEMES):
+    """Cheapest output mode every named theme can be built from, see OUTPUT_MODES."""
+    modes = [OUTPUT_MODES[themes[name]["geometry"]] for name in names]
+    return max(modes, key=MODE_ORDER.index, default="body")
+
+
+def _theme_sets(names, themes, input_set=None):
+    """Lines collecting every named theme into its own set, from input_set instead of the whole bbox if given."""
+    lines = []
+    for name in names:
+        statements = [
+            clause_ql(statement if input_set is None else f"{statement}.{input_set}", conditions)
+            for statement, conditions in optimize(themes[name]["filters"])
+        ]
+        lines.append("(")
+        lines.extend("  " + statement for statement in statements)
+        lines.append(f")->.{theme_set_name(name)};")
+    return lines
+
+
+def _settings(bbox, timeout):
+    s, w, n, e = bbox[1], bbox[0], bbox[3], bbox[2]
+    return f"[out:json][timeout:{timeout}][bbox:{s},{w},{n},{e}];"
+
+
+def compile_themes(names, bbox, timeout=600, themes=THEMES, mode="body", meta=False, newer=None):
+    """
+    One Overpass query fetching every named theme inside bbox (minx, miny, maxx, maxy).
+
+    Each theme ends up in its own named set and the union of the sets is
+    printed once, in "body" mode together with the nodes and ways it needs.
+    The other modes print the elements alone, see streaming.iter_inline.
+
+    meta prints element versions and timestamps too. newer (an ISO 8601 UTC
+    timestamp) keeps only the elements changed since then, counting ways
+    whose nodes moved and relations whose member ways changed as changed.
+    """
+    statements = META_STATEMENTS if meta else OUT_STATEMENTS
+    if mode not in statements:
+        raise ValueError(f"Unknown output mode {mode!r}" + (" with meta" if meta else ""))
+    lines = [_settings(bbox, timeout)]
+    if newer is not None:
+        # Geometry changes do not bump the version of the ways and relations built from the nodes
+        lines.append(f'node(newer:"{newer}")->.changed;')
+        lines.append(f'(.changed; way(bn.changed); way(newer:"{newer}");)->.changed;')
+        lines.append(f'(.changed; rel(bw.changed); rel(newer:"{newer}");)->.changed;')
+    lines.extend(_theme_sets(names, themes, "changed" if newer is not None else None))
+    lines.append("(" + " ".join(f".{theme_set_name(name)};" for name in names) + ")->.themes;")
+    if mode == "body":
+        lines.append("(.themes; .themes >;);")
+    else:
+        lines.append(".themes;")
+    lines.append(statements[mode])
+    return "\n".join(lines)
+
+
+def compile_theme_ids(names, bbox, timeout=600, themes=THEMES):
+    """
+    One query listing the type and id of every element of the named themes inside bbox.
+
+    The ids of each theme follow a derived element {"type": "theme", "tags":
+    {"name": <theme>}} marking where its list starts.
+    """
+    lines = [_settings(bbox, timeout)]
+    lines.extend(_theme_sets(names, themes))
+    for name in names:
+        lines.append(f"make theme name={_quote(name)};")
+        lines.append("out;")
+        lines.append(f".{theme_set_name(name)} out ids qt;")
+    return "\n".join(lines)
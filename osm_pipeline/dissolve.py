@@ -0,0 +1,221 @@
+"""
+Parallel tiled dissolve of polygon layers.
+
+Each layer is cut into a grid of tiles; every feature belongs to exactly one
+tile, the one holding its representative point, so unions of tiles never
+double count. Tiles are dissolved in a process pool, then neighbouring tiles
+are merged 2x2 at a time level by level until one geometry per group is
+left, which keeps every union small and all cores busy. Several files share
+one pool.
+
+In streaming mode the parent only reads the layer bounds; every tile task
+reads its own bbox window from disk, so memory stays bounded by the tile.
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+
+TILE_FEATURES = 20000  # target features per tile
+
+
+def tile_grid(bounds, count, tile_features=TILE_FEATURES):
+    """(origin x, origin y, tile width, tile height, columns, rows) for about tile_features per tile."""
+    minx, miny, maxx, maxy = bounds
+    tiles = max(1, math.ceil(count / tile_features))
+    side = max(1, math.ceil(math.sqrt(tiles)))
+    width = (maxx - minx) / side or 1.0
+    height = (maxy - miny) / side or 1.0
+    return minx, miny, width, height, side, side
+
+
+def tile_index(points, grid):
+    """(column, row) of the tile holding each point, edges clamped into the grid."""
+    minx, miny, width, height, columns, rows = grid
+    xy = shapely.get_coordinates(points)
+    i = np.clip(np.floor((xy[:, 0] - minx) / width).astype(np.int64), 0, columns - 1)
+    j = np.clip(np.floor((xy[:, 1] - miny) / height).astype(np.int64), 0, rows - 1)
+    return i, j
+
+
+def _union_groups(values, geometries):
+    """{group value: WKB of the union of its geometries}; null values form no group, as in dissolve."""
+    result = {}
+    # factorize rather than sort: object columns may mix types and hold None
+    codes, uniques = pd.factorize(values)
+    if not len(codes):
+        return result
+    order = np.argsort(codes, kind="stable")
+    codes, geometries = codes[order], geometries[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(codes)]):
+        if codes[start] >= 0:
+            result[uniques[codes[start]]] = shapely.to_wkb(shapely.union_all(geometries[start:end]))
+    return result
+
+
+def _owned_rows(gdf, by):
+    """Rows with a geometry and a group value; GeoDataFrame.dissolve drops null groups the same way."""
+    return gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty & gdf[by].notna()]
+
+
+def dissolve_tile(values, wkbs):
+    return _union_groups(np.asarray(values, dtype=object), shapely.from_wkb(wkbs))
+
+
+def dissolve_window(path, by, grid, tile):
+    """Streaming tile task: read the tile's bbox window and keep the features it owns."""
+    minx, miny, width, height, _, _ = grid
+    i, j = tile
+    window = (minx + i * width, miny + j * height, minx + (i + 1) * width, miny + (j + 1) * height)
+    gdf = _owned_rows(gpd.read_file(path, bbox=window), by)
+    if gdf.empty:
+        return {}, {}
+    owner_i, owner_j = tile_index(gdf.geometry.representative_point().to_numpy(), grid)
+    owned = gdf[(owner_i == i) & (owner_j == j)]
+    first = {value: row for value, row in owned.drop(columns="geometry").groupby(by, sort=False).first().iterrows()}
+    return dissolve_tile(owned[by].to_numpy(), shapely.to_wkb(owned.geometry.to_numpy())), first
+
+
+def block_box(grid, level, block):
+    """Box covering the tiles of a merge block at the given level (tiles are level 0)."""
+    minx, miny, width, height, _, _ = grid
+    size = 2 ** level
+    i, j = block
+    return shapely.box(minx + i * size * width, miny + j * size * height,
+                       minx + (i + 1) * size * width, miny + (j + 1) * size * height)
+
+
+def merge_seams(blocks):
+    """
+    Union [(block box WKB, {group value: WKB}), ...] of neighbouring blocks.
+
+    Only parts reaching outside their own block, plus the parts they touch,
+    can join across a seam; everything else is copied as is.
+    """
+    grouped = {}
+    for box, part in blocks:
+        box = shapely.from_wkb(box)
+        for value, wkb in part.items():
+            pieces = shapely.get_parts(shapely.from_wkb(wkb))
+            inside = shapely.contains_properly(box, pieces)
+            grouped.setdefault(value, ([], []))
+            grouped[value][0].append(pieces[inside])
+            grouped[value][1].append(pieces[~inside])
+
+    merged = {}
+    for value, (inside, seam) in grouped.items():
+        inside, seam = np.concatenate(inside), np.concatenate(seam)
+        if len(seam):
+            touching = np.unique(shapely.STRtree(seam).query(inside, predicate="intersects")[0])
+            joined = np.zeros(len(inside), dtype=bool)
+            joined[touching] = True
+            seam = shapely.get_parts(shapely.union_all(np.concatenate((seam, inside[joined]))))
+            inside = inside[~joined]
+        merged[value] = shapely.to_wkb(shapely.multipolygons(np.concatenate((inside, seam))))
+    return merged
+
+
+def merge_tiles(executor, grid, level):
+    """Merge {(column, row): {group value: WKB}} of the tiles of a grid 2x2 blocks at a time until one is left."""
+    depth = 0
+    while len(level) > 1:
+        blocks = {}
+        for (i, j), part in level.items():
+            box = shapely.to_wkb(block_box(grid, depth, (i, j)))
+            blocks.setdefault((i // 2, j // 2), []).append((box, part))
+        futures = {
+            key: executor.submit(merge_seams, parts) if len(parts) > 1 else None
+            for key, parts in blocks.items()
+        }
+        level = {key: future.result() if future is not None else blocks[key][0][1] for key, future in futures.items()}
+        depth += 1
+    return next(iter(level.values()), {})
+
+
+class _Job:
+    """Dissolve state of one file: tile futures, then merge levels."""
+
+    def __init__(self, path, output_path, by):
+        self.path = path
+        self.output_path = output_path
+        self.by = by
+        self.streaming = False
+        self.crs = None
+        self.first = {}  # group value -> attributes of its first feature
+        self.grid = None
+        self.tiles = {}  # (column, row) -> future of {value: WKB}, or ({value: WKB}, first) when streaming
+
+    def submit(self, executor, tile_features, streaming):
+        self.streaming = streaming
+        if streaming:
+            info = pyogrio.read_info(self.path, force_total_bounds=True)
+            self.crs = info["crs"]
+            grid = self.grid = tile_grid(info["total_bounds"], info["features"], tile_features)
+            for i in range(grid[4]):
+                for j in range(grid[5]):
+                    self.tiles[(i, j)] = executor.submit(dissolve_window, self.path, self.by, grid, (i, j))
+            return
+
+        gdf = _owned_rows(gpd.read_file(self.path), self.by)
+        self.first = {value: row for value, row in gdf.drop(columns="geometry").groupby(self.by, sort=False).first().iterrows()}
+        self.crs = gdf.crs
+        if gdf.empty:
+            return
+        grid = self.grid = tile_grid(gdf.total_bounds, len(gdf), tile_features)
+        i, j = tile_index(gdf.geometry.representative_point().to_numpy(), grid)
+        values = gdf[self.by].to_numpy()
+        wkbs = shapely.to_wkb(gdf.geometry.to_numpy())
+        tile_keys = i * grid[5] + j
+        for key in np.unique(tile_keys):
+            members = tile_keys == key
+            self.tiles[(int(key // grid[5]), int(key % grid[5]))] = executor.submit(dissolve_tile, values[members], wkbs[members])
+
+    def merge(self, executor):
+        """Merge 2x2 blocks of neighbouring tiles until one remains."""
+        level = {}
+        for key, future in self.tiles.items():
+            result = future.result()
+            if self.streaming:
+                result, first = result
+                for value, row in first.items():
+                    self.first.setdefault(value, row)
+            if result:
+                level[key] = result
+        return merge_tiles(executor, self.grid, level)
+
+    def write(self, merged):
+        rows = []
+        for value in sorted(merged, key=str):
+            row = dict(self.first.get(value, {}))
+            row[self.by] = value
+            row["geometry"] = shapely.from_wkb(merged[value])
+            rows.append(row)
+        if not rows:
+            return 0
+        dissolved = gpd.GeoDataFrame(rows, geometry="geometry", crs=self.crs).set_index(self.by)
+        dissolved.to_file(self.output_path)
+        return len(dissolved)
+
+
+def dissolve_files(paths, by="building", max_workers=None, tile_features=TILE_FEATURES, streaming=False):
+    """
+    Dissolve every (input path, output path) pair by the given column, like GeoDataFrame.dissolve(by).
+
+    All files share one process pool: every file's tiles are queued first,
+    then each file is merged and written in turn. Returns {input path: dissolved feature count}.
+    """
+    jobs = [_Job(path, output_path, by) for path, output_path in paths]
+    counts = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for job in jobs:
+            job.submit(executor, tile_features, streaming)
+        for job in jobs:
+            counts[job.path] = job.write(job.merge(executor))
+            print(f"Dissolved {os.path.basename(job.path)}: {counts[job.path]} features")
+    return counts
@@ -0,0 +1,379 @@
+"""
+Array-backed store of the nodes, ways and relations of an Overpass response.
+
+overpy keeps every element as a Python object, with Decimal coordinates
+and a dict of tags: hundreds of bytes per node, and an attribute lookup
+and a float() for every coordinate a fetcher reads. Here node ids and
+coordinates are sorted NumPy arrays looked up with searchsorted, the node
+refs of ways and the members of relations are flat arrays with offsets,
+and tags are pairs of ids into one table of interned strings.
+
+Whole layers come out as one coordinate array plus offsets (way i is
+xy[offsets[i]:offsets[i + 1]], the layout of lengths.py), ready for
+vectorized lengths and Shapely's bulk constructors:
+
+    store = fetch_store(query, bbox=bbox)
+    ways = np.flatnonzero(store.theme_mask(THEMES["structures"], "way"))
+    xy, offsets = store.way_coords(ways)
+    lengths = lengths_from_offsets(xy, offsets, ellipsoidal=True)
+"""
+import re
+import sys
+from array import array
+
+import numpy as np
+import shapely
+
+from osm_pipeline.streaming import stream_query
+
+KINDS = ("node", "way", "relation")
+
+
+class StringTable:
+    """Interned strings by id; every distinct key, value and role is stored once."""
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, text):
+        string_id = self.ids.get(text)
+        if string_id is None:
+            string_id = self.ids[text] = len(self.strings)
+            self.strings.append(sys.intern(text))
+        return string_id
+
+    def get(self, text):
+        """Id of text, or None if no element uses it."""
+        return self.ids.get(text)
+
+    def values(self):
+        """The strings as an object array, indexable with id arrays."""
+        table = np.empty(len(self.strings), dtype=object)
+        table[:] = self.strings
+        return table
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _ragged_rows(offsets, rows):
+    """Flat positions of the given ragged rows, concatenated, and the offsets of the concatenation."""
+    counts = np.diff(offsets)[rows]
+    new_offsets = _offsets(counts)
+    positions = np.repeat(offsets[:-1][rows] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return positions, new_offsets
+
+
+def _take_ragged(offsets, columns, order):
+    """Offsets and columns of ragged rows reordered by order (row i of the result is row order[i])."""
+    positions, new_offsets = _ragged_rows(offsets, order)
+    return new_offsets, [column[positions] for column in columns]
+
+
+class _Tags:
+    """Tags of all elements of one kind: rows of (key id, value id) pairs."""
+
+    def __init__(self, offsets, keys, values):
+        self.offsets = offsets
+        self.keys = keys
+        self.values = values
+        self.element_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+class _Builder:
+    """Accumulates streamed elements in compact arrays, see ElementStore.from_elements."""
+
+    def __init__(self):
+        self.strings = StringTable()
+        self.ids = {kind: array("q") for kind in KINDS}
+        self.versions = {kind: array("q") for kind in KINDS}
+        self.tag_counts = {kind: array("q") for kind in KINDS}
+        self.tag_keys = {kind: array("i") for kind in KINDS}
+        self.tag_values = {kind: array("i") for kind in KINDS}
+        self.node_xy = array("d")
+        self.way_counts = array("q")
+        self.way_refs = array("q")
+        self.member_counts = array("q")
+        self.member_types = array("b")
+        self.member_refs = array("q")
+        self.member_roles = array("i")
+
+    def add(self, element):
+        kind = element["type"]
+        if kind not in self.ids:
+            return
+        self.ids[kind].append(element["id"])
+        self.versions[kind].append(element.get("version", 0))
+        tags = element.get("tags") or {}
+        self.tag_counts[kind].append(len(tags))
+        intern = self.strings.intern
+        for key, value in tags.items():
+            self.tag_keys[kind].append(intern(key))
+            self.tag_values[kind].append(intern(value))
+        if kind == "node":
+            self.node_xy.append(element["lon"])
+            self.node_xy.append(element["lat"])
+        elif kind == "way":
+            refs = element.get("nodes", ())
+            self.way_counts.append(len(refs))
+            self.way_refs.extend(refs)
+        else:
+            members = element.get("members", ())
+            self.member_counts.append(len(members))
+            for member in members:
+                self.member_types.append(KINDS.index(member["type"]))
+                self.member_refs.append(member["ref"])
+                self.member_roles.append(intern(member.get("role", "")))
+
+    def build(self):
+        store = ElementStore()
+        store.strings = self.strings
+        store.string_values = self.strings.values()
+        for kind in KINDS:
+            ids = np.frombuffer(self.ids[kind], dtype=np.int64)
+            # Overpass prints "out body" by id, "out qt" by quadtile: sort only when needed
+            order = None if np.all(ids[1:] > ids[:-1]) else np.argsort(ids, kind="stable")
+            tag_offsets = _offsets(np.frombuffer(self.tag_counts[kind], dtype=np.int64))
+            tag_columns = [np.frombuffer(self.tag_keys[kind], dtype=np.int32),
+                           np.frombuffer(self.tag_values[kind], dtype=np.int32)]
+            versions = np.frombuffer(self.versions[kind], dtype=np.int64)
+            if order is not None:
+                ids, versions = ids[order], versions[order]
+                tag_offsets, tag_columns = _take_ragged(tag_offsets, tag_columns, order)
+            store.ids[kind] = ids.copy()
+            store.versions[kind] = versions.copy()
+            store.tags[kind] = _Tags(tag_offsets, *(column.copy() for column in tag_columns))
+
+            if kind == "node":
+                xy = np.frombuffer(self.node_xy, dtype=np.float64).reshape(-1, 2)
+                store.node_xy = (xy if order is None else xy[order]).copy()
+            elif kind == "way":
+                offsets = _offsets(np.frombuffer(self.way_counts, dtype=np.int64))
+                refs = np.frombuffer(self.way_refs, dtype=np.int64)
+                if order is not None:
+                    offsets, (refs,) = _take_ragged(offsets, [refs], order)
+                store.way_offsets, store.way_refs = offsets, refs.copy()
+            else:
+                offsets = _offsets(np.frombuffer(self.member_counts, dtype=np.int64))
+                columns = [np.frombuffer(self.member_types, dtype=np.int8),
+                           np.frombuffer(self.member_refs, dtype=np.int64),
+                           np.frombuffer(self.member_roles, dtype=np.int32)]
+                if order is not None:
+                    offsets, columns = _take_ragged(offsets, columns, order)
+                store.member_offsets = offsets
+                store.member_types, store.member_refs, store.member_roles = (column.copy() for column in columns)
+        return store
+
+
+class ElementStore:
+    """
+    Nodes, ways and relations of a response as sorted, flat NumPy arrays.
+
+    Elements of each kind are addressed by their position in ids[kind]
+    (sorted ascending). Ways and relations refer to their nodes and members
+    by OSM id; members missing from the response are skipped on resolution,
+    like the bbox-cut members of iter_resolved.
+    """
+
+    def __init__(self):
+        self.strings = StringTable()
+        self.string_values = self.strings.values()
+        self.ids = {kind: np.empty(0, dtype=np.int64) for kind in KINDS}
+        self.versions = {kind: np.empty(0, dtype=np.int64) for kind in KINDS}
+        self.tags = {kind: _Tags(np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32),
+                                 np.empty(0, dtype=np.int32)) for kind in KINDS}
+        self.node_xy = np.empty((0, 2), dtype=np.float64)
+        self.way_offsets = np.zeros(1, dtype=np.int64)
+        self.way_refs = np.empty(0, dtype=np.int64)
+        self.member_offsets = np.zeros(1, dtype=np.int64)
+        self.member_types = np.empty(0, dtype=np.int8)
+        self.member_refs = np.empty(0, dtype=np.int64)
+        self.member_roles = np.empty(0, dtype=np.int32)
+
+    @classmethod
+    def from_elements(cls, elements):
+        """Store of the element dicts of streaming.iter_elements, consumed one at a time."""
+        builder = _Builder()
+        for element in elements:
+            builder.add(element)
+        return builder.build()
+
+    def count(self, kind):
+        return len(self.ids[kind])
+
+    @property
+    def nbytes(self):
+        """Bytes held by the arrays (the string table not included)."""
+        arrays = [self.node_xy, self.way_offsets, self.way_refs, self.member_offsets, self.member_types,
+                  self.member_refs, self.member_roles]
+        for kind in KINDS:
+            tags = self.tags[kind]
+            arrays += [self.ids[kind], self.versions[kind], tags.offsets, tags.keys, tags.values]
+        return sum(a.nbytes for a in arrays)
+
+    def index(self, kind, ids):
+        """Positions of OSM ids among the elements of kind, -1 for those not in the store."""
+        known = self.ids[kind]
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(known, ids)
+        clipped = np.minimum(positions, max(len(known) - 1, 0))
+        found = (positions < len(known)) & (known[clipped] == ids) if len(known) else np.zeros(ids.shape, dtype=bool)
+        return np.where(found, positions, -1)
+
+    def node_coords(self, ids):
+        """(lon, lat) rows for node ids and a mask of those found; rows of missing nodes are NaN."""
+        positions = self.index("node", ids)
+        found = positions >= 0
+        xy = np.full((len(positions), 2), np.nan)
+        xy[found] = self.node_xy[positions[found]]
+        return xy, found
+
+    # Tags
+
+    def element_tags(self, kind, i):
+        """Tags of element i of kind as a dict."""
+        tags = self.tags[kind]
+        start, end = tags.offsets[i], tags.offsets[i + 1]
+        strings = self.strings.strings
+        return {strings[k]: strings[v] for k, v in zip(tags.keys[start:end].tolist(), tags.values[start:end].tolist())}
+
+    def tag_values(self, kind, key, default=None):
+        """Object array with the value of key for every element of kind, default where it is absent."""
+        values = np.full(self.count(kind), default, dtype=object)
+        key_id = self.strings.get(key)
+        if key_id is None:
+            return values
+        tags = self.tags[kind]
+        has_key = tags.keys == key_id
+        values[tags.element_index[has_key]] = self.string_values[tags.values[has_key]]
+        return values
+
+    def _value_ids(self, kind, key):
+        """Value id of key for every element of kind, -1 where it is absent."""
+        value_ids = np.full(self.count(kind), -1, dtype=np.int32)
+        key_id = self.strings.get(key)
+        if key_id is not None:
+            tags = self.tags[kind]
+            has_key = tags.keys == key_id
+            value_ids[tags.element_index[has_key]] = tags.values[has_key]
+        return value_ids
+
+    def _condition_mask(self, kind, condition):
+        key, op, value = condition
+        value_ids = self._value_ids(kind, key)
+        present = value_ids >= 0
+        if op == "exists":
+            return present
+        if op in ("=", "!="):
+            value_id = self.strings.get(value)
+            equal = value_ids == value_id if value_id is not None else np.zeros(len(value_ids), dtype=bool)
+            # Like Overpass, an absent key also counts as "not equal"
+            return equal if op == "=" else ~equal
+        if op == "~":
+            # The regex runs once per distinct value, not once per element
+            pattern = re.compile(value)
+            distinct = np.unique(value_ids[present])
+            matching = distinct[[pattern.search(self.strings.strings[v]) is not None for v in distinct.tolist()]]
+            return present & np.isin(value_ids, matching)
+        raise ValueError(f"Unknown tag operator {op!r}")
+
+    def match(self, kind, conditions):
+        """Mask of the elements of kind meeting all (key, op, value) conditions (see themes.tag_matches)."""
+        mask = np.ones(self.count(kind), dtype=bool)
+        for condition in conditions:
+            mask &= self._condition_mask(kind, condition)
+        return mask
+
+    def theme_mask(self, theme, kind):
+        """Mask of the elements of kind matched by any filter clause of a theme (see themes.theme_matches)."""
+        mask = np.zeros(self.count(kind), dtype=bool)
+        for clause_type, conditions in theme["filters"]:
+            if clause_type == kind:
+                mask |= self.match(kind, conditions)
+        return mask
+
+    # Geometry
+
+    def way_node_refs(self, i):
+        return self.way_refs[self.way_offsets[i]:self.way_offsets[i + 1]]
+
+    def way_coords(self, ways=None):
+        """
+        (xy, offsets) of the given way positions (all ways by default), in one array.
+
+        Nodes missing from the response are left out of their way, so check the
+        lengths (np.diff(offsets)) before building geometries.
+        """
+        rows = np.arange(self.count("way")) if ways is None else np.asarray(ways, dtype=np.int64)
+        positions, row_offsets = _ragged_rows(self.way_offsets, rows)
+        node_index = self.index("node", self.way_refs[positions])
+        found = node_index >= 0
+        line_index = np.repeat(np.arange(len(rows)), np.diff(row_offsets))
+        offsets = _offsets(np.bincount(line_index[found], minlength=len(rows)))
+        return self.node_xy[node_index[found]], offsets
+
+    def linestrings(self, ways=None):
+        """Shapely LineStrings of ways with at least two resolved nodes, and their positions."""
+        rows = np.arange(self.count("way")) if ways is None else np.asarray(ways, dtype=np.int64)
+        xy, offsets = self.way_coords(rows)
+        counts = np.diff(offsets)
+        valid = counts >= 2
+        keep = np.repeat(valid, counts)
+        lines = shapely.linestrings(xy[keep], indices=np.repeat(np.arange(valid.sum()), counts[valid]))
+        return lines, rows[valid]
+
+    def relation_members(self, i):
+        """[(type, ref, role)] of relation i, in member order."""
+        start, end = self.member_offsets[i], self.member_offsets[i + 1]
+        strings = self.strings.strings
+        return [(KINDS[t], ref, strings[role]) for t, ref, role in zip(
+            self.member_types[start:end].tolist(), self.member_refs[start:end].tolist(),
+            self.member_roles[start:end].tolist())]
+
+    def relation_ways(self, i):
+        """
+        [(role, coordinates, node ids)] of the way members of relation i.
+
+        The shape streaming.iter_resolved yields for relations, so
+        rings.assemble_multipolygon and TransitNetwork.add_route take it as is.
+        """
+        start, end = self.member_offsets[i], self.member_offsets[i + 1]
+        is_way = self.member_types[start:end] == KINDS.index("way")
+        way_index = self.index("way", self.member_refs[start:end][is_way])
+        roles = self.member_roles[start:end][is_way]
+        strings = self.strings.strings
+        members = []
+        for way, role in zip(way_index.tolist(), roles.tolist()):
+            if way < 0:
+                continue
+            refs = self.way_node_refs(way)
+            xy, found = self.node_coords(refs)
+            members.append((strings[role], xy[found].tolist(), refs[found].tolist()))
+        return members
+
+    def element(self, kind, i):
+        """Element i of kind as a minimal Overpass dict (type, id, tags), for code written against those."""
+        return {"type": kind, "id": int(self.ids[kind][i]), "tags": self.element_tags(kind, i)}
+
+
+def _unresolved(elements):
+    for element in elements:
+        yield element, None
+
+
+def fetch_store(query, bbox=None, max_retries=5, **kwargs):
+    """
+    ElementStore of a recursed "out body" query, fetched with streaming.stream_query.
+
+    The response is parsed one element at a time straight into the arrays,
+    without overpy objects or a materialized element list in between.
+    """
+    elements = stream_query(query, bbox=bbox, max_retries=max_retries, resolve=_unresolved, **kwargs)
+    return ElementStore.from_elements(element for element, _ in elements)
@@ -0,0 +1,219 @@
+"""
+Offline isochrones over a local pedestrian graph.
+
+The foot network of a frame is fetched once, turned into a CSR adjacency
+(indptr/indices/weights in walking seconds) and saved as a small .npz. Stops
+are snapped to their nearest node of a connected piece of the network
+(not a stray fragment of a few nodes) and searched with time-bounded
+Dijkstra, one source at a time in tasks of many sources spread over a
+process pool; the nodes each stop reaches become its isochrone polygon.
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+from shapely.geometry import mapping
+
+from osm_pipeline.isochrones import get_time_limit
+from osm_pipeline.lengths import EARTH_RADIUS, haversine_segments
+from osm_pipeline.streaming import stream_query
+
+WALKING_SPEED = 5 / 3.6  # m/s, GraphHopper's foot profile
+SOURCES_PER_TASK = 64  # sources sent to a worker at once, searched one by one
+HULL_RATIO = 0.2
+MIN_COMPONENT_NODES = 50  # stops snap to components at least this big, or to the largest one
+DEFAULT_GRAPH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_cache", "graphs")
+
+
+def foot_query(bbox):
+    s, w, n, e = bbox[1], bbox[0], bbox[3], bbox[2]
+    return f'''
+    [out:json][timeout:600];
+    (
+        way["highway"]["highway"!~"motorway|motorway_link|trunk|trunk_link|construction|proposed|raceway|bus_guideway"]["foot"!~"no|private"]["access"!~"^(no|private)$"]({s},{w},{n},{e});
+    );
+    (._;>;);
+    out body;
+    '''
+
+
+def walking_bbox(bounds, time_limit=900, speed=WALKING_SPEED):
+    """Stop bounds (minx, miny, maxx, maxy) grown by the longest walk, so isochrones are not cut off."""
+    reach = time_limit * speed
+    dlat = math.degrees(reach / EARTH_RADIUS)
+    dlon = dlat / max(math.cos(math.radians(max(abs(bounds[1]), abs(bounds[3])))), 0.01)
+    return bounds[0] - dlon, bounds[1] - dlat, bounds[2] + dlon, bounds[3] + dlat
+
+
+class FootGraph:
+    """Undirected walking graph in CSR form; weights are seconds at WALKING_SPEED."""
+
+    def __init__(self, xy, indptr, indices, weights):
+        self.xy = xy
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self._tree = None
+
+    def __len__(self):
+        return len(self.xy)
+
+    @classmethod
+    def from_ways(cls, ways, speed=WALKING_SPEED):
+        """ways yields (node ids, [(lon, lat), ...]) pairs of equal length."""
+        ids = {}
+        coords = []
+        heads, tails = [], []
+        for refs, line in ways:
+            previous = None
+            for ref, point in zip(refs, line):
+                index = ids.get(ref)
+                if index is None:
+                    index = ids[ref] = len(coords)
+                    coords.append(point)
+                if previous is not None and previous != index:
+                    heads.append(previous)
+                    tails.append(index)
+                previous = index
+
+        xy = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        u = np.array(heads + tails, dtype=np.int64)
+        v = np.array(tails + heads, dtype=np.int64)
+        seconds = haversine_segments(xy[u, 0], xy[u, 1], xy[v, 0], xy[v, 1]) / speed
+
+        # Ways sharing a segment would add it twice, keep the shortest copy
+        order = np.lexsort((seconds, v, u))
+        u, v, seconds = u[order], v[order], seconds[order]
+        first = np.ones(len(u), dtype=bool)
+        first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, seconds = u[first], v[first], seconds[first]
+
+        indptr = np.zeros(len(xy) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(u, minlength=len(xy)), out=indptr[1:])
+        return cls(xy, indptr, v.astype(np.int32), seconds)
+
+    @classmethod
+    def fetch(cls, bbox, speed=WALKING_SPEED):
+        """Build the graph for bbox (minx, miny, maxx, maxy) from Overpass."""
+        def ways():
+            for element, line in stream_query(foot_query(bbox), bbox=bbox):
+                if element["type"] == "way" and len(line) == len(element.get("nodes", ())):
+                    yield element["nodes"], line
+        return cls.from_ways(ways(), speed)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["xy"], data["indptr"], data["indices"], data["weights"])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(path, xy=self.xy, indptr=self.indptr, indices=self.indices, weights=self.weights)
+
+    @classmethod
+    def load_or_fetch(cls, path, bbox, speed=WALKING_SPEED):
+        if os.path.exists(path):
+            return cls.load(path)
+        graph = cls.fetch(bbox, speed)
+        graph.save(path)
+        return graph
+
+    def matrix(self):
+        n = len(self.xy)
+        return csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+
+    def snappable(self, min_nodes=MIN_COMPONENT_NODES):
+        """
+        Mask of the nodes a stop may snap to: those of components with at least min_nodes nodes.
+
+        A footway fragment cut off by the bbox or by a missing OSM connection
+        would otherwise give the stops next to it a near-empty isochrone. The
+        largest component always qualifies.
+        """
+        _, labels = connected_components(self.matrix(), directed=False)
+        sizes = np.bincount(labels)
+        return sizes[labels] >= min(min_nodes, sizes.max())
+
+    def nearest(self, lon, lat):
+        """Snappable node index closest to every (lon, lat), on a local equirectangular plane."""
+        if self._tree is None:
+            self._scale = math.cos(math.radians(float(np.mean(self.xy[:, 1]))))
+            self._snap_nodes = np.flatnonzero(self.snappable())
+            xy = self.xy[self._snap_nodes]
+            self._tree = cKDTree(np.column_stack((xy[:, 0] * self._scale, xy[:, 1])))
+        points = np.column_stack((np.asarray(lon, dtype=np.float64) * self._scale, np.asarray(lat, dtype=np.float64)))
+        return self._snap_nodes[self._tree.query(points)[1]]
+
+
+_worker_graph = None
+
+
+def _init_worker(xy, indptr, indices, weights):
+    global _worker_graph
+    _worker_graph = (xy, FootGraph(xy, indptr, indices, weights).matrix())
+
+
+def isochrone_polygon(points):
+    """Concave hull of the reached node coordinates."""
+    if len(points) < 3:
+        return shapely.buffer(shapely.multipoints(points), 0.0001) if len(points) else None
+    return shapely.concave_hull(shapely.multipoints(points), ratio=HULL_RATIO)
+
+
+def _search(sources, limit):
+    """
+    GeoJSON isochrone for every source node, in order.
+
+    dijkstra returns a dense row of len(graph) distances per source, so the
+    sources are searched one by one and a worker holds a single row at a time.
+    """
+    xy, matrix = _worker_graph
+    polygons = []
+    for source in sources:
+        seconds = dijkstra(matrix, directed=True, indices=int(source), limit=limit)
+        polygon = isochrone_polygon(xy[np.isfinite(seconds)])
+        polygons.append(mapping(polygon) if polygon is not None and not polygon.is_empty else None)
+    return polygons
+
+
+def compute_isochrones(stops, journal, graph, max_workers=None):
+    """
+    Offline counterpart of isochrones.fetch_isochrones, writing to the same journal.
+
+    Stops not yet journaled are grouped by their time limit, snapped to the
+    graph and searched SOURCES_PER_TASK at a time in a process pool.
+    """
+    done = journal.done()
+    pending = stops[~stops['id'].astype(int).isin(done)]
+    print(f"{len(done)} stops already journaled, {len(pending)} to compute")
+    if pending.empty:
+        return 0
+
+    sources = graph.nearest(pending['longitude'].to_numpy(), pending['latitude'].to_numpy())
+    limits = np.array([get_time_limit(railway) for railway in pending['railway']])
+    tasks = []
+    for limit in np.unique(limits):
+        positions = np.flatnonzero(limits == limit)
+        for start in range(0, len(positions), SOURCES_PER_TASK):
+            chunk = positions[start:start + SOURCES_PER_TASK]
+            tasks.append((chunk, sources[chunk], float(limit)))
+
+    computed = 0
+    arrays = (graph.xy, graph.indptr, graph.indices, graph.weights)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=arrays) as executor:
+        futures = [(chunk, limit, executor.submit(_search, nodes, limit)) for chunk, nodes, limit in tasks]
+        for chunk, limit, future in futures:
+            for position, polygon in zip(chunk, future.result()):
+                stop = pending.iloc[position]
+                if polygon is None:
+                    print(f"No walkable graph around stop {stop['id']}")
+                    continue
+                journal.record(stop['id'], stop['railway'], int(limit), [polygon])
+                computed += 1
+        print(f"Computed {computed} isochrones")
+    return computed
@@ -0,0 +1,237 @@
+"""
+Plan the fetches of nested frame sheets so each area is downloaded once.
+
+The sheet layers in _Ogolne nest: Arkusze_Centra and Arkusze_Centra_2 lie
+inside Arkusze_Miasta, which lies inside Arkusze_Aglomeracje. plan_frames
+finds, with an STRtree over every frame of every sheet, the smallest frame
+covering each one; only the outermost frames (the roots) are fetched, and
+every frame under a root, the root included, gets the features clipped to
+its actual polygon rather than everything inside its bbox.
+
+Roots are agglomeration sized, so they go through tiling.fetch_tiled (split
+where Overpass times out, planned for the next run) and features are
+clipped to the frames as they stream in.
+"""
+import os
+
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon, mapping, shape
+from shapely.strtree import STRtree
+
+from osm_pipeline.compiler import compile_themes, output_mode
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.multitheme import GIT_DIR, OUTPUT_DIR, match_themes
+from osm_pipeline.scheduler import DEFAULT_BURST, run_concurrently
+from osm_pipeline.sheets import read_sheet
+from osm_pipeline.streaming import stream_query
+from osm_pipeline.themes import GEOMETRY_TYPES, THEMES
+from osm_pipeline.tiling import DEFAULT_PLAN_DIR, TileFetchError, fetch_tiled, path_bbox
+from osm_pipeline.writers import FrameWriters
+
+SHEETS = ("Arkusze_Aglomeracje", "Arkusze_Miasta", "Arkusze_Centra", "Arkusze_Centra_2")
+# Dimension of the features each theme geometry kind produces
+DIMENSIONS = {"point": 0, "line": 1, "member_lines": 1, "polygon": 2}
+
+
+class Frame:
+    """One frame of a sheet layer, its geometry in WGS 84."""
+
+    def __init__(self, sheet, name, geometry):
+        self.sheet = sheet
+        self.name = name
+        self.geometry = geometry
+
+    @property
+    def key(self):
+        """Output name, one subdirectory per sheet (see writers.frame_output_path)."""
+        return f"{self.sheet}/{self.name}"
+
+    @property
+    def bbox(self):
+        return self.geometry.bounds
+
+    def __repr__(self):
+        return f"Frame({self.key!r})"
+
+
+def load_frames(sheet_paths):
+    """Frames of every sheet layer, named as in sheets.read_sheet."""
+    frames = []
+    for path in sheet_paths:
+        sheet_name = os.path.splitext(os.path.basename(path))[0]
+        frames.extend(Frame(sheet_name, name, geometry) for name, geometry in read_sheet(path))
+    return frames
+
+
+def plan_frames(frames, tolerance=0.0):
+    """
+    Group frames under the outermost frame covering them: [(root, [frames])].
+
+    Each root's list starts with the root itself. A frame is covered by
+    another when it lies inside it (within tolerance degrees); of identical
+    frames the first one is the root.
+    """
+    geometries = np.array([frame.geometry for frame in frames])
+    areas = shapely.area(geometries)
+    tree = STRtree(shapely.buffer(geometries, tolerance) if tolerance else geometries)
+    frame_index, container_index = tree.query(geometries, predicate="covered_by")
+
+    # Parent: the smallest frame covering it
+    parents = [None] * len(frames)
+    for i, j in zip(frame_index, container_index):
+        if i == j or areas[j] < areas[i] or (areas[j] == areas[i] and j > i):
+            continue
+        if parents[i] is None or areas[j] < areas[parents[i]]:
+            parents[i] = j
+
+    groups = {}
+    for i in range(len(frames)):
+        root = i
+        while parents[root] is not None:
+            root = parents[root]
+        groups.setdefault(root, []).append(i)
+    return [(frames[root], [frames[root]] + [frames[i] for i in members if i != root])
+            for root, members in groups.items()]
+
+
+def _parts(geometry, dimension):
+    """Single parts of geometry with the given dimension (a clip may leave points or lines on the edge)."""
+    parts = shapely.get_parts(shapely.get_parts(geometry))
+    return [part for part in parts if not part.is_empty and shapely.get_dimensions(part) == dimension]
+
+
+def clip_to_frame(geometry, frame_geometry):
+    """geometry as it is if it lies inside the frame geometry, else the part of it inside."""
+    if shapely.covered_by(geometry, frame_geometry):
+        return geometry
+    return shapely.intersection(geometry, frame_geometry)
+
+
+def frame_features(kind, clipped, properties):
+    """GeoJSON features of one clipped geometry: one per line part, polygon parts in one MultiPolygon."""
+    parts = _parts(clipped, DIMENSIONS[kind])
+    if not parts:
+        return []
+    if kind == "polygon":
+        geometries = [parts[0] if len(parts) == 1 else MultiPolygon(parts)]
+    else:
+        geometries = parts
+    return [{"type": "Feature", "geometry": mapping(geometry), "properties": properties} for geometry in geometries]
+
+
+class _FrameClipper:
+    """
+    Writes streamed theme features clipped to every frame they intersect.
+
+    Passed to tiling.fetch_tiled as write(), so features are clipped as they
+    arrive and never collected; the keys of the elements written are kept
+    so a refetch of some frames skips what they already got.
+    """
+
+    def __init__(self, frames, writers, themes, counts, written=None):
+        self.frames = frames
+        self.tree = STRtree([frame.geometry for frame in frames])
+        for frame in frames:
+            shapely.prepare(frame.geometry)
+        self.writers = writers
+        self.themes = themes
+        self.counts = counts
+        self.written = set() if written is None else written
+
+    def write(self, item):
+        key, name, feature = item
+        if key in self.written:
+            return
+        self.written.add(key)
+        kind = self.themes[name]["geometry"]
+        geometry = shape(feature["geometry"])
+        for index in self.tree.query(geometry, predicate="intersects"):
+            frame = self.frames[index]
+            for clipped in frame_features(kind, clip_to_frame(geometry, frame.geometry), feature["properties"]):
+                self.writers.get(frame.key, name, geometry_type=GEOMETRY_TYPES[kind]).write(clipped)
+                self.counts[frame.key][name] += 1
+
+
+def _tile_fetcher(names, themes, mode, max_retries):
+    """fetch_tile for tiling.fetch_tiled: the themes of one tile keyed by theme, element and feature."""
+    def fetch_tile(tile_bbox):
+        query = compile_themes(names, tile_bbox, themes=themes, mode=mode)
+        elements = stream_query(query, bbox=tile_bbox, max_retries=max_retries, inline=mode != "body")
+        for name, element, features in match_themes(elements, names, themes):
+            for index, feature in enumerate(features):
+                key = (name, element["type"], element["id"], index)
+                yield key, (key, name, feature)
+    return fetch_tile
+
+
+def plan_path(root, names):
+    return os.path.join(DEFAULT_PLAN_DIR, "frames", f"{'-'.join(sorted(names))}_{root.sheet}_{root.name}.json")
+
+
+def fetch_root(root, members, names, writers, themes=THEMES, max_retries=3, max_workers=DEFAULT_BURST):
+    """
+    Fetch the themes for the bbox of root and write every member frame clipped to its polygon.
+
+    The root is fetched with tiling.fetch_tiled, split into quadrants where
+    the server times out, and features are clipped to the frames as they
+    stream in. If tiles still fail, the member frames they touch are fetched
+    again one by one, each only writing the elements not written yet.
+    Returns ({frame key: {theme: feature count}}, {frame key: error}) for
+    the frames written and those left incomplete.
+    """
+    recorder = get_default_recorder()
+    mode = output_mode(names, themes)
+    fetch_tile = _tile_fetcher(names, themes, mode, max_retries)
+    counts = {frame.key: dict.fromkeys(names, 0) for frame in members}
+    failed = {}
+    with recorder.span("frame", root.key, bbox=root.bbox, themes=names, mode=mode, frames=len(members)) as span:
+        clipper = _FrameClipper(members, writers, themes, counts)
+        try:
+            fetch_tiled(root.bbox, fetch_tile, plan_path(root, names), clipper.write, max_workers=max_workers)
+        except TileFetchError as error:
+            tiles = shapely.box(*np.array([path_bbox(root.bbox, path) for path in error.failed]).T)
+            incomplete = [frame for frame in members if shapely.intersects(tiles, frame.geometry).any()]
+            print(f"{root.key}: {len(error.failed)} tile(s) failed, fetching {len(incomplete)} frame(s) one by one")
+            # Elements already written reached every frame they touch, only new ones are clipped
+            fallback = _FrameClipper(incomplete, writers, themes, counts, clipper.written)
+            for frame in incomplete:
+                try:
+                    fetch_tiled(frame.bbox, fetch_tile, None, fallback.write, max_workers=max_workers)
+                except Exception as frame_error:
+                    failed[frame.key] = frame_error
+        span.add("features", sum(count for frame_counts in counts.values() for count in frame_counts.values()))
+    return counts, failed
+
+
+def fetch_sheets(sheet_paths, names, output_format="gpkg", output_dir=OUTPUT_DIR, max_workers=2, tolerance=0.0):
+    """Every frame of every sheet, one tiled fetch per outermost frame and one output per frame."""
+    plan = plan_frames(load_frames(sheet_paths), tolerance)
+    frame_count = sum(len(members) for _, members in plan)
+    print(f"{frame_count} frames, {len(plan)} roots")
+
+    with FrameWriters(output_format, output_dir) as writers:
+        def fetch(group):
+            root, members = group
+            return fetch_root(root, members, names, writers)
+
+        for (root, _), result, error in run_concurrently(fetch, plan, max_workers=max_workers):
+            if error is not None:
+                print(f"Failed to fetch {root.key}: {error}")
+                continue
+            counts, failed = result
+            for key, frame_counts in counts.items():
+                if key in failed:
+                    print(f"Failed to fetch {key}, written incomplete: {failed[key]}")
+                else:
+                    print(f"{key}: " + ", ".join(f"{theme} {count}" for theme, count in frame_counts.items()))
+
+
+def main(sheets=SHEETS, names=("structures", "cycleways", "roads", "gastronomy", "transit")):
+    fetch_sheets([os.path.join(GIT_DIR, "_Ogolne", f"{sheet}.shp") for sheet in sheets], list(names))
+    get_default_recorder().print_summary()
+    print("Data fetching complete.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Multi-scale generalized copies of polygon and line layers.
+
+For every target scale a layer gets a copy simplified with a tolerance of
+SIMPLIFY_MM on paper, without the features smaller than MIN_AREA_MM2 or
+shorter than MIN_LENGTH_MM at that scale. Small polygons close to each
+other are aggregated first (closed over AGGREGATE_MM), so dense building
+fabric turns into blocks instead of vanishing. Each level is built from
+the previous, finer one.
+
+Polygons are simplified as a coverage (shapely.coverage_simplify): an
+edge shared by neighbouring polygons is simplified once for both, so no
+slivers open between them at coarse scales. Polygons that overlap their
+neighbours are no coverage and are simplified on their own, like lines
+(Shapely's preserve_topology: no ring collapses or crosses itself).
+
+The work is done in metres in the layer's UTM zone, spread over a process
+pool. Aggregation runs on the tiles of dissolve.py: every tile closes the
+small polygons within a halo around it and keeps the part of the blocks
+inside the tile, which is exact, and the pieces are merged across the
+seams with dissolve.merge_tiles before they are simplified. Every level is
+written as its own layer with an R-tree next to the original
+(<layer>_<scale / 1000>k), ready for scale-dependent visibility in QGIS.
+
+    python -m osm_pipeline.generalize _Ogolne/themes_output/Arkusze_Aglomeracje/*.gpkg
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from shapely.strtree import STRtree
+
+from osm_pipeline.dissolve import TILE_FEATURES, block_box, merge_tiles, tile_grid
+
+SCALES = (25000, 50000, 100000, 200000)
+SIMPLIFY_MM = 0.1  # simplification tolerance on paper
+MIN_AREA_MM2 = 0.1  # polygons smaller than this on paper are aggregated or dropped
+MIN_LENGTH_MM = 1.0  # lines shorter than this on paper are dropped
+AGGREGATE_MM = 0.5  # small polygons closer than this on paper are merged
+MITRE_LIMIT = 5.0  # the GEOS default, mitred corners reach at most this many buffer distances out
+POLYGON_TYPE_ID = 3
+LINE_TYPE_ID = 1
+
+
+def level_name(layer, scale):
+    return f"{layer}_{scale // 1000}k"
+
+
+def _polygonal(geometries):
+    """Mask of the geometries with polygonal parts (simplification and clips can leave lines)."""
+    parts, part_index = shapely.get_parts(geometries, return_index=True)
+    polygonal = (shapely.get_type_id(parts) == POLYGON_TYPE_ID) & ~shapely.is_empty(parts)
+    mask = np.zeros(len(geometries), dtype=bool)
+    mask[part_index[polygonal]] = True
+    return mask
+
+
+def close_tile(wkbs, box_wkb, distance):
+    """
+    {0: WKB} of the small polygons of a tile and its halo closed over 2 * distance, clipped to the tile.
+
+    The clip reaches distance / 100 past the tile, so the pieces of a block
+    overlap their neighbours' and union into one across the seam.
+    """
+    closed = shapely.buffer(shapely.from_wkb(wkbs), distance, join_style="mitre", mitre_limit=MITRE_LIMIT)
+    blocks = shapely.buffer(shapely.union_all(closed), -distance, join_style="mitre", mitre_limit=MITRE_LIMIT)
+    box = shapely.buffer(shapely.from_wkb(box_wkb), distance / 100, join_style="mitre")
+    parts = shapely.get_parts(shapely.intersection(blocks, box))
+    parts = parts[(shapely.get_type_id(parts) == POLYGON_TYPE_ID) & ~shapely.is_empty(parts)]
+    return {0: shapely.to_wkb(shapely.multipolygons(parts))} if len(parts) else {}
+
+
+def _aggregate(executor, small, distance, tile_features):
+    """Blocks of the small polygons closed over 2 * distance, merged across tile seams."""
+    grid = tile_grid(shapely.total_bounds(small), len(small), tile_features)
+    tree = STRtree(small)
+    # A point of the closing depends on the polygons within two buffer distances, mitred corners included
+    halo = 2 * MITRE_LIMIT * distance
+    futures = {}
+    for i in range(grid[4]):
+        for j in range(grid[5]):
+            box = block_box(grid, 0, (i, j))
+            rows = tree.query(shapely.buffer(box, halo, join_style="mitre"))
+            if len(rows):
+                futures[(i, j)] = executor.submit(close_tile, shapely.to_wkb(small[rows]), shapely.to_wkb(box), distance)
+    tiles = {key: part for key, part in ((key, future.result()) for key, future in futures.items()) if part}
+    merged = merge_tiles(executor, grid, tiles)
+    return shapely.get_parts(shapely.from_wkb(merged[0])) if merged else np.empty(0, dtype=object)
+
+
+def simplify_chunk(wkbs, tolerance):
+    return shapely.to_wkb(shapely.simplify(shapely.from_wkb(wkbs), tolerance, preserve_topology=True))
+
+
+def simplify_coverage_chunk(wkbs, tolerance):
+    """
+    Polygons simplified as one coverage, shared edges stay shared.
+
+    The polygons with edges that are not part of a valid coverage (overlaps
+    with a neighbour) are simplified one by one instead.
+    """
+    polygons = shapely.from_wkb(wkbs)
+    overlapping = ~shapely.is_empty(shapely.coverage_invalid_edges(polygons))
+    simplified = np.empty(len(polygons), dtype=object)
+    simplified[~overlapping] = shapely.coverage_simplify(polygons[~overlapping], tolerance)
+    simplified[overlapping] = shapely.simplify(polygons[overlapping], tolerance, preserve_topology=True)
+    return shapely.to_wkb(simplified)
+
+
+def _chunks(count, tile_features):
+    return np.array_split(np.arange(count), max(1, -(-count // tile_features)))
+
+
+def _coverage_chunks(polygons, tile_features):
+    """Row chunks of about tile_features polygons, polygons that touch always in the same chunk."""
+    left, right = STRtree(polygons).query(polygons, predicate="intersects")
+    touching = coo_matrix((np.ones(len(left), dtype=bool), (left, right)), shape=(len(polygons),) * 2)
+    _, labels = connected_components(touching, directed=False)
+    order = np.argsort(labels, kind="stable")
+    ends = np.cumsum(np.bincount(labels))
+    # Cut at the end of the group that reaches each multiple of tile_features
+    cuts = np.unique(ends[np.searchsorted(ends, np.arange(tile_features, len(polygons), tile_features))])
+    return [chunk for chunk in np.split(order, cuts) if len(chunk)]
+
+
+def _simplify(executor, geometries, tolerance, tile_features, coverage=False):
+    """
+    Geometries simplified in chunks of tile_features over the pool.
+
+    With coverage, the geometries are polygons simplified as a coverage;
+    the chunks keep touching polygons together so their shared edges are
+    simplified in the same call.
+    """
+    if not len(geometries):
+        return geometries
+    if coverage:
+        chunks, simplify = _coverage_chunks(geometries, tile_features), simplify_coverage_chunk
+    else:
+        chunks, simplify = _chunks(len(geometries), tile_features), simplify_chunk
+    futures = [executor.submit(simplify, shapely.to_wkb(geometries[chunk]), tolerance) for chunk in chunks]
+    simplified = np.empty(len(geometries), dtype=object)
+    for chunk, future in zip(chunks, futures):
+        simplified[chunk] = shapely.from_wkb(future.result())
+    return simplified
+
+
+def _generalize_polygons(executor, geometries, sources, paper_mm, tile_features):
+    """Simplified polygons of one level and their source rows (-1 for aggregates)."""
+    min_area = MIN_AREA_MM2 * paper_mm ** 2
+    large = shapely.area(geometries) >= min_area
+    shapes, indices = [geometries[large]], [sources[large]]
+    small = geometries[~large]
+    if len(small):
+        blocks = _aggregate(executor, small, AGGREGATE_MM * paper_mm / 2, tile_features)
+        blocks = blocks[shapely.area(blocks) >= min_area]
+        shapes.append(blocks)
+        indices.append(np.full(len(blocks), -1))
+    shapes, indices = np.concatenate(shapes), np.concatenate(indices)
+    simplified = _simplify(executor, shapes, SIMPLIFY_MM * paper_mm, tile_features, coverage=True)
+    # Rings thinner than the tolerance can collapse into lines, keep the polygonal ones
+    keep = _polygonal(simplified)
+    return simplified[keep], indices[keep]
+
+
+def _generalize_lines(executor, geometries, sources, paper_mm, tile_features):
+    long_enough = shapely.length(geometries) >= MIN_LENGTH_MM * paper_mm
+    simplified = _simplify(executor, geometries[long_enough], SIMPLIFY_MM * paper_mm, tile_features)
+    return simplified, sources[long_enough]
+
+
+def generalize_geometries(executor, geometries, polygonal, scales=SCALES, tile_features=TILE_FEATURES):
+    """
+    {scale: (source rows, geometries)} for an array of metric geometries.
+
+    Rows index into geometries; aggregates of several small polygons have
+    row -1 and carry no attributes (aggregated = 1 in the output).
+    """
+    sources = np.arange(len(geometries))
+    generalize = _generalize_polygons if polygonal else _generalize_lines
+    result = {}
+    for scale in sorted(scales):
+        geometries, sources = generalize(executor, geometries, sources, scale / 1000, tile_features)
+        result[scale] = (sources, geometries)
+    return result
+
+
+class _Job:
+    """Generalization of one layer: read, generalize level by level, then one output layer per scale."""
+
+    def __init__(self, path, layer, output_path):
+        self.path = path
+        self.layer = layer or os.path.splitext(os.path.basename(path))[0]
+        self.output_path = output_path
+        self.gdf = None
+        self.crs = None
+        self.polygonal = None
+
+    def read(self):
+        gdf = gpd.read_file(self.path, layer=self.layer if self.path.lower().endswith(".gpkg") else None)
+        self.gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty].reset_index(drop=True)
+        if self.gdf.empty:
+            return
+        type_ids = shapely.get_type_id(shapely.get_parts(self.gdf.geometry.to_numpy()))
+        if not np.isin(type_ids, (POLYGON_TYPE_ID, LINE_TYPE_ID)).all():
+            raise ValueError(f"{self.path} ({self.layer}): only polygon and line layers are generalized")
+        self.polygonal = bool((type_ids == POLYGON_TYPE_ID).all())
+        self.crs = self.gdf.estimate_utm_crs()
+
+    def generalize(self, executor, scales, tile_features):
+        if self.gdf.empty:
+            return {}
+        metric = self.gdf.geometry.to_crs(self.crs).to_numpy()
+        return generalize_geometries(executor, metric, self.polygonal, scales, tile_features)
+
+    def write(self, levels, scales):
+        """Write one layer per scale; returns {level layer name: feature count}."""
+        counts = {}
+        attributes = self.gdf.drop(columns="geometry")
+        geometry_type = "MultiPolygon" if self.polygonal else "MultiLineString"
+        for scale in sorted(scales):
+            name = level_name(self.layer, scale)
+            if scale not in levels:
+                counts[name] = 0
+                continue
+            sources, geometries = levels[scale]
+            level = attributes.reindex(sources).reset_index(drop=True)
+            level["aggregated"] = (sources < 0).astype(int)
+            geometries = gpd.GeoSeries(geometries, crs=self.crs).to_crs(self.gdf.crs).to_numpy()
+            level = gpd.GeoDataFrame(level, geometry=geometries, crs=self.gdf.crs)
+            # Multi types throughout, so empty levels and mixed parts still make one typed layer
+            level.to_file(self.output_path, layer=name, driver="GPKG", geometry_type=geometry_type,
+                          promote_to_multi=True, layer_options={"DESCRIPTION": f"{self.layer} generalized for 1:{scale}"})
+            counts[name] = len(level)
+        return counts
+
+
+def output_path(path):
+    """Levels go into the GeoPackage of the original, or a <name>_generalized.gpkg next to other formats."""
+    root, extension = os.path.splitext(path)
+    return path if extension.lower() == ".gpkg" else f"{root}_generalized.gpkg"
+
+
+def generalize_files(sources, scales=SCALES, max_workers=None, tile_features=TILE_FEATURES):
+    """
+    Write the generalized levels of every (path, layer) source; layer None for single-layer formats.
+
+    All sources share one process pool, each layer is generalized and
+    written in turn. Returns {(path, layer): {level layer: count}}.
+    """
+    counts = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for path, layer in sources:
+            job = _Job(path, layer, output_path(path))
+            job.read()
+            counts[(job.path, job.layer)] = level_counts = job.write(job.generalize(executor, scales, tile_features), scales)
+            print(f"Generalized {os.path.basename(job.path)} ({job.layer}): "
+                  + ", ".join(f"{name} {count}" for name, count in level_counts.items()))
+    return counts
+
+
+def generalize_frames(paths, layers=("buildings", "water_bodies", "roads"), scales=SCALES, max_workers=None):
+    """Generalize the given layers of every frame GeoPackage (see writers.FrameWriters) that has them."""
+    sources = []
+    for path in paths:
+        present = {name for name, _ in pyogrio.list_layers(path)}
+        sources.extend((path, layer) for layer in layers if layer in present)
+    return generalize_files(sources, scales, max_workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("paths", nargs="+", help="frame GeoPackages")
+    parser.add_argument("--layers", nargs="+", default=["buildings", "water_bodies", "roads"])
+    parser.add_argument("--scales", nargs="+", type=int, default=list(SCALES))
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args(argv)
+    generalize_frames(args.paths, args.layers, args.scales, args.workers)
+
+
+if __name__ == "__main__":
+    main()
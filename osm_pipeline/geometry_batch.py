@@ -0,0 +1,77 @@
+"""Bulk polygon construction, repair and WKB encoding with the Shapely 2 array API."""
+from array import array
+
+import numpy as np
+import shapely
+
+POLYGON_TYPE_ID = 3
+
+
+class EncodedFeature:
+    """A feature whose geometry is already WKB, ready for GeoPackageLayer.write_wkb."""
+
+    __slots__ = ("wkb", "properties")
+
+    def __init__(self, wkb, properties):
+        self.wkb = wkb
+        self.properties = properties
+
+
+class PolygonBatch:
+    """
+    Collects simple polygons (closed ways) as flat coordinate and offset arrays.
+
+    encode() creates all polygons in one call, repairs the invalid ones with a
+    vectorized make_valid and encodes them straight to WKB, without going
+    through per-feature Shapely objects or GeoJSON dicts.
+    """
+
+    def __init__(self):
+        self.coords = array("d")
+        self.offsets = array("q", [0])
+        self.keys = []
+        self.properties = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, coords, properties):
+        """coords is a closed ring of at least 4 (lon, lat) pairs."""
+        for x, y in coords:
+            self.coords.append(x)
+            self.coords.append(y)
+        self.offsets.append(len(self.coords) // 2)
+        self.keys.append(key)
+        self.properties.append(properties)
+
+    def build(self):
+        """Valid geometries and a mask of the input polygons that survived repair."""
+        xy = np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 2)
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        ring_index = np.repeat(np.arange(len(self.keys)), np.diff(offsets))
+        polygons = shapely.polygons(shapely.linearrings(xy, indices=ring_index))
+
+        invalid = ~shapely.is_valid(polygons)
+        if invalid.any():
+            polygons[invalid] = shapely.make_valid(polygons[invalid])
+
+        # make_valid can return collections with lines or points, keep the polygonal parts
+        parts, part_index = shapely.get_parts(polygons, return_index=True)
+        polygonal = (shapely.get_type_id(parts) == POLYGON_TYPE_ID) & ~shapely.is_empty(parts)
+        parts, part_index = parts[polygonal], part_index[polygonal]
+
+        keep = np.zeros(len(self.keys), dtype=bool)
+        keep[part_index] = True
+        new_index = np.cumsum(keep) - 1
+        return parts, new_index[part_index], keep
+
+    def encode(self):
+        """Yield (key, EncodedFeature) for every polygon that survived repair, as MultiPolygons."""
+        if not self.keys:
+            return
+        parts, index, keep = self.build()
+        geometries = shapely.multipolygons(parts, indices=index)
+        wkbs = shapely.to_wkb(geometries, byte_order=1, output_dimension=2)
+        records = [(key, properties) for key, properties, kept in zip(self.keys, self.properties, keep) if kept]
+        for (key, properties), wkb in zip(records, wkbs):
+            yield key, EncodedFeature(wkb, properties)
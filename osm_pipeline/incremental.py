@@ -0,0 +1,250 @@
+"""
+Incremental refresh of the theme layers of a frame from OSM change timestamps.
+
+The first sync of a layer is a full fetch. Every later one asks Overpass
+only for the elements changed since the last sync (compiler.compile_themes
+with newer=) and lists the ids still in each theme to find the deleted ones
+(compiler.compile_theme_ids). Changed elements replace their features by
+OSM type and id, deleted ones are removed, the rest of the layer is left
+as it is.
+
+The sync state is kept in two tables of the frame's GeoPackage, next to the
+layers it describes: the Overpass data timestamp of the last sync of every
+layer, and the version and timestamp of every element written to it.
+"""
+import time
+
+from osm_pipeline.compiler import compile_theme_ids, compile_themes, output_mode
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.multitheme import OUTPUT_DIR, SHEET_PATH, drop_short, sheet_frames, theme_features
+from osm_pipeline.scheduler import run_concurrently
+from osm_pipeline.streaming import stream_query
+from osm_pipeline.themes import GEOMETRY_TYPES, THEMES, theme_matches
+from osm_pipeline.writers import GeoPackage, frame_output_path
+
+KEY_FIELDS = ("osm_type", "osm_id")
+
+
+def _utc_now():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+class SyncState:
+    """Last sync time and element versions of the layers of one GeoPackage, stored in the GeoPackage."""
+
+    def __init__(self, gpkg):
+        self.gpkg = gpkg
+        with gpkg.lock:
+            cursor = gpkg.connection
+            cursor.execute("CREATE TABLE IF NOT EXISTS osm_sync (layer TEXT PRIMARY KEY, synced_at TEXT NOT NULL)")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS osm_elements ("
+                "layer TEXT NOT NULL, osm_type TEXT NOT NULL, osm_id INTEGER NOT NULL, "
+                "version INTEGER, timestamp TEXT, PRIMARY KEY (layer, osm_type, osm_id)) WITHOUT ROWID"
+            )
+
+    def synced_at(self, layer):
+        """
+        Data timestamp of the last sync, or None if the layer needs a full one.
+
+        A layer rewritten since by a full fetch (multitheme.fetch_frame) has no
+        OSM id columns and is synced from scratch.
+        """
+        with self.gpkg.lock:
+            row = self.gpkg.connection.execute("SELECT synced_at FROM osm_sync WHERE layer = ?", (layer,)).fetchone()
+        if row is None:
+            return None
+        fields = self.gpkg.layer_fields(layer)
+        if fields is not None and not set(KEY_FIELDS) <= set(fields):
+            return None
+        return row[0]
+
+    def versions(self, layer):
+        """{(osm type, osm id): version} of every element in the layer."""
+        with self.gpkg.lock:
+            rows = self.gpkg.connection.execute(
+                "SELECT osm_type, osm_id, version FROM osm_elements WHERE layer = ?", (layer,)
+            ).fetchall()
+        return {(osm_type, osm_id): version for osm_type, osm_id, version in rows}
+
+    def save(self, layer, synced_at, written, deleted=(), reset=False):
+        """
+        Record a sync of layer in one transaction.
+
+        written maps (osm type, osm id) to (version, timestamp) for the elements
+        fetched, deleted lists the keys removed; reset forgets every element first.
+        """
+        with self.gpkg.lock:
+            cursor = self.gpkg.connection
+            cursor.execute("BEGIN")
+            if reset:
+                cursor.execute("DELETE FROM osm_elements WHERE layer = ?", (layer,))
+            cursor.executemany(
+                "DELETE FROM osm_elements WHERE layer = ? AND osm_type = ? AND osm_id = ?",
+                [(layer, *key) for key in deleted],
+            )
+            cursor.executemany(
+                "INSERT OR REPLACE INTO osm_elements VALUES (?, ?, ?, ?, ?)",
+                [(layer, *key, version, timestamp) for key, (version, timestamp) in written.items()],
+            )
+            cursor.execute("INSERT OR REPLACE INTO osm_sync VALUES (?, ?)", (layer, synced_at))
+            cursor.execute("COMMIT")
+
+
+def _matching(elements, names, themes):
+    """Yield (theme name, key, element, features) for every theme each (element, geometry) pair belongs to."""
+    return drop_short(_match(elements, names, themes), themes)
+
+
+def _match(elements, names, themes):
+    for element, geometry in elements:
+        tags = element.get("tags")
+        if not tags:
+            continue
+        key = (element["type"], element["id"])
+        for name in names:
+            theme = themes[name]
+            if not theme_matches(theme, element["type"], tags):
+                continue
+            features = []
+            for feature in theme_features(theme, element, geometry, tags):
+                properties = {"osm_type": key[0], "osm_id": key[1], **feature["properties"]}
+                features.append({**feature, "properties": properties})
+            yield name, key, element, features
+
+
+def theme_ids(bbox, names, themes=THEMES, max_retries=3, **query_options):
+    """
+    {theme name: {(osm type, osm id)}} of every element currently in the named themes.
+
+    query_options (url, limiter) go to streaming.stream_query; the answer is never cached.
+    """
+    ids = {name: set() for name in names}
+    current = None
+    query = compile_theme_ids(names, bbox, themes=themes)
+    options = dict(query_options, cache=False)
+    for element, _ in stream_query(query, bbox=bbox, max_retries=max_retries, inline=True, **options):
+        if element["type"] == "theme":
+            current = ids[element["tags"]["name"]]
+        else:
+            current.add((element["type"], element["id"]))
+    return ids
+
+
+def _full_sync(bbox, names, gpkg, state, themes, max_retries, query_options):
+    mode = output_mode(names, themes)
+    query = compile_themes(names, bbox, themes=themes, mode=mode, meta=True)
+    header = {}
+    started = _utc_now()
+    layers = {name: gpkg.layer(name, geometry_type=GEOMETRY_TYPES[themes[name]["geometry"]]) for name in names}
+    written = {name: {} for name in names}
+    try:
+        elements = stream_query(query, bbox=bbox, max_retries=max_retries, inline=mode != "body", header=header,
+                                **query_options)
+        for name, key, element, features in _matching(elements, names, themes):
+            for feature in features:
+                layers[name].write(feature)
+            if features:
+                written[name][key] = (element.get("version"), element.get("timestamp"))
+    finally:
+        for layer in layers.values():
+            layer.close()
+    synced_at = header.get("timestamp_osm_base") or started
+    for name in names:
+        state.save(name, synced_at, written[name], reset=True)
+    return {name: {"added": len(written[name]), "modified": 0, "deleted": 0} for name in names}
+
+
+def _delta_sync(bbox, names, gpkg, state, themes, synced_at, max_retries, query_options):
+    mode = output_mode(names, themes)
+    query = compile_themes(names, bbox, themes=themes, mode=mode, meta=True, newer=synced_at)
+    header = {}
+    started = _utc_now()
+    versions = {name: state.versions(name) for name in names}
+    # The delta is small, it is collected so old features can be deleted before the new ones go in
+    changed = {name: {} for name in names}
+    elements = stream_query(query, bbox=bbox, max_retries=max_retries, inline=mode != "body", header=header,
+                            **dict(query_options, cache=False))
+    for name, key, element, features in _matching(elements, names, themes):
+        version = element.get("version")
+        stored = versions[name].get(key)
+        if stored is not None and version is not None and version < stored:
+            continue  # answered by a mirror lagging behind the last sync
+        changed[name][key] = (version, element.get("timestamp"), features)
+    current = theme_ids(bbox, names, themes, max_retries, **query_options)
+
+    counts = {}
+    for name in names:
+        stored = versions[name]
+        deleted = set(stored) - current[name] - set(changed[name])
+        # Elements that no longer produce a feature (post-filter, geometry) are dropped like deleted ones
+        deleted |= {key for key, (_, _, features) in changed[name].items() if not features and key in stored}
+        written = {key: (version, timestamp) for key, (version, timestamp, features) in changed[name].items() if features}
+        if gpkg.layer_fields(name) is None:
+            layer = gpkg.layer(name, geometry_type=GEOMETRY_TYPES[themes[name]["geometry"]]) if written else None
+        else:
+            layer = gpkg.update_layer(name, KEY_FIELDS)
+            layer.delete(sorted(deleted | set(changed[name])))
+        if layer is not None:
+            with layer:
+                for _, _, features in changed[name].values():
+                    for feature in features:
+                        layer.write(feature)
+        state.save(name, header.get("timestamp_osm_base") or started, written, deleted)
+        counts[name] = {
+            "added": sum(1 for key in written if key not in stored),
+            "modified": sum(1 for key in written if key in stored),
+            "deleted": len(deleted),
+        }
+    return counts
+
+
+def refresh_frame(bbox, frame, names, gpkg, themes=THEMES, max_retries=3, **query_options):
+    """
+    Bring the named theme layers of a frame's GeoPackage up to date.
+
+    Layers never synced get a full fetch, the others one query for what
+    changed and one for the ids still there; query_options (url, cache,
+    limiter) go to every query, the last two are never cached. Returns
+    {theme: {"added", "modified", "deleted"}} element counts.
+    """
+    state = SyncState(gpkg)
+    groups = {}
+    for name in names:
+        groups.setdefault(state.synced_at(name), []).append(name)
+    counts = {}
+    with get_default_recorder().span("frame", frame, bbox=bbox, themes=names, incremental=True) as span:
+        for synced_at, group in groups.items():
+            if synced_at is None:
+                counts.update(_full_sync(bbox, group, gpkg, state, themes, max_retries, query_options))
+            else:
+                counts.update(_delta_sync(bbox, group, gpkg, state, themes, synced_at, max_retries, query_options))
+        for change in ("added", "modified", "deleted"):
+            span.add(change, sum(count[change] for count in counts.values()))
+    return counts
+
+
+def refresh_sheet(sheet_path, names, output_dir=OUTPUT_DIR, max_workers=2):
+    """Refresh every frame of a sheet layer, one GeoPackage per frame as written by multitheme.fetch_sheet."""
+    def refresh(frame):
+        name, bbox = frame
+        with GeoPackage(frame_output_path(name, None, "gpkg", output_dir)) as gpkg:
+            return refresh_frame(bbox, name, names, gpkg)
+
+    for (name, _), counts, error in run_concurrently(refresh, sheet_frames(sheet_path), max_workers=max_workers):
+        if error is not None:
+            print(f"Failed to refresh {name}: {error}")
+        else:
+            print(f"{name}: " + ", ".join(
+                f"{theme} +{count['added']} ~{count['modified']} -{count['deleted']}" for theme, count in counts.items()
+            ))
+
+
+def main(sheet_path=SHEET_PATH, names=("structures", "cycleways", "roads", "gastronomy", "transit")):
+    refresh_sheet(sheet_path, list(names))
+    get_default_recorder().print_summary()
+    print("Refresh complete.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Structured run metrics: one JSON line per frame, tile and query, and a summary table.
+
+Work is wrapped in spans (recorder.span("frame", name)), library code adds
+counters to the innermost span of its thread (recorder.add("retries")),
+and a closing span writes its record and passes its counters on to its
+parent. Stages (recorder.stage("parse")) only add their time to the
+enclosing span, unless profiling is switched on:
+
+    OSM_PIPELINE_METRICS=path.jsonl       where the records go, _cache/metrics/<start time>.jsonl by default
+    OSM_PIPELINE_PROFILE=cprofile         one cProfile per stage and span kind, dumped to _cache/profiles
+    OSM_PIPELINE_PROFILE=tracemalloc      traced peak memory of every span and stage
+    OSM_PIPELINE_PROFILE=cprofile,tracemalloc
+
+Every thread profiles its own spans and stages, only the innermost open
+block at a time: the time of a stage goes to stage-<name>, not to the span
+around it. The profiles of a label are merged across threads when dumped.
+From Python 3.12 cProfile runs on sys.monitoring, which takes one profiler
+per process: a block opened while another thread profiles goes
+unprofiled, and the profile that runs includes the other threads.
+"""
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_cache")
+DEFAULT_METRICS_DIR = os.path.join(ROOT_DIR, "metrics")
+DEFAULT_PROFILE_DIR = os.path.join(ROOT_DIR, "profiles")
+
+SUMMARY_COLUMNS = (
+    ("count", "n", "{:d}"),
+    ("seconds", "seconds", "{:.1f}"),
+    ("latency", "latency", "{:.1f}"),
+    ("bytes", "MiB in", "{:.1f}"),
+    ("elements", "elements", "{:d}"),
+    ("parse_seconds", "parse s", "{:.1f}"),
+    ("features", "features", "{:d}"),
+    ("features_per_second", "feat/s", "{:.0f}"),
+    ("retries", "retries", "{:d}"),
+    ("cache_hits", "cache hits", "{:d}"),
+    ("peak_bytes", "peak MiB", "{:.1f}"),
+)
+
+
+def _is_peak(counter):
+    # Peaks are kept at their maximum instead of summed when passed to the parent
+    return counter.endswith("peak_bytes")
+
+
+def _peak_rss():
+    """Peak resident size of the process in bytes, where the platform reports it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Span:
+    def __init__(self, recorder, kind, name, parent, fields):
+        self.recorder = recorder
+        self.kind = kind
+        self.name = name
+        self.parent = parent
+        self.fields = fields
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, counter, value=1):
+        with self._lock:
+            if _is_peak(counter):
+                self.counters[counter] = max(self.counters.get(counter, 0), value)
+            else:
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def merge(self, counters):
+        for counter, value in counters.items():
+            self.add(counter, value)
+
+
+class Recorder:
+    """
+    Writes span records as JSON lines and keeps the totals for summary().
+
+    path=None keeps the records in memory only (summary still works). The
+    profiling switches are what OSM_PIPELINE_PROFILE sets for the default recorder.
+    """
+
+    def __init__(self, path=None, cprofile=False, trace_memory=False, profile_dir=DEFAULT_PROFILE_DIR):
+        self.path = path
+        self.cprofile = cprofile
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.records = []
+        self._file = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = {}  # (label, thread id) -> cProfile.Profile
+        self._watches = []  # [start bytes, peak so far] of every open traced span and stage
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _profile_stack(self):
+        """Profiles of the blocks open in this thread, None for those left unprofiled."""
+        if not hasattr(self._local, "profiles"):
+            self._local.profiles = []
+        return self._local.profiles
+
+    def current(self):
+        """The innermost open span of this thread, or None."""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def add(self, counter, value=1):
+        """Add to a counter of the innermost open span of this thread; a no-op outside spans."""
+        span = self.current()
+        if span is not None:
+            span.add(counter, value)
+
+    def _watch_start(self):
+        """Start a traced peak; the peaks of the blocks already open are folded in before the reset."""
+        with self._lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            for watch in self._watches:
+                watch[1] = max(watch[1], peak)
+            tracemalloc.reset_peak()
+            watch = [tracemalloc.get_traced_memory()[0], 0]
+            self._watches.append(watch)
+        return watch
+
+    def _watch_stop(self, watch):
+        """Traced peak above the starting allocation, process-wide (parallel blocks share it)."""
+        with self._lock:
+            self._watches.remove(watch)
+            peak = max(watch[1], tracemalloc.get_traced_memory()[1])
+        return max(0, peak - watch[0])
+
+    @contextmanager
+    def _profiled(self, label):
+        """cProfile a block into this thread's profile of label, the enclosing block's profile paused meanwhile."""
+        if not self.cprofile:
+            yield
+            return
+        with self._lock:
+            profile = self._profiles.setdefault((label, threading.get_ident()), cProfile.Profile())
+        stack = self._profile_stack()
+        outer = stack[-1] if stack else None
+        if outer is not None:
+            outer.disable()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler (not ours, or another thread's from 3.12) is active
+            profile = None
+        stack.append(profile)
+        try:
+            yield
+        finally:
+            stack.pop()
+            if profile is not None:
+                profile.disable()
+            if outer is not None:
+                try:
+                    outer.enable()
+                except ValueError:
+                    pass
+
+    @contextmanager
+    def span(self, kind, name=None, parent=None, **fields):
+        """
+        Measure a unit of work ("frame", "tile", "query"...) and write its record when it closes.
+
+        parent defaults to the innermost span of this thread; pass it explicitly
+        for spans opened in worker threads so their counters reach the caller.
+        """
+        stack = self._stack()
+        parent = parent if parent is not None else (stack[-1] if stack else None)
+        span = Span(self, kind, name, parent, fields)
+        stack.append(span)
+        start = time.perf_counter()
+        watch = self._watch_start() if self.trace_memory else None
+        try:
+            with self._profiled(kind):
+                yield span
+        except BaseException as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            stack.remove(span)
+            seconds = time.perf_counter() - start
+            if watch is not None:
+                span.add("peak_bytes", self._watch_stop(watch))
+            self._close(span, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage of the enclosing span into its "<name>_seconds" counter, profiled when switched on."""
+        start = time.perf_counter()
+        watch = self._watch_start() if self.trace_memory else None
+        try:
+            with self._profiled(f"stage-{name}"):
+                yield
+        finally:
+            self.add(f"{name}_seconds", time.perf_counter() - start)
+            if watch is not None:
+                self.add(f"{name}_peak_bytes", self._watch_stop(watch))
+
+    def _close(self, span, seconds):
+        record = {
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "kind": span.kind,
+            "name": span.name,
+            "seconds": round(seconds, 4),
+            **span.fields,
+            **{counter: round(value, 4) if isinstance(value, float) else value for counter, value in span.counters.items()},
+        }
+        if span.counters.get("features"):
+            record["features_per_second"] = round(span.counters["features"] / seconds, 1) if seconds else None
+        rss = _peak_rss()
+        if rss is not None:
+            record["peak_rss"] = rss
+        self.write(record)
+        if span.parent is not None:
+            span.parent.merge(span.counters)
+
+    def record(self, kind, **fields):
+        """Write a one-off event record ("retry", "split"...)."""
+        self.write({"time": datetime.now().isoformat(timespec="milliseconds"), "kind": kind, **fields})
+
+    def write(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self.path is None:
+                return
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record, default=str) + "\n")
+            self._file.flush()
+
+    def summary(self):
+        """Totals per record kind, spans only: {kind: {column: value}}."""
+        totals = {}
+        for record in self.records:
+            if "seconds" not in record:
+                continue
+            row = totals.setdefault(record["kind"], {"count": 0})
+            row["count"] += 1
+            for column, _, _ in SUMMARY_COLUMNS[1:]:
+                value = record.get(column)
+                if not isinstance(value, (int, float)) or column == "features_per_second":
+                    continue
+                if _is_peak(column):
+                    row[column] = max(row.get(column, 0), value)
+                else:
+                    row[column] = row.get(column, 0) + value
+        for row in totals.values():
+            if row.get("features") and row.get("seconds"):
+                row["features_per_second"] = row["features"] / row["seconds"]
+        return totals
+
+    def print_summary(self):
+        totals = self.summary()
+        if not totals:
+            return
+        print(f"{'kind':10}" + "".join(f"{header:>11}" for _, header, _ in SUMMARY_COLUMNS))
+        for kind, row in totals.items():
+            cells = []
+            for column, _, fmt in SUMMARY_COLUMNS:
+                value = row.get(column)
+                if value is None:
+                    cells.append("")
+                    continue
+                if column in ("bytes", "peak_bytes"):
+                    value = value / 2 ** 20
+                cells.append(fmt.format(int(value) if fmt == "{:d}" else value))
+            print(f"{kind:10}" + "".join(f"{cell:>11}" for cell in cells))
+        if self.path is not None:
+            print(f"Metrics written to {self.path}")
+        for path in self.dump_profiles():
+            print(f"Profile written to {path}")
+
+    def dump_profiles(self):
+        """Write one .prof per stage and span kind, the threads' profiles merged; returns the paths."""
+        with self._lock:
+            profiles = dict(self._profiles)
+        merged = {}
+        for (label, _), profile in profiles.items():
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:  # never enabled long enough to collect anything
+                continue
+            if label in merged:
+                merged[label].add(stats)
+            else:
+                merged[label] = stats
+        paths = []
+        for label, stats in merged.items():
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"{label}.prof")
+            stats.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_default_recorder = None
+_default_recorder_lock = threading.Lock()
+
+
+def get_default_recorder():
+    """Return the process-wide recorder, configured from OSM_PIPELINE_METRICS and OSM_PIPELINE_PROFILE."""
+    global _default_recorder
+    with _default_recorder_lock:
+        if _default_recorder is None:
+            path = os.environ.get("OSM_PIPELINE_METRICS") or os.path.join(
+                DEFAULT_METRICS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl")
+            switches = {switch.strip().lower() for switch in os.environ.get("OSM_PIPELINE_PROFILE", "").split(",")}
+            _default_recorder = Recorder(path, cprofile="cprofile" in switches, trace_memory="tracemalloc" in switches)
+        return _default_recorder
+
+
+def set_default_recorder(recorder):
+    """Make recorder the process-wide one (None: configure a new one on next use); returns the previous one."""
+    global _default_recorder
+    with _default_recorder_lock:
+        previous, _default_recorder = _default_recorder, recorder
+        return previous
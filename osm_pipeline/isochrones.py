@@ -0,0 +1,306 @@
+"""
+Isochrones for transit stops, journaled so an interrupted run resumes exactly.
+
+Every finished stop is appended to a SQLite journal keyed by stop id; the
+final layer is exported once at the end instead of being rewritten after
+each stop. Stops of one railway type a few metres apart are coalesced into a
+single request, and answers are kept in a persistent cache keyed by rounded
+coordinate and time limit.
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import geopandas as gpd
+import numpy as np
+import requests
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist
+from shapely.geometry import shape
+
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.scheduler import run_concurrently
+
+GRAPHHOPPER_URL = "https://graphhopper.com/api/1/isochrone"
+RATE_LIMIT_RESERVE = 150  # credits left untouched, as the old script stopped at 150
+COALESCE_RADIUS = 50  # metres, platforms of one stop are usually closer than this
+METRES_PER_DEGREE = 111320
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_cache", "isochrones.sqlite")
+
+
+def get_time_limit(railway):
+    if railway == 'tram':
+        return 480  # 8 minutes in seconds
+    elif railway in ['subway', 'light_rail', 'monorail']:
+        return 720  # 12 minutes in seconds
+    elif railway == 'train':
+        return 900  # 15 minutes in seconds
+    else:
+        return 480  # default time
+
+
+class IsochroneJournal:
+    """Append-only SQLite journal of fetched isochrones, one row per stop id."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS isochrones ("
+            "stop_id INTEGER PRIMARY KEY, railway TEXT, time_limit INTEGER, "
+            "polygons TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def done(self):
+        return {row[0] for row in self.conn.execute("SELECT stop_id FROM isochrones")}
+
+    def record(self, stop_id, railway, time_limit, polygons):
+        """polygons is the list of GeoJSON geometries returned for the stop."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO isochrones VALUES (?, ?, ?, ?, ?)",
+                (int(stop_id), railway, time_limit, json.dumps(polygons), time.time()),
+            )
+
+    def rows(self):
+        """{'geometry', 'railway', 'id'} records, one per polygon."""
+        for stop_id, railway, polygons in self.conn.execute(
+            "SELECT stop_id, railway, polygons FROM isochrones ORDER BY stop_id"
+        ):
+            for geometry in json.loads(polygons):
+                yield {'geometry': shape(geometry), 'railway': railway, 'id': stop_id}
+
+    def export(self, path):
+        """Write the whole journal to a vector file once (format from the extension)."""
+        rows = list(self.rows())
+        if not rows:
+            return 0
+        gpd.GeoDataFrame(rows, geometry='geometry', crs="EPSG:4326").to_file(path)
+        return len(rows)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class IsochroneCache:
+    """
+    Isochrones by (rounded latitude, rounded longitude, time limit), shared by every run and frame.
+
+    Requests are sent for the rounded coordinate, so a cached answer is exactly
+    what the API would return again. 4 decimals is about 10 m.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, decimals=4):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.decimals = decimals
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS isochrones (key TEXT PRIMARY KEY, polygons TEXT NOT NULL)")
+        self.conn.commit()
+
+    def point(self, latitude, longitude):
+        return round(float(latitude), self.decimals), round(float(longitude), self.decimals)
+
+    def key(self, latitude, longitude, time_limit):
+        latitude, longitude = self.point(latitude, longitude)
+        return f"{latitude:.{self.decimals}f},{longitude:.{self.decimals}f},{time_limit}"
+
+    def get(self, key):
+        row = self.conn.execute("SELECT polygons FROM isochrones WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, polygons):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO isochrones VALUES (?, ?)", (key, json.dumps(polygons)))
+
+    def close(self):
+        self.conn.close()
+
+
+def cluster_labels(longitude, latitude, radius):
+    """
+    Cluster label per point: no two points of a cluster are more than radius metres apart.
+
+    Coordinates go on a local equirectangular plane. Close pairs come from a
+    KD-tree and their connected components bound the clusters; a component
+    chained wider than radius (stops along a street) is cut by complete
+    linkage with radius as the cutoff, so its pairwise distances stay small.
+    """
+    n = len(longitude)
+    if n == 0 or radius <= 0:
+        return np.arange(n)
+    scale = math.cos(math.radians(float(np.mean(latitude))))
+    xy = np.column_stack((np.asarray(longitude) * scale, np.asarray(latitude))) * METRES_PER_DEGREE
+    pairs = cKDTree(xy).query_pairs(radius, output_type="ndarray")
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    components = connected_components(graph, directed=False)[1]
+    labels = components.copy()
+    next_label = components.max() + 1
+    sizes = np.bincount(components)
+    for component in np.flatnonzero(sizes > 2):
+        members = np.flatnonzero(components == component)
+        sub = fcluster(linkage(pdist(xy[members]), method="complete"), radius, criterion="distance")
+        labels[members[sub > 1]] = next_label + sub[sub > 1] - 2
+        next_label += sub.max() - 1
+    return labels
+
+
+def coalesce_stops(stops, radius=COALESCE_RADIUS):
+    """
+    One request per cluster of stops of the same railway type within radius metres.
+
+    Returns dicts with the cluster centroid (latitude, longitude), railway
+    and the member stop ids.
+    """
+    clusters = []
+    for railway, group in stops.groupby('railway', sort=False):
+        labels = cluster_labels(group['longitude'].to_numpy(float), group['latitude'].to_numpy(float), radius)
+        for label in np.unique(labels):
+            members = group[labels == label]
+            clusters.append({
+                'latitude': float(members['latitude'].mean()),
+                'longitude': float(members['longitude'].mean()),
+                'railway': railway,
+                'ids': [int(stop_id) for stop_id in members['id']],
+            })
+    return clusters
+
+
+class RateLimitPacer:
+    """
+    Spaces requests so the remaining credits last until the limit window resets.
+
+    Fed from the X-RateLimit-Remaining / X-RateLimit-Reset response headers;
+    once only the reserve is left it reports exhausted and nothing more is sent.
+    """
+
+    def __init__(self, reserve=RATE_LIMIT_RESERVE, min_interval=1.0):
+        self.reserve = reserve
+        self.min_interval = min_interval
+        self.interval = min_interval
+        self.remaining = None
+        self.exhausted = False
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until this caller's request slot; False if the credits ran out."""
+        with self._lock:
+            if self.exhausted:
+                return False
+            now = time.monotonic()
+            start = max(now, self._next_at)
+            self._next_at = start + self.interval
+        time.sleep(start - now)
+        return not self.exhausted
+
+    def update(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return
+        with self._lock:
+            self.remaining = int(remaining)
+            spare = self.remaining - self.reserve
+            if spare <= 0:
+                self.exhausted = True
+                return
+            reset = headers.get('X-RateLimit-Reset')
+            if reset is not None:
+                self.interval = max(self.min_interval, float(reset) / spare)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+
+class RateLimitExhausted(Exception):
+    pass
+
+
+def get_isochrone_data(api_key, latitude, longitude, railway_type, url=GRAPHHOPPER_URL, timeout=60):
+    time_limit = get_time_limit(railway_type)
+    params = {'point': f"{latitude},{longitude}", 'time_limit': time_limit, 'vehicle': 'foot', 'key': api_key}
+    return requests.get(url, params=params, timeout=timeout)
+
+
+def fetch_isochrones(stops, journal, api_key, url=GRAPHHOPPER_URL, max_workers=2, pacer=None, error_pause=60,
+                     radius=COALESCE_RADIUS, cache=None):
+    """
+    Fetch isochrones for every stop not yet in the journal.
+
+    stops needs id, latitude, longitude and railway columns. Nearby stops are
+    coalesced (see coalesce_stops) and answered from the cache when possible;
+    the rest is requested in a bounded thread pool paced by the rate limit
+    headers. Each answer is fanned out to the member stops and journaled from
+    this thread as it arrives. Returns the number of stops journaled in this run.
+    """
+    pacer = pacer if pacer is not None else RateLimitPacer()
+    cache = cache if cache is not None else IsochroneCache()
+    done = journal.done()
+    pending = stops[~stops['id'].astype(int).isin(done)]
+    clusters = coalesce_stops(pending, radius)
+    print(f"{len(done)} stops already journaled, {len(pending)} to fetch in {len(clusters)} requests")
+
+    def record(cluster, polygons):
+        time_limit = get_time_limit(cluster['railway'])
+        for stop_id in cluster['ids']:
+            journal.record(stop_id, cluster['railway'], time_limit, polygons)
+        return len(cluster['ids'])
+
+    fetched = 0
+    requested = []
+    for cluster in clusters:
+        cluster['key'] = cache.key(cluster['latitude'], cluster['longitude'], get_time_limit(cluster['railway']))
+        polygons = cache.get(cluster['key'])
+        if polygons is None:
+            requested.append(cluster)
+        else:
+            fetched += record(cluster, polygons)
+    if fetched:
+        print(f"{fetched} stops answered from the isochrone cache")
+
+    def fetch(cluster):
+        if not pacer.wait():
+            raise RateLimitExhausted()
+        latitude, longitude = cache.point(cluster['latitude'], cluster['longitude'])
+        with get_default_recorder().span("query", f"{latitude},{longitude}", api="graphhopper") as span:
+            start = time.perf_counter()
+            response = get_isochrone_data(api_key, latitude, longitude, cluster['railway'], url)
+            span.add("latency", time.perf_counter() - start)
+            span.add("bytes", len(response.content))
+            span.set(status=response.status_code)
+        pacer.update(response.headers)
+        if response.status_code == 429:
+            pacer.pause(error_pause)
+        return response
+
+    for cluster, response, error in run_concurrently(fetch, requested, max_workers=max_workers):
+        if isinstance(error, RateLimitExhausted):
+            continue
+        if error is not None:
+            print(f"Error with stop at {cluster['latitude']}, {cluster['longitude']}: {error!r}")
+            continue
+        if response.status_code != 200:
+            print(f"Error with stop at {cluster['latitude']}, {cluster['longitude']}: {response.text}")
+            continue
+        polygons = [polygon['geometry'] for polygon in response.json()['polygons']]
+        cache.put(cluster['key'], polygons)
+        fetched += record(cluster, polygons)
+        print(f"Processed stops with IDs: {cluster['ids']}, rate limit remaining: {pacer.remaining}")
+
+    if pacer.exhausted:
+        print("Approaching rate limit, stopped requests. Run again after the limit resets to continue.")
+    return fetched
@@ -0,0 +1,82 @@
+"""
+Line lengths in metres for many ways at once.
+
+Lines are flattened into one coordinate array plus offsets (line i is
+xy[offsets[i]:offsets[i + 1]]), so a length filter over a whole frame is a
+handful of NumPy operations instead of one geodesic() call per segment.
+Haversine is the default; ellipsoidal=True uses the WGS84 ellipsoid through
+pyproj, which matches geopy's geodesic to the millimetre.
+"""
+import numpy as np
+
+try:
+    from pyproj import Geod
+except ImportError:  # pyproj ships with QGIS and geopandas, but keep haversine usable without it
+    Geod = None
+
+EARTH_RADIUS = 6371008.8  # mean radius in metres
+
+_geod = None
+
+
+def _wgs84():
+    global _geod
+    if Geod is None:
+        raise ImportError("ellipsoidal lengths need pyproj")
+    if _geod is None:
+        _geod = Geod(ellps="WGS84")
+    return _geod
+
+
+def flatten(lines):
+    """(xy, offsets) for a sequence of [(lon, lat), ...] coordinate lists."""
+    counts = np.fromiter((len(line) for line in lines), dtype=np.int64, count=len(lines))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    xy = np.empty((offsets[-1], 2), dtype=np.float64)
+    for line, start, end in zip(lines, offsets[:-1], offsets[1:]):
+        if end > start:
+            xy[start:end] = line
+    return xy, offsets
+
+
+def haversine_segments(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def geodesic_segments(lon1, lat1, lon2, lat2):
+    return _wgs84().inv(lon1, lat1, lon2, lat2)[2]
+
+
+def lengths_from_offsets(xy, offsets, ellipsoidal=False):
+    """Length of every line, with segments crossing a line boundary left out."""
+    n = len(offsets) - 1
+    if len(xy) < 2:
+        return np.zeros(n)
+    line_index = np.repeat(np.arange(n), np.diff(offsets))
+    inside = line_index[:-1] == line_index[1:]
+    start, end = xy[:-1][inside], xy[1:][inside]
+    segments = geodesic_segments if ellipsoidal else haversine_segments
+    distances = segments(start[:, 0], start[:, 1], end[:, 0], end[:, 1])
+    return np.bincount(line_index[:-1][inside], weights=distances, minlength=n)
+
+
+def line_lengths(lines, ellipsoidal=False):
+    """Length in metres of every [(lon, lat), ...] line."""
+    xy, offsets = flatten(lines)
+    return lengths_from_offsets(xy, offsets, ellipsoidal)
+
+
+def min_length_mask(lines, min_length, ellipsoidal=False):
+    """Boolean mask of the lines at least min_length metres long."""
+    return line_lengths(lines, ellipsoidal) >= min_length
+
+
+def line_length(coords, ellipsoidal=True):
+    """Length of a single line, for callers that see one way at a time."""
+    if ellipsoidal:
+        xy = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        return _wgs84().line_length(xy[:, 0], xy[:, 1])
+    return float(line_lengths([coords])[0])
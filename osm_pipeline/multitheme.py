@@ -0,0 +1,208 @@
+"""
+Fetch several themes of a frame with one Overpass request.
+
+The themes are compiled into a single query (compiler.compile_themes), the
+response is streamed once and every element is routed to the themes whose
+filters it matches, which the layers of one GeoPackage per frame receive.
+Themes that need no polygon rings are printed with inline coordinates
+(compiler.output_mode), which skips the recursed node table entirely.
+"""
+import os
+
+import numpy as np
+from shapely.geometry import LineString, MultiPoint, Point, Polygon, mapping
+
+from osm_pipeline.compiler import compile_themes, output_mode
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.lengths import flatten, lengths_from_offsets
+from osm_pipeline.rings import assemble_multipolygon
+from osm_pipeline.scheduler import run_concurrently
+from osm_pipeline.sheets import read_sheet
+from osm_pipeline.streaming import stream_query
+from osm_pipeline.themes import GEOMETRY_TYPES, THEMES, theme_matches, theme_properties
+from osm_pipeline.writers import FrameWriters
+
+GIT_DIR = r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git"
+SHEET_PATH = os.path.join(GIT_DIR, "_Ogolne", "Arkusze_Miasta.shp")
+OUTPUT_DIR = os.path.join(GIT_DIR, "_Ogolne", "themes_output")
+LENGTH_BATCH = 5000  # elements whose lines are measured together for a theme's min_length
+
+
+def theme_geometries(kind, element, geometry):
+    """Shapely geometries of one streamed element (see streaming.iter_resolved/iter_inline) for a theme geometry kind."""
+    if geometry is None:
+        return []
+    if isinstance(geometry, tuple):
+        # A node or the center of a way or relation
+        return [Point(geometry)] if kind == "point" else []
+    element_type = element["type"]
+    if element_type == "way":
+        if kind == "line" and len(geometry) >= 2:
+            return [LineString(geometry)]
+        if kind == "point" and len(geometry) >= 4:
+            return [Polygon(geometry).centroid]
+        if kind == "polygon" and len(geometry) >= 4:
+            polygon = Polygon(geometry)
+            return [polygon if polygon.is_valid else polygon.buffer(0)]
+        return []
+
+    members = [(role, coords, refs) for role, coords, refs in geometry if len(coords) >= 2]
+    if kind == "polygon":
+        polygon, broken = assemble_multipolygon(members)
+        if broken:
+            print(f"Relation {element['id']}: {len(broken)} broken ring(s)")
+        return [polygon] if polygon is not None else []
+    if kind == "member_lines":
+        return [LineString(coords) for _, coords, _ in members]
+    if kind == "line" and members:
+        # Like the single-theme fetchers, a relation is drawn with its first member way
+        return [LineString(members[0][1])]
+    if kind == "point":
+        points = [point for _, coords, _ in members for point in coords]
+        return [MultiPoint(points).centroid] if len(points) >= 3 else []
+    return []
+
+
+def theme_features(theme, element, geometry, tags):
+    """
+    GeoJSON features of an element matching theme; empty if the post-filter or the geometry drops it.
+
+    The theme's min_length is left to drop_short, which measures many lines at once.
+    """
+    properties = theme_properties(theme, tags)
+    if properties is None:
+        return []
+    features = []
+    for shape in theme_geometries(theme["geometry"], element, geometry):
+        if shape.is_empty:
+            continue
+        features.append({"type": "Feature", "geometry": mapping(shape), "properties": properties})
+    return features
+
+
+def _measured(batch, themes):
+    lines = [feature["geometry"]["coordinates"] for item in batch for feature in item[-1]]
+    xy, offsets = flatten(lines)
+    lengths = lengths_from_offsets(xy, offsets, ellipsoidal=True)
+    min_lengths = np.repeat([themes[item[0]]["min_length"] for item in batch], [len(item[-1]) for item in batch])
+    keep = lengths >= min_lengths
+    position = 0
+    for item in batch:
+        features = item[-1]
+        kept = [feature for feature, long_enough in zip(features, keep[position:position + len(features)]) if long_enough]
+        position += len(features)
+        yield (*item[:-1], kept)
+
+
+def drop_short(items, themes=THEMES, batch_size=LENGTH_BATCH):
+    """
+    Pass on (theme name, ..., features) items without the line features under their theme's min_length.
+
+    The lines are measured batch_size items at a time in one array
+    operation; items of themes without min_length pass straight through.
+    """
+    batch = []
+    for item in items:
+        if themes[item[0]].get("min_length") is None:
+            yield item
+            continue
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield from _measured(batch, themes)
+            batch = []
+    if batch:
+        yield from _measured(batch, themes)
+
+
+def match_themes(elements, names, themes=THEMES):
+    """Yield (theme name, element, features) for every theme each (element, geometry) pair belongs to."""
+    return drop_short(_match_themes(elements, names, themes), themes)
+
+
+def _match_themes(elements, names, themes):
+    for element, geometry in elements:
+        tags = element.get("tags")
+        if not tags:
+            continue
+        for name in names:
+            theme = themes[name]
+            if theme_matches(theme, element["type"], tags):
+                with get_default_recorder().stage("assemble"):
+                    features = theme_features(theme, element, geometry, tags)
+                yield name, element, features
+
+
+def split_themes(elements, names, themes=THEMES):
+    """Yield (theme name, feature) for every theme each (element, geometry) pair belongs to."""
+    for name, _, features in match_themes(elements, names, themes):
+        for feature in features:
+            yield name, feature
+
+
+def fetch_frame(bbox, frame, names, writers, themes=THEMES, max_retries=3, mode=None):
+    """
+    Fetch every theme of one frame in a single request; returns feature counts per theme.
+
+    mode defaults to the cheapest output mode the themes allow.
+    """
+    mode = mode if mode is not None else output_mode(names, themes)
+    query = compile_themes(names, bbox, themes=themes, mode=mode)
+    counts = dict.fromkeys(names, 0)
+    with get_default_recorder().span("frame", frame, bbox=bbox, themes=names, mode=mode) as span:
+        elements = stream_query(query, bbox=bbox, max_retries=max_retries, inline=mode != "body")
+        for name, feature in split_themes(elements, names, themes):
+            writers.get(frame, name, geometry_type=GEOMETRY_TYPES[themes[name]["geometry"]]).write(feature)
+            counts[name] += 1
+        span.add("features", sum(counts.values()))
+    return counts
+
+
+def fetch_tags(bbox, names, themes=THEMES, max_retries=3):
+    """
+    Attribute-only lookup: yield (theme name, element type, id, properties) without any geometry.
+
+    Printed with "out tags", the cheapest form Overpass has.
+    """
+    query = compile_themes(names, bbox, themes=themes, mode="tags")
+    for element, _ in stream_query(query, bbox=bbox, max_retries=max_retries, inline=True):
+        tags = element.get("tags")
+        if not tags:
+            continue
+        for name in names:
+            theme = themes[name]
+            if not theme_matches(theme, element["type"], tags):
+                continue
+            properties = theme_properties(theme, tags)
+            if properties is not None:
+                yield name, element["type"], element["id"], properties
+
+
+def sheet_frames(sheet_path):
+    """(name, bbox) of every frame of a sheet layer, bbox in WGS 84."""
+    return [(name, geometry.bounds) for name, geometry in read_sheet(sheet_path)]
+
+
+def fetch_sheet(sheet_path, names, output_format="gpkg", output_dir=OUTPUT_DIR, max_workers=2):
+    """Every frame of a sheet layer, one request and one GeoPackage per frame."""
+    frames = sheet_frames(sheet_path)
+
+    with FrameWriters(output_format, output_dir) as writers:
+        def fetch(frame):
+            name, bbox = frame
+            return fetch_frame(bbox, name, names, writers)
+
+        for (name, _), counts, error in run_concurrently(fetch, frames, max_workers=max_workers):
+            if error is not None:
+                print(f"Failed to fetch {name}: {error}")
+            else:
+                print(f"{name}: " + ", ".join(f"{theme} {count}" for theme, count in counts.items()))
+
+
+def main(sheet_path=SHEET_PATH, names=("structures", "cycleways", "roads", "gastronomy", "transit")):
+    fetch_sheet(sheet_path, list(names))
+    get_default_recorder().print_summary()
+    print("Data fetching complete.")
+
+
+if __name__ == "__main__":
+    main()
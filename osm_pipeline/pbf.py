@@ -0,0 +1,258 @@
+"""
+Offline backend: route every element of a local .osm.pbf extract to the
+matching themes of every frame in a single pass.
+
+Needs pyosmium (pip install osmium). Produces the same layers as the
+Overpass fetchers, written with FrameWriters.
+
+One extract is worked on by several processes: its frames are split into
+groups of neighbours, and each process routes the whole file to its own
+group. Every frame is still written by one process only, and nodes outside
+a group's bounds are dropped before their tags are read.
+"""
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import osmium
+import shapely
+from shapely.geometry import LineString, MultiPoint, Point, Polygon, box, mapping
+
+from osm_pipeline.frames import load_frames
+from osm_pipeline.lengths import lengths_from_offsets
+from osm_pipeline.themes import GEOMETRY_TYPES, THEMES, theme_matches, theme_properties
+from osm_pipeline.writers import FrameWriters
+
+GIT_DIR = r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git"
+PBF_DIR = os.path.join(GIT_DIR, "_Ogolne", "pbf")
+OUTPUT_DIR = os.path.join(GIT_DIR, "_Ogolne", "pbf_output")
+LENGTH_BATCH = 5000  # lines of min_length themes measured together
+
+
+def _tags(obj):
+    return {tag.k: tag.v for tag in obj.tags}
+
+
+def _way_coords(way):
+    return [(node.lon, node.lat) for node in way.nodes if node.location.valid()]
+
+
+class _MemberWays(osmium.SimpleHandler):
+    """Pre-pass over relations only: which ways do non-polygon relation themes need."""
+
+    def __init__(self, themes):
+        super().__init__()
+        self.themes = {name: theme for name, theme in themes.items() if theme["geometry"] != "polygon"}
+        self.way_ids = set()
+
+    def relation(self, relation):
+        tags = _tags(relation)
+        if any(theme_matches(theme, "relation", tags) for theme in self.themes.values()):
+            self.way_ids.update(member.ref for member in relation.members if member.type == "w")
+
+
+class ThemeRouter(osmium.SimpleHandler):
+    def __init__(self, frames, themes, writers, member_way_ids):
+        super().__init__()
+        self.frame_names = [name for name, _ in frames]
+        self.frame_tree = shapely.STRtree([geometry for _, geometry in frames])
+        self.bounds = shapely.total_bounds([geometry for _, geometry in frames])
+        self.themes = themes
+        self.writers = writers
+        self.member_way_ids = member_way_ids
+        self.member_ways = {}
+        self.wkb = osmium.geom.WKBFactory()
+        self.lines = []  # (theme name, theme, geometry, properties) waiting for flush_lines
+
+    def _matching(self, element_type, tags, geometries):
+        if not tags:
+            return []
+        return [
+            (name, theme) for name, theme in self.themes.items()
+            if theme["geometry"] in geometries and theme_matches(theme, element_type, tags)
+        ]
+
+    def _emit(self, theme_name, theme, tags, geometry):
+        if geometry is None or geometry.is_empty:
+            return
+        properties = theme_properties(theme, tags)
+        if properties is None:
+            return
+        if theme.get("min_length") is not None:
+            self.lines.append((theme_name, theme, geometry, properties))
+            if len(self.lines) >= LENGTH_BATCH:
+                self.flush_lines()
+            return
+        self._write(theme_name, theme, geometry, properties)
+
+    def _write(self, theme_name, theme, geometry, properties):
+        feature = {"type": "Feature", "geometry": mapping(geometry), "properties": properties}
+        for index in self.frame_tree.query(geometry, predicate="intersects"):
+            writer = self.writers.get(self.frame_names[index], theme_name, geometry_type=GEOMETRY_TYPES[theme["geometry"]])
+            writer.write(feature)
+
+    def flush_lines(self):
+        """Write the waiting lines that reach their theme's min_length, all measured in one array operation."""
+        if not self.lines:
+            return
+        geometries = [geometry for _, _, geometry, _ in self.lines]
+        offsets = np.zeros(len(geometries) + 1, dtype=np.int64)
+        np.cumsum(shapely.get_num_coordinates(geometries), out=offsets[1:])
+        lengths = lengths_from_offsets(shapely.get_coordinates(geometries), offsets, ellipsoidal=True)
+        min_lengths = np.array([theme["min_length"] for _, theme, _, _ in self.lines], dtype=np.float64)
+        for line, keep in zip(self.lines, lengths >= min_lengths):
+            if keep:
+                self._write(*line)
+        self.lines = []
+
+    def node(self, node):
+        if not node.tags:
+            return
+        min_lon, min_lat, max_lon, max_lat = self.bounds
+        if not (min_lon <= node.location.lon <= max_lon and min_lat <= node.location.lat <= max_lat):
+            return
+        tags = _tags(node)
+        for name, theme in self._matching("node", tags, ("point",)):
+            self._emit(name, theme, tags, Point(node.location.lon, node.location.lat))
+
+    def way(self, way):
+        if way.id in self.member_way_ids:
+            self.member_ways[way.id] = _way_coords(way)
+        tags = _tags(way)
+        matching = self._matching("way", tags, ("point", "line"))
+        if not matching:
+            return
+        coords = _way_coords(way)
+        for name, theme in matching:
+            if theme["geometry"] == "line":
+                geometry = LineString(coords) if len(coords) >= 2 else None
+            else:
+                geometry = Polygon(coords).centroid if len(coords) >= 4 else None
+            self._emit(name, theme, tags, geometry)
+
+    def relation(self, relation):
+        tags = _tags(relation)
+        matching = self._matching("relation", tags, ("point", "line", "member_lines"))
+        if not matching:
+            return
+        members = [self.member_ways.get(m.ref) for m in relation.members if m.type == "w"]
+        members = [coords for coords in members if coords and len(coords) >= 2]
+        for name, theme in matching:
+            if theme["geometry"] == "member_lines":
+                for coords in members:
+                    self._emit(name, theme, tags, LineString(coords))
+            elif theme["geometry"] == "line" and members:
+                # Like the Overpass fetcher, a relation is drawn with its first member way
+                self._emit(name, theme, tags, LineString(members[0]))
+            elif theme["geometry"] == "point":
+                points = [point for coords in members for point in coords]
+                if len(points) >= 3:
+                    self._emit(name, theme, tags, MultiPoint(points).centroid)
+
+    def area(self, area):
+        element_type = "way" if area.from_way() else "relation"
+        tags = _tags(area)
+        matching = self._matching(element_type, tags, ("polygon",))
+        if not matching:
+            return
+        try:
+            geometry = shapely.from_wkb(self.wkb.create_multipolygon(area))
+        except RuntimeError:
+            # Broken ring, the Overpass path skips these too
+            return
+        for name, theme in matching:
+            self._emit(name, theme, tags, geometry)
+
+
+def extract_frames(pbf_path, frames, themes=THEMES, output_format="gpkg", output_dir=OUTPUT_DIR):
+    """Write every theme for every frame covered by one extract; returns feature counts."""
+    member_ways = _MemberWays(themes)
+    relations_only = osmium.io.Reader(pbf_path, osmium.osm.osm_entity_bits.RELATION)
+    try:
+        osmium.apply(relations_only, member_ways)
+    finally:
+        relations_only.close()
+
+    with FrameWriters(output_format, output_dir) as writers:
+        router = ThemeRouter(frames, themes, writers, member_ways.way_ids)
+        router.apply_file(pbf_path, locations=True, idx="flex_mem")
+        router.flush_lines()
+        return writers.counts()
+
+
+def extract_bounds(pbf_path):
+    reader = osmium.io.Reader(pbf_path, osmium.osm.osm_entity_bits.NOTHING)
+    try:
+        header_box = reader.header().box()
+    finally:
+        reader.close()
+    if not header_box.valid():
+        return None
+    return box(header_box.bottom_left.lon, header_box.bottom_left.lat, header_box.top_right.lon, header_box.top_right.lat)
+
+
+def assign_frames(pbf_paths, frames):
+    """Give each frame to the first extract that fully covers it, so no two workers write one file."""
+    assigned = {path: [] for path in pbf_paths}
+    missing = []
+    bounds = {path: extract_bounds(path) for path in pbf_paths}
+    for name, geometry in frames:
+        path = next((p for p in pbf_paths if bounds[p] is None or bounds[p].covers(geometry)), None)
+        if path is None:
+            missing.append(name)
+        else:
+            assigned[path].append((name, geometry))
+    return assigned, missing
+
+
+def split_frames(frames, parts):
+    """Up to parts groups of neighbouring frames, cut along the longer side of their extent."""
+    if parts <= 1 or len(frames) <= 1:
+        return [frames]
+    centroids = shapely.centroid([geometry for _, geometry in frames])
+    x, y = shapely.get_x(centroids), shapely.get_y(centroids)
+    order = np.argsort(x if np.ptp(x) >= np.ptp(y) else y, kind="stable")
+    return [[frames[i] for i in group] for group in np.array_split(order, min(parts, len(frames)))]
+
+
+def extract_all(pbf_paths, sheet_paths, themes=THEMES, output_format="gpkg", output_dir=OUTPUT_DIR, max_workers=None):
+    """
+    One pass per extract and group of frames over all themes, in parallel.
+
+    The frames of each extract are split into as many groups as there are
+    workers for it, so a single extract keeps every worker busy.
+    """
+    frames = [(frame.key, box(*frame.bbox)) for frame in load_frames(sheet_paths)]
+    assigned, missing = assign_frames(pbf_paths, frames)
+    for name in missing:
+        print(f"No extract covers {name}")
+    assigned = {path: path_frames for path, path_frames in assigned.items() if path_frames}
+    if not assigned:
+        return
+    parts = -(-(max_workers or os.cpu_count() or 1) // len(assigned))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(extract_frames, path, group, themes, output_format, output_dir): (path, group)
+            for path, path_frames in assigned.items() for group in split_frames(path_frames, parts)
+        }
+        for future in as_completed(futures):
+            path, group = futures[future]
+            try:
+                counts = future.result()
+            except Exception as e:
+                print(f"Failed to process {path} ({len(group)} frames): {e}")
+                continue
+            print(f"{os.path.basename(path)} ({len(group)} frames): {sum(counts.values())} features in {len(counts)} layers")
+
+
+def main():
+    pbf_paths = sorted(glob.glob(os.path.join(PBF_DIR, "*.osm.pbf")))
+    sheet_paths = sorted(glob.glob(os.path.join(GIT_DIR, "_Ogolne", "Arkusze_*.shp")))
+    extract_all(pbf_paths, sheet_paths)
+    print("Extraction complete.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Multipolygon relation assembly shared by the building and water fetchers."""
+from collections import defaultdict
+
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+
+
+def join_ways(ways):
+    """
+    Join ways into closed rings through their end node ids.
+
+    ways is a list of (refs, coords) with matching node ids and coordinates.
+    Every way is visited once, with endpoints looked up in a hash map, so the
+    cost is linear in the number of ways. Returns (rings, broken) where rings
+    are closed coordinate lists and broken are the node id chains that could
+    not be closed.
+    """
+    rings = []
+    ends = defaultdict(list)
+    open_ways = []
+    for refs, coords in ways:
+        if len(refs) < 2:
+            continue
+        if refs[0] == refs[-1]:
+            rings.append(list(coords))
+            continue
+        index = len(open_ways)
+        open_ways.append((refs, coords))
+        ends[refs[0]].append(index)
+        ends[refs[-1]].append(index)
+
+    used = [False] * len(open_ways)
+    broken = []
+    for start in range(len(open_ways)):
+        if used[start]:
+            continue
+        used[start] = True
+        refs, coords = open_ways[start]
+        chain_refs, chain_coords = list(refs), list(coords)
+        while chain_refs[-1] != chain_refs[0]:
+            candidates = ends[chain_refs[-1]]
+            while candidates and used[candidates[-1]]:
+                candidates.pop()
+            if not candidates:
+                break
+            index = candidates.pop()
+            used[index] = True
+            refs, coords = open_ways[index]
+            if refs[0] != chain_refs[-1]:
+                refs, coords = refs[::-1], coords[::-1]
+            chain_refs.extend(refs[1:])
+            chain_coords.extend(coords[1:])
+
+        if chain_refs[-1] == chain_refs[0] and len(chain_coords) >= 4:
+            rings.append(chain_coords)
+        else:
+            broken.append(chain_refs)
+    return rings, broken
+
+
+def _valid_polygons(rings):
+    polygons = []
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        polygon = Polygon(ring)
+        if not polygon.is_valid:
+            polygon = shapely.make_valid(polygon)
+        polygons.extend(part for part in getattr(polygon, "geoms", [polygon]) if isinstance(part, Polygon) and not part.is_empty)
+    return polygons
+
+
+def assemble_multipolygon(members):
+    """
+    Build the geometry of a multipolygon relation.
+
+    members is a list of (role, coords, refs). Inner rings are matched to the
+    smallest outer ring containing them with one bulk STRtree query, so no
+    outer is ever differenced against the union of all inners. Returns
+    (MultiPolygon or None, broken node id chains).
+    """
+    outer_ways = [(refs, coords) for role, coords, refs in members if role != "inner"]
+    inner_ways = [(refs, coords) for role, coords, refs in members if role == "inner"]
+    outer_rings, broken = join_ways(outer_ways)
+    inner_rings, inner_broken = join_ways(inner_ways)
+    broken.extend(inner_broken)
+
+    outers = _valid_polygons(outer_rings)
+    if not outers:
+        return None, broken
+    inners = _valid_polygons(inner_rings)
+
+    holes = defaultdict(list)
+    if inners:
+        tree = shapely.STRtree(outers)
+        # Whole rings, not a point of each: an inner around a smaller outer (an island in a lake in a
+        # park) has points inside that outer too
+        inner_index, outer_index = tree.query(inners, predicate="covered_by")
+        areas = shapely.area(outers)
+        best = {}
+        for i, o in zip(inner_index, outer_index):
+            if i not in best or areas[o] < areas[best[i]]:
+                best[i] = o
+        for i, o in best.items():
+            holes[o].append(inners[i])
+
+    polygons = []
+    for index, outer in enumerate(outers):
+        if index in holes:
+            polygon = Polygon(outer.exterior, [hole.exterior for hole in holes[index]])
+            if not polygon.is_valid:
+                # Touching or overlapping holes, fall back to a difference with just this outer's holes
+                polygon = outer.difference(shapely.union_all(holes[index]))
+        else:
+            polygon = outer
+        polygons.extend(part for part in getattr(polygon, "geoms", [polygon]) if isinstance(part, Polygon) and not part.is_empty)
+
+    if not polygons:
+        return None, broken
+    return MultiPolygon(polygons), broken
@@ -0,0 +1,155 @@
+"""Concurrent frame/tile scheduling with per-endpoint rate limiting and backoff."""
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.error import URLError
+from urllib.request import urlopen
+
+import overpy
+
+from osm_pipeline.instrumentation import get_default_recorder
+
+DEFAULT_RATE = 0.5  # requests per second per endpoint
+DEFAULT_BURST = 2  # overpass-api.de hands out two slots per IP
+
+RETRYABLE_ERRORS = (
+    overpy.exception.OverpassTooManyRequests,
+    overpy.exception.OverpassGatewayTimeout,
+    overpy.exception.OverpassUnknownHTTPStatusCode,
+    URLError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class TokenBucket:
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Drain the bucket so nobody sends for the given time (server asked us to back off)."""
+        with self._lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+            self.updated = time.monotonic()
+
+
+class EndpointLimiter:
+    """One token bucket per endpoint URL."""
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        with self._lock:
+            if endpoint not in self._buckets:
+                self._buckets[endpoint] = TokenBucket(self.rate, self.capacity)
+            return self._buckets[endpoint]
+
+    def acquire(self, endpoint):
+        self.bucket(endpoint).acquire()
+
+    def pause(self, endpoint, seconds):
+        self.bucket(endpoint).pause(seconds)
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_default_limiter():
+    global _default_limiter
+    with _default_limiter_lock:
+        if _default_limiter is None:
+            _default_limiter = EndpointLimiter()
+        return _default_limiter
+
+
+def backoff_delay(attempt, base=5.0, cap=300.0):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def status_url(endpoint):
+    return re.sub(r"/interpreter/?$", "/status", endpoint)
+
+
+def parse_slot_wait(status_text):
+    """Seconds until the next Overpass slot frees up, 0 if one is available now."""
+    if re.search(r"^\d+ slots? available now", status_text, re.MULTILINE):
+        return 0
+    waits = [int(s) for s in re.findall(r"Slot available after: \S+, in (-?\d+) seconds", status_text)]
+    if waits:
+        return max(0, min(waits))
+    return None
+
+
+def slot_wait(endpoint, timeout=10):
+    try:
+        with urlopen(status_url(endpoint), timeout=timeout) as f:
+            return parse_slot_wait(f.read().decode("utf-8", "replace"))
+    except (URLError, ConnectionError, TimeoutError):
+        return None
+
+
+def call_with_backoff(fn, endpoint=overpy.Overpass.default_url, max_retries=5, base_delay=5.0, max_delay=300.0, limiter=None):
+    """
+    Call fn(), retrying on server back-pressure.
+
+    HTTP 429 waits for the next free Overpass slot (from /status) and pauses the
+    endpoint for every other worker; 504 and connection errors back off
+    exponentially with jitter.
+    """
+    limiter = limiter if limiter is not None else get_default_limiter()
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except RETRYABLE_ERRORS as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            if isinstance(e, overpy.exception.OverpassTooManyRequests):
+                wait = slot_wait(endpoint)
+                if wait is not None:
+                    delay = wait + random.uniform(0, base_delay)
+            limiter.pause(endpoint, delay)
+            attempt += 1
+            recorder = get_default_recorder()
+            recorder.add("retries")
+            recorder.record("retry", endpoint=endpoint, attempt=attempt, delay=round(delay, 1), error=repr(e))
+            time.sleep(delay)
+
+
+def run_concurrently(fn, items, max_workers=DEFAULT_BURST):
+    """Run fn over items in a thread pool, yielding (item, result, error) as each finishes."""
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
@@ -0,0 +1,20 @@
+"""Frames of the sheet layers in _Ogolne (Arkusze_*.shp), shared by every backend."""
+import geopandas as gpd
+
+NAME_COLUMNS = ("Name_EN", "City_Name", "name")
+
+
+def read_sheet(sheet_path, name_columns=NAME_COLUMNS):
+    """
+    (name, WGS 84 geometry) of every frame of a sheet layer.
+
+    Frames are named by the first of name_columns the layer has; frames
+    without a name there (no such column, null or empty) by their row index.
+    """
+    gdf = gpd.read_file(sheet_path).to_crs(epsg=4326)
+    name_column = next((column for column in name_columns if column in gdf.columns), None)
+    frames = []
+    for index, row in gdf.iterrows():
+        name = row[name_column] if name_column else None
+        frames.append((name if isinstance(name, str) and name else str(index), row["geometry"]))
+    return frames
@@ -0,0 +1,322 @@
+"""Incremental parsing of Overpass JSON responses into resolved geometries."""
+import codecs
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from array import array
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import overpy
+
+from osm_pipeline.cache import get_default_cache
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.scheduler import call_with_backoff, get_default_limiter
+
+CHUNK_SIZE = 1 << 16
+
+_remark_regex = re.compile(r'"remark"\s*:\s*("(?:[^"\\]|\\.)*")')
+_osm3s_regex = re.compile(r'"osm3s"\s*:\s*(\{[^{}]*\})')
+
+
+class _CacheTee:
+    """Wraps an HTTP response, copying what is read into a cache entry committed on a clean EOF."""
+
+    def __init__(self, response, cache, key):
+        self.response = response
+        self.cache = cache
+        self.path = cache.path(key)
+        self.tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.copy = gzip.open(self.tmp_path, "wb", compresslevel=cache.compresslevel)
+        self.complete = False
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        if data:
+            self.copy.write(data)
+        else:
+            self.complete = True
+        return data
+
+    def commit(self):
+        """Keep the copy, called once the response parsed without a runtime error."""
+        self.copy.close()
+        if self.complete:
+            os.replace(self.tmp_path, self.path)
+            self.cache.evict()
+
+    def close(self):
+        self.response.close()
+        if not self.copy.closed:
+            self.copy.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_overpass_stream(query, url=overpy.Overpass.default_url, cache=None, limiter=None, bbox=None):
+    """
+    Open the raw response of a query as a binary stream.
+
+    Cache hits are read straight from the compressed cache file, misses are
+    streamed from the server and copied into the cache while being read.
+    cache=False always asks the server and keeps nothing (live data, e.g.
+    the queries of an incremental refresh).
+    """
+    if cache is not False:
+        cache = cache if cache is not None else get_default_cache()
+        key = cache.key(query, bbox)
+        path = cache.get_path(key)
+        if path is not None:
+            get_default_recorder().add("cache_hits")
+            return gzip.open(path, "rb")
+        get_default_recorder().add("cache_misses")
+
+    limiter = limiter if limiter is not None else get_default_limiter()
+    limiter.acquire(url)
+    try:
+        response = urlopen(url, query.encode("utf-8"))
+    except HTTPError as e:
+        e.close()
+        if e.code == 429:
+            raise overpy.exception.OverpassTooManyRequests()
+        if e.code == 504:
+            raise overpy.exception.OverpassGatewayTimeout()
+        if e.code == 400:
+            raise overpy.exception.OverpassBadRequest(query)
+        raise overpy.exception.OverpassUnknownHTTPStatusCode(e.code)
+    if cache is False:
+        return response
+    return _CacheTee(response, cache, key)
+
+
+def _raise_remark(tail):
+    match = _remark_regex.search(tail)
+    if not match:
+        return
+    msg = json.loads(match.group(1)).strip()
+    if msg.startswith("runtime error:"):
+        raise overpy.exception.OverpassRuntimeError(msg=msg)
+    if msg.startswith("runtime remark:"):
+        raise overpy.exception.OverpassRuntimeRemark(msg=msg)
+    raise overpy.exception.OverpassUnknownError(msg=msg)
+
+
+def iter_elements(stream, chunk_size=CHUNK_SIZE, header=None):
+    """
+    Yield the objects of the "elements" array one at a time.
+
+    Only the current chunk and the element being decoded are held in memory.
+    A trailing runtime error remark is raised after the last element. If a
+    header dict is given, it receives the "osm3s" fields of the response
+    (timestamp_osm_base: the time the data is current to).
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+        else:
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+    # Skip the header up to the opening bracket of the elements array
+    while True:
+        match = re.search(r'"elements"\s*:\s*\[', buffer)
+        if match:
+            pos = match.end()
+            if header is not None:
+                osm3s = _osm3s_regex.search(buffer, 0, match.start())
+                if osm3s:
+                    header.update(json.loads(osm3s.group(1)))
+            break
+        if eof:
+            _raise_remark(buffer)
+            return
+        fill()
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError("Overpass response ended inside the elements array")
+            fill()
+            continue
+        if buffer[pos] == "]":
+            pos += 1
+            break
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        pos = end
+        yield element
+
+    tail = buffer[pos:]
+    buffer, pos = "", 0
+    while not eof:
+        fill()
+        tail += buffer
+        buffer = ""
+    _raise_remark(tail)
+
+
+def iter_resolved(elements):
+    """
+    Resolve geometries as soon as their nodes are known.
+
+    Overpass prints nodes, then ways, then relations, so every way can be
+    resolved on arrival and every relation once its member ways were seen.
+    Yields (element, geometry) where geometry is (lon, lat) for tagged nodes,
+    a coordinate list for tagged ways and a list of (role, coordinates,
+    node ids) for the way members of relations.
+    """
+    nodes = {}
+    ways = {}
+    for element in elements:
+        kind = element["type"]
+        if kind == "node":
+            nodes[element["id"]] = (element["lon"], element["lat"])
+            if element.get("tags"):
+                yield element, nodes[element["id"]]
+        elif kind == "way":
+            refs = array("q", element.get("nodes", ()))
+            # Relations come last, any way may still turn out to be a member
+            ways[element["id"]] = refs
+            if element.get("tags"):
+                coords = [nodes[ref] for ref in refs if ref in nodes]
+                yield element, coords
+        elif kind == "relation":
+            members = []
+            for member in element.get("members", ()):
+                if member["type"] != "way" or member["ref"] not in ways:
+                    continue
+                refs = [ref for ref in ways[member["ref"]] if ref in nodes]
+                members.append((member.get("role", ""), [nodes[ref] for ref in refs], refs))
+            yield element, members
+
+
+def _inline_coords(points):
+    # Members cut by a bbox carry nulls for the nodes outside it
+    return [(point["lon"], point["lat"]) for point in points if point is not None]
+
+
+def iter_inline(elements):
+    """
+    Geometries of responses printed with "out center", "out geom" or "out tags".
+
+    Every element carries its own coordinates, so no node table is kept and
+    elements are yielded in any order. The geometry is (lon, lat) for nodes
+    and centers, a coordinate list for ways, a list of (role, coordinates,
+    coordinates) for the way members of relations (the coordinates double as
+    node ids for ring assembly) and None for tags-only and ids-only elements
+    and the derived elements of "make".
+    """
+    for element in elements:
+        if "center" in element:
+            center = element["center"]
+            yield element, (center["lon"], center["lat"])
+        elif element["type"] == "node":
+            yield element, (element["lon"], element["lat"]) if "lat" in element else None
+        elif element["type"] == "way":
+            yield element, _inline_coords(element["geometry"]) if "geometry" in element else None
+        elif element["type"] == "relation":
+            members = [
+                member for member in element.get("members", ())
+                if member["type"] == "way" and "geometry" in member
+            ]
+            if not members:
+                yield element, None
+                continue
+            resolved = []
+            for member in members:
+                coords = _inline_coords(member["geometry"])
+                resolved.append((member.get("role", ""), coords, coords))
+            yield element, resolved
+        else:
+            yield element, None
+
+
+class _Metered:
+    """Counts the bytes read from a stream and the time spent waiting for them."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+
+def stream_query(query, url=overpy.Overpass.default_url, cache=None, limiter=None, bbox=None, max_retries=5,
+                 inline=False, header=None, resolve=None):
+    """
+    Fetch a query and yield (element, geometry) pairs.
+
+    Recursed "out body" responses are resolved by iter_resolved, set inline
+    for queries printed with "out center", "out geom" or "out tags" (iter_inline).
+    resolve replaces both: a function of the element iterator yielding the pairs.
+    header is filled as in iter_elements.
+
+    Recorded as a "query" span: latency (rate limit waits, retries and server
+    time until the response starts), bytes, transfer and parse time, elements.
+    """
+    recorder = get_default_recorder()
+    with recorder.span("query", bbox=bbox) as span:
+        start = time.perf_counter()
+        stream = call_with_backoff(
+            lambda: open_overpass_stream(query, url, cache, limiter, bbox),
+            url,
+            max_retries=max_retries,
+            limiter=limiter,
+        )
+        span.add("latency", time.perf_counter() - start)
+        metered = _Metered(stream)
+        if resolve is None:
+            resolve = iter_inline if inline else iter_resolved
+        elements = resolve(iter_elements(metered, header=header))
+        busy = 0.0
+        count = 0
+        try:
+            with stream:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(elements)
+                    except StopIteration:
+                        break
+                    finally:
+                        busy += time.perf_counter() - start
+                    count += 1
+                    yield item
+                if isinstance(stream, _CacheTee):
+                    stream.commit()
+        finally:
+            span.add("elements", count)
+            span.add("bytes", metered.bytes)
+            span.add("transfer_seconds", metered.seconds)
+            span.add("parse_seconds", max(0.0, busy - metered.seconds))
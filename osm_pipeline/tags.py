@@ -0,0 +1,105 @@
+"""
+Vectorized normalization of unit-bearing and multi-valued OSM tags.
+
+Every parser takes a whole column (anything pandas.Series accepts) and
+returns a Series, so a national layer is parsed with a handful of string
+operations instead of a Python call per value. apply_to_layer writes the
+result to a QGIS layer with one changeAttributeValues call.
+"""
+import numpy as np
+import pandas as pd
+
+NUMBER = r"([-+]?\d*\.\d+|\d+)"
+INTEGER = r"\s*[-+]?\d+\s*"
+NULL_VALUES = ("", "null", "none", "nan", "yes")
+FOOT = 0.3048
+INCH = 0.0254
+
+
+def _text(values):
+    """Lower-cased strings with missing values as ""."""
+    series = values if isinstance(values, pd.Series) else pd.Series(list(values), dtype=object)
+    return series.astype(object).where(series.notna(), "").astype(str).str.strip().str.lower()
+
+
+def _first_value(text):
+    """First entry of a multi-valued tag ("3;4" -> "3")."""
+    return text.str.split(";", n=1).str[0].str.strip()
+
+
+def _first_number(text):
+    return pd.to_numeric(text.str.replace(",", ".", regex=False).str.extract(NUMBER, expand=False), errors="coerce")
+
+
+def parse_power_mw(values):
+    """Power output in MW ("240kW" -> 0.24, "0,996MW" -> 0.996, "yes" -> NaN), rounded to 3 decimals."""
+    text = _text(values)
+    number = _first_number(text).where(~text.isin(NULL_VALUES))
+    factor = np.where(text.str.contains("kw", regex=False), 0.001, np.where(text.str.contains("gw", regex=False), 1000.0, 1.0))
+    return (number * factor).round(3)
+
+
+def parse_lanes(values, default=0):
+    """Lane count from the first of ";" or "," separated values, default where it is not a whole number."""
+    first = _text(values).str.split(r"[;,]", n=1, regex=True).str[0]
+    whole = first.str.fullmatch(INTEGER)
+    return pd.to_numeric(first.where(whole), errors="coerce").fillna(default).astype(int)
+
+
+def parse_levels(values, default=1):
+    """building:levels as an int from the first value, default where it is not a plain count."""
+    first = _first_value(_text(values))
+    return pd.to_numeric(first.where(first.str.fullmatch(r"\d+")), errors="coerce").fillna(default).astype(int)
+
+
+def parse_height_m(values):
+    """Height in metres from "12", "12.5 m", "12,5", "40 ft" or 12'6"; NaN when unparsable."""
+    text = _first_value(_text(values))
+    metres = _first_number(text)
+    feet_inches = text.str.extract(r"(\d+(?:\.\d+)?)\s*'\s*(?:(\d+(?:\.\d+)?)\s*\")?")
+    imperial = feet_inches[0].notna()
+    feet = pd.to_numeric(feet_inches[0], errors="coerce") * FOOT + pd.to_numeric(feet_inches[1], errors="coerce").fillna(0) * INCH
+    metres = metres.where(~imperial, feet)
+    metres = metres.where(~(text.str.contains("ft", regex=False) & ~imperial), metres * FOOT)
+    return metres.round(2)
+
+
+def layer_frame(layer, fields):
+    """DataFrame of the given attribute fields indexed by feature id, read without geometry."""
+    from qgis.core import QgsFeatureRequest
+
+    def value(attribute):
+        # QGIS NULLs arrive as QVariant objects, make them proper missing values
+        return None if attribute is None or (hasattr(attribute, "isNull") and attribute.isNull()) else attribute
+
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(fields, layer.fields())
+    rows = {feature.id(): [value(feature[field]) for field in fields] for feature in layer.getFeatures(request)}
+    return pd.DataFrame.from_dict(rows, orient="index", columns=fields)
+
+
+def apply_to_layer(layer, field_name, values, field_type=None):
+    """
+    Write values (a Series indexed by feature id) to field_name, adding the field if needed.
+
+    Uses a single dataProvider().changeAttributeValues call instead of one
+    changeAttributeValue per feature inside an edit session.
+    """
+    from qgis.core import QgsField
+    from qgis.PyQt.QtCore import QVariant
+
+    provider = layer.dataProvider()
+    # changeAttributeValues takes provider indexes, which differ from the layer's once it has virtual or joined fields
+    index = provider.fields().indexOf(field_name)
+    if index < 0:
+        provider.addAttributes([QgsField(field_name, field_type if field_type is not None else QVariant.Double)])
+        layer.updateFields()
+        index = provider.fields().indexOf(field_name)
+
+    changes = {
+        int(fid): {index: None if pd.isna(value) else value.item() if hasattr(value, "item") else value}
+        for fid, value in values.items()
+    }
+    if not provider.changeAttributeValues(changes):
+        raise RuntimeError(f"Could not write {field_name}: {provider.lastError()}")
+    layer.triggerRepaint()
+    return len(changes)
@@ -0,0 +1,186 @@
+"""
+Theme definitions shared by the Overpass fetchers and the offline backends.
+
+Each theme lists the tag filters of its Overpass query as (element type,
+conditions) clauses, the geometry it produces, the properties it keeps and
+an optional post-filter. Conditions are (key, op, value) with op one of
+"exists", "=", "!=" and "~" (unanchored regex, like Overpass).
+"""
+import re
+
+MAJOR_ROADS = "primary|secondary|tertiary|motorway|trunk"
+RAIL_TYPES = "rail|subway|tram|light_rail"
+GASTRONOMY = ("restaurant", "bar", "pub", "nightclub", "cafe", "fast_food")
+
+# Layer geometry type for each theme "geometry" kind
+GEOMETRY_TYPES = {"point": "POINT", "line": "LINESTRING", "polygon": "MULTIPOLYGON", "member_lines": "LINESTRING"}
+# Cheapest Overpass output mode each geometry kind can be built from, see compiler.output_mode
+OUTPUT_MODES = {"point": "center", "line": "geom", "polygon": "body", "member_lines": "geom"}
+
+
+def tag_matches(tags, condition):
+    key, op, value = condition
+    if op == "exists":
+        return key in tags
+    if op == "=":
+        return tags.get(key) == value
+    if op == "!=":
+        # Like Overpass, an absent key also counts as "not equal"
+        return tags.get(key) != value
+    if op == "~":
+        return key in tags and re.search(value, tags[key]) is not None
+    raise ValueError(f"Unknown tag operator {op!r}")
+
+
+def theme_matches(theme, element_type, tags):
+    return any(
+        clause_type == element_type and all(tag_matches(tags, condition) for condition in conditions)
+        for clause_type, conditions in theme["filters"]
+    )
+
+
+def theme_properties(theme, tags):
+    """Properties of a matching element, or None if the post-filter drops it."""
+    properties = {name: tags.get(key, default) for name, (key, default) in theme["properties"].items()}
+    post_filter = theme.get("post_filter")
+    if post_filter is not None:
+        return post_filter(tags, properties)
+    return properties
+
+
+def _structure_type(tags, properties):
+    is_bridge = "bridge" in tags and tags["bridge"] != "no"
+    is_tunnel = "tunnel" in tags and tags["tunnel"] == "yes"
+
+    if tags.get("railway") == "construction":
+        prefix = "rail_construction"
+    elif tags.get("highway") == "construction":
+        prefix = "road_construction"
+    elif "railway" in tags and tags["railway"] not in ["no"]:
+        prefix = "rail"
+    elif "highway" in tags and tags["highway"] not in ["no"]:
+        prefix = "road"
+    else:
+        prefix = "other"
+
+    if is_bridge:
+        suffix = "bridge"
+    elif is_tunnel:
+        suffix = "tunnel"
+    else:
+        suffix = "other"
+
+    return {"type": f"{prefix}_{suffix}", **properties}
+
+
+def _wide_road(tags, properties):
+    lanes = tags.get("lanes", "0")
+    oneway = tags.get("oneway", "no")
+    try:
+        lanes = int(lanes.split(";")[0].split(",")[0])
+    except ValueError:
+        lanes = 0
+    if (oneway == "yes" and lanes >= 2) or (oneway == "no" and lanes >= 4):
+        return properties
+    return None
+
+
+def _stop_railway_type(tags, properties):
+    if properties.get("railway") == "tram_stop":
+        railway_type = "tram"
+    else:
+        railway_type = None
+        for key in ["light_rail", "subway", "tram", "monorail"]:
+            if tags.get(key) == "yes":
+                railway_type = key
+                break
+        if railway_type is None and tags.get("train") == "yes":
+            railway_type = "train"
+    if railway_type is None:
+        return None
+    return {"railway": railway_type, "name": properties.get("name")}
+
+
+def _has_amenity(tags, properties):
+    return properties if properties["amenity"] is not None else None
+
+
+def _structure_clauses():
+    clauses = []
+    for key, values in (("highway", MAJOR_ROADS), ("construction", MAJOR_ROADS),
+                        ("railway", RAIL_TYPES + "|construction"), ("construction", RAIL_TYPES)):
+        clauses.append(("way", [(key, "~", values), ("tunnel", "=", "yes")]))
+        clauses.append(("way", [(key, "~", values), ("bridge", "exists", None), ("bridge", "!=", "no")]))
+    return clauses
+
+
+def _cycleway_clauses():
+    clauses = [("way", [("highway", "=", "cycleway")])]
+    clauses += [("way", [("cycleway", "=", value)]) for value in ("lane", "track")]
+    clauses += [("way", [(f"cycleway:{side}", "=", value)])
+                for side in ("left", "right") for value in ("lane", "opposite_lane", "track", "separate")]
+    clauses += [("way", [("cycleway:both", "=", value)]) for value in ("lane", "track", "separate")]
+    clauses.append(("way", [("bicycle", "=", "designated")]))
+    return clauses
+
+
+THEMES = {
+    "buildings": {
+        "filters": [("way", [("building", "exists", None)]), ("relation", [("building", "exists", None)])],
+        "geometry": "polygon",
+        "properties": {
+            "building": ("building", "unknown"),
+            "levels": ("building:levels", "unknown"),
+            "height": ("building:height", "unknown"),
+        },
+    },
+    "water_bodies": {
+        "filters": [("way", [("natural", "=", "water")]), ("relation", [("natural", "=", "water")])],
+        "geometry": "polygon",
+        "properties": {"name": ("name", "Unknown")},
+    },
+    "roads": {
+        "filters": [("way", [("highway", "~", "primary|secondary|tertiary|motorway|motorway_link|trunk")])],
+        "geometry": "line",
+        "properties": {key: (key, None) for key in ("oneway", "lanes", "highway", "motorroad")},
+        "post_filter": _wide_road,
+    },
+    "structures": {
+        "filters": _structure_clauses(),
+        "geometry": "line",
+        "properties": {key: (key, None) for key in ("highway", "railway", "bridge", "tunnel", "construction")},
+        "post_filter": _structure_type,
+        "min_length": 50,
+    },
+    "cycleways": {
+        "filters": _cycleway_clauses(),
+        "geometry": "line",
+        "properties": {key: (key, None) for key in (
+            "highway", "cycleway", "cycleway:left", "cycleway:right", "cycleway:both",
+            "bicycle", "footway", "foot", "segregated")},
+    },
+    "gastronomy": {
+        "filters": [(element_type, [("amenity", "=", amenity)])
+                    for element_type in ("node", "way", "relation") for amenity in GASTRONOMY],
+        "geometry": "point",
+        "properties": {"amenity": ("amenity", None), "name": ("name", None)},
+        "post_filter": _has_amenity,
+    },
+    "powerplants": {
+        "filters": [("way", [("power", "=", "plant")]), ("relation", [("power", "=", "plant")])],
+        "geometry": "line",
+        "properties": {key: (key, None) for key in ("plant:output:electricity", "plant:source")},
+    },
+    "transit_routes": {
+        "filters": [("relation", [("type", "=", "route"), ("route", "~", "bus|tram|train|subway|railway|ferry")])],
+        "geometry": "member_lines",
+        "properties": {"type": ("type", None), "route": ("route", None)},
+    },
+    "transit": {
+        "filters": [("node", [("railway", "=", value)]) for value in ("tram_stop", "station", "stop", "halt")]
+        + [("way", [("railway", "=", "station"), (mode, "=", "yes")]) for mode in ("subway", "tram", "light_rail")],
+        "geometry": "point",
+        "properties": {key: (key, None) for key in ("railway", "name", "light_rail", "subway", "tram", "train", "monorail")},
+        "post_filter": _stop_railway_type,
+    },
+}
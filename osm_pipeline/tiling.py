@@ -0,0 +1,157 @@
+"""Adaptive quadtree tiling of a frame with deduplication across tiles."""
+import json
+import os
+import threading
+
+import overpy
+
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.scheduler import DEFAULT_BURST, run_concurrently
+
+DEFAULT_PLAN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_cache", "tiles")
+
+
+class TileFetchError(Exception):
+    """Tiles of a frame failed for good; failed maps their paths to the last error."""
+
+    def __init__(self, bbox, failed):
+        self.bbox = bbox
+        self.failed = failed
+        super().__init__(f"{len(failed)} tile(s) of {bbox} failed: "
+                         + ", ".join(f"'{path}' ({error})" for path, error in sorted(failed.items())))
+
+
+def should_split(error):
+    """True if the server gave up on the tile because it is too dense, not because it is busy."""
+    if isinstance(error, overpy.exception.OverpassGatewayTimeout):
+        return True
+    if isinstance(error, overpy.exception.OverpassRuntimeError):
+        msg = str(error)
+        return "timed out" in msg or "out of memory" in msg
+    return False
+
+
+def path_bbox(bbox, path):
+    """
+    Bounding box of a quadtree tile.
+
+    A path is a string of quadrant digits, '' is the whole frame and each
+    digit picks 0=SW, 1=SE, 2=NW, 3=NE of the previous tile.
+    """
+    minx, miny, maxx, maxy = bbox
+    for quadrant in path:
+        midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+        quadrant = int(quadrant)
+        minx, maxx = (midx, maxx) if quadrant & 1 else (minx, midx)
+        miny, maxy = (midy, maxy) if quadrant & 2 else (miny, midy)
+    return (minx, miny, maxx, maxy)
+
+
+def load_plan(plan_path):
+    if plan_path and os.path.exists(plan_path):
+        with open(plan_path) as f:
+            return json.load(f)["tiles"]
+    return [""]
+
+
+def save_plan(plan_path, tiles):
+    if not plan_path:
+        return
+    os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+    with open(plan_path, "w") as f:
+        json.dump({"tiles": sorted(tiles)}, f)
+
+
+def merge_sparse(counts, sparse_threshold):
+    """Collapse complete sibling quartets whose combined feature count is below the threshold."""
+    counts = dict(counts)
+    merged = True
+    while merged:
+        merged = False
+        parents = {path[:-1] for path in counts if path}
+        for parent in sorted(parents, key=len, reverse=True):
+            children = [parent + str(q) for q in range(4)]
+            if not all(child in counts for child in children):
+                continue
+            total = sum(counts[child] for child in children)
+            if total < sparse_threshold:
+                for child in children:
+                    del counts[child]
+                counts[parent] = total
+                merged = True
+    return counts
+
+
+def fetch_tiled(bbox, fetch_tile, plan_path=None, write=None, max_depth=6, max_workers=DEFAULT_BURST, sparse_threshold=20000):
+    """
+    Fetch a frame tile by tile, passing each feature to write() exactly once.
+
+    fetch_tile(tile_bbox) yields (element_key, feature) pairs, where
+    element_key identifies the OSM element (e.g. ("way", 123)). A tile is split
+    into quadrants only when the server times out or runs out of memory on it.
+    The resulting leaves are saved to plan_path, sparse sibling tiles merged,
+    so the next run starts from tiles that match the data density.
+
+    Without write() the features are collected and returned as a list.
+    Returns the number of features written otherwise. If a tile fails
+    without being split, the other tiles are still fetched and written, the
+    plan is saved, then TileFetchError is raised: the frame is incomplete.
+
+    Every tile is recorded as a "tile" span under the caller's open span.
+    """
+    pending = load_plan(plan_path)
+    counts = {}
+    failed = {}
+    seen = {}  # element key: path of the tile it is counted for
+    features = []
+    lock = threading.Lock()
+    collect = write is None
+    if collect:
+        write = features.append
+    recorder = get_default_recorder()
+    parent = recorder.current()
+
+    def run_tile(path):
+        written = 0
+        tile_bbox = path_bbox(bbox, path)
+        with recorder.span("tile", path, parent=parent, bbox=tile_bbox) as span:
+            try:
+                for key, feature in fetch_tile(tile_bbox):
+                    with lock:
+                        # Elements crossing tile borders come back from every tile they touch
+                        owner = seen.get(key)
+                        if owner is None:
+                            write(feature)
+                        elif not (len(owner) < len(path) and path.startswith(owner)):
+                            continue
+                        # else written by an ancestor before it failed and was split: already
+                        # written, but it counts for the child that has it in the plan now
+                        seen[key] = path
+                    written += 1
+            finally:
+                span.add("features", written)
+        # Features new to this tile: those crossing into tiles fetched earlier are not counted twice
+        return written
+
+    while pending:
+        split = []
+        for path, count, error in run_concurrently(run_tile, pending, max_workers):
+            if error is not None:
+                if should_split(error) and len(path) < max_depth:
+                    recorder.record("split", tile=path, bbox=bbox, error=repr(error))
+                    print(f"Splitting tile '{path}' of {bbox}: {error}")
+                    split.extend(path + str(q) for q in range(4))
+                else:
+                    print(f"Failed tile '{path}' of {bbox}: {error}")
+                    failed[path] = error
+                    # Keep it in the plan, unmerged, so the next run retries it
+                    counts[path] = sparse_threshold
+                continue
+            counts[path] = count
+        pending = split
+
+    if counts:
+        save_plan(plan_path, merge_sparse(counts, sparse_threshold))
+    if failed:
+        raise TileFetchError(bbox, failed)
+    return features if collect else len(seen)
@@ -0,0 +1,131 @@
+"""
+Transit network of route relations with every stretch of track or road drawn once.
+
+A way shared by twenty bus routes used to be written twenty times, once per
+route relation. Here the way members are broken into node-to-node edges,
+each edge keyed by its node pair and tagged with the set of routes running
+over it, and edges are stitched back into lines between junctions: nodes
+where the network branches or the set of routes changes. Every line gets
+the number of routes, the lines (mode and ref) and the modes on it, which
+is what line bundling styles need.
+
+"type" and "route" keep their meaning from the per-relation features, so
+existing styles still categorize on them: "route" is the single mode of the
+most routes on the line; all modes are in "modes".
+"""
+from collections import Counter
+
+from osm_pipeline.instrumentation import get_default_recorder
+from osm_pipeline.themes import THEMES, theme_matches
+
+ROUTE_THEME = THEMES["transit_routes"]
+
+
+def _ref_key(ref):
+    # Natural order: 2, 10, 10A, N21
+    return (0, int(ref), "") if ref.isdecimal() else (1, 0, ref)
+
+
+class TransitNetwork:
+    """Undirected graph of the edges of route relations, each with the set of routes using it."""
+
+    def __init__(self):
+        self.nodes = {}  # node id -> (lon, lat)
+        self.edges = {}  # (node id, node id), smaller first -> set of route indices
+        self.routes = []  # (mode, ref) of every route relation added
+
+    def add_route(self, element, members):
+        """Add a route relation; members are (role, coordinates, node ids) as from streaming.iter_resolved."""
+        tags = element.get("tags", {})
+        route = len(self.routes)
+        self.routes.append((tags.get("route"), tags.get("ref") or tags.get("name") or str(element["id"])))
+        for role, coords, refs in members:
+            if role.startswith("platform"):
+                continue
+            for ref, point in zip(refs, coords):
+                self.nodes[ref] = tuple(point)
+            for a, b in zip(refs, refs[1:]):
+                if a == b:
+                    continue
+                self.edges.setdefault((a, b) if a < b else (b, a), set()).add(route)
+
+    def _adjacency(self):
+        adjacent = {}
+        for a, b in self.edges:
+            adjacent.setdefault(a, []).append(b)
+            adjacent.setdefault(b, []).append(a)
+        return adjacent
+
+    def segments(self):
+        """
+        Yield (node ids, route indices) of every stitched segment.
+
+        A segment runs between junctions: nodes with other than two neighbours,
+        or whose two edges carry different routes. Rings without any junction
+        come out as one closed segment.
+        """
+        adjacent = self._adjacency()
+        edges = self.edges
+
+        def edge(a, b):
+            return edges[(a, b) if a < b else (b, a)]
+
+        def is_junction(node):
+            neighbours = adjacent[node]
+            return len(neighbours) != 2 or edge(node, neighbours[0]) != edge(node, neighbours[1])
+
+        visited = set()
+
+        def walk(start, first):
+            routes = edge(start, first)
+            path = [start, first]
+            visited.add((start, first) if start < first else (first, start))
+            previous, node = start, first
+            while node != start and not is_junction(node):
+                following = next(n for n in adjacent[node] if n != previous)
+                visited.add((node, following) if node < following else (following, node))
+                path.append(following)
+                previous, node = node, following
+            return path, routes
+
+        for node in adjacent:
+            if not is_junction(node):
+                continue
+            for neighbour in adjacent[node]:
+                if ((node, neighbour) if node < neighbour else (neighbour, node)) not in visited:
+                    yield walk(node, neighbour)
+        # Whatever is left forms rings of identical routes
+        for a, b in edges:
+            if (a, b) not in visited:
+                yield walk(a, b)
+
+    def features(self):
+        """Yield one GeoJSON LineString feature per segment."""
+        for path, routes in self.segments():
+            lines = {self.routes[route] for route in routes}
+            modes = Counter(self.routes[route][0] for route in routes if self.routes[route][0])
+            refs = sorted({ref for _, ref in lines}, key=_ref_key)
+            yield {
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": [self.nodes[node] for node in path]},
+                "properties": {
+                    "type": "route",
+                    # Ties go to the alphabetically first mode, so the choice is stable
+                    "route": min(modes, key=lambda mode: (-modes[mode], mode)) if modes else None,
+                    "modes": ";".join(sorted(modes)),
+                    "route_count": len(routes),
+                    "line_count": len(lines),
+                    "refs": ";".join(refs),
+                },
+            }
+
+
+def build_network(elements):
+    """TransitNetwork of the route relations in (element, geometry) pairs from streaming.iter_resolved."""
+    network = TransitNetwork()
+    for element, geometry in elements:
+        if element["type"] != "relation" or not theme_matches(ROUTE_THEME, "relation", element.get("tags") or {}):
+            continue
+        with get_default_recorder().stage("assemble"):
+            network.add_route(element, geometry)
+    return network
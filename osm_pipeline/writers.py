@@ -0,0 +1,394 @@
+"""Feature writers that stream to disk instead of dumping one big list."""
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pyogrio
+import pyogrio.raw
+import shapely
+
+from osm_pipeline.instrumentation import get_default_recorder
+
+GPKG_APPLICATION_ID = 0x47504B47  # "GPKG"
+GPKG_USER_VERSION = 10400
+
+SQL_TYPES = {bool: "INTEGER", int: "INTEGER", float: "REAL", str: "TEXT"}
+
+
+class GeoJSONWriter:
+    """Writes a FeatureCollection one feature at a time; the file is created on the first feature."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, feature):
+        if hasattr(feature, "wkb"):
+            feature = _decode_feature(feature)
+        with self._lock, get_default_recorder().stage("serialize"):
+            if self._file is None:
+                self._file = open(self.path, "w")
+                self._file.write('{"type": "FeatureCollection", "features": [\n')
+            else:
+                self._file.write(",\n")
+            json.dump(feature, self._file)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.write("\n]}\n")
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _decode_feature(feature):
+    """GeoJSON dict for an already encoded feature (see geometry_batch.EncodedFeature)."""
+    return {
+        "type": "Feature",
+        "geometry": json.loads(shapely.to_geojson(shapely.from_wkb(feature.wkb))),
+        "properties": feature.properties,
+    }
+
+
+GEOMETRY_TYPE_NAMES = {
+    "POINT": "Point",
+    "LINESTRING": "LineString",
+    "POLYGON": "Polygon",
+    "MULTIPOINT": "MultiPoint",
+    "MULTILINESTRING": "MultiLineString",
+    "MULTIPOLYGON": "MultiPolygon",
+    "GEOMETRYCOLLECTION": "GeometryCollection",
+    "GEOMETRY": "Unknown",
+}
+
+DTYPE_SQL_TYPES = {"int64": "INTEGER", "int32": "INTEGER", "bool": "INTEGER", "float64": "REAL", "float32": "REAL"}
+
+
+def _infer_fields(rows):
+    """{field: SQL type} over the properties of a batch, in the order the fields first appear."""
+    kinds = {}
+    for _, properties in rows:
+        for key, value in properties.items():
+            kind = kinds.setdefault(key, set())
+            if value is not None:
+                kind.add(SQL_TYPES.get(type(value), "TEXT"))
+    fields = {}
+    for key, kind in kinds.items():
+        if kind <= {"INTEGER"}:
+            fields[key] = "INTEGER"
+        elif kind <= {"INTEGER", "REAL"}:
+            fields[key] = "REAL"
+        else:
+            fields[key] = "TEXT"
+    return fields
+
+
+def _column(layer, field, sql_type, values):
+    """(values, null mask) arrays of one field for pyogrio; the mask is None for object and float columns."""
+    if sql_type == "TEXT":
+        return np.array([None if value is None else str(value) for value in values], dtype=object), None
+    try:
+        if sql_type == "INTEGER":
+            mask = np.array([value is None for value in values], dtype=bool)
+            return np.array([0 if value is None else int(value) for value in values], dtype=np.int64), mask
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64), None
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"{layer}.{field} is {sql_type}: {error}") from error
+
+
+def _wkbs(geometries):
+    """WKB of a batch of WKB and GeoJSON geometries, the GeoJSON ones parsed in bulk by GEOS."""
+    wkbs = np.array(geometries, dtype=object)
+    mappings = np.array([not isinstance(geometry, bytes) for geometry in geometries], dtype=bool)
+    if mappings.any():
+        wkbs[mappings] = shapely.to_wkb(shapely.from_geojson([json.dumps(wkbs[i]) for i in np.flatnonzero(mappings)]))
+    return wkbs
+
+
+class GeoPackage:
+    """
+    A GeoPackage file holding one layer per theme.
+
+    Features are written through GDAL (pyogrio) in batches, which keeps the
+    file, its R-tree spatial index and the feature counts in the shape QGIS
+    expects. The sqlite3 connection is for the tables of other modules
+    (incremental.SyncState) and for deleting features by key; it is opened
+    on first use.
+    """
+
+    def __init__(self, path, batch_size=10000, srs_id=4326):
+        self.path = path
+        self.batch_size = batch_size
+        self.crs = f"EPSG:{srs_id}"
+        self.lock = threading.RLock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        with self.lock:
+            if self._connection is None:
+                new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+                self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                if new:
+                    self._create_metadata()
+            return self._connection
+
+    def _create_metadata(self):
+        """
+        The tables that make an empty file a GeoPackage.
+
+        Without them GDAL takes a file with only our own tables for something
+        else and replaces it on the first layer; it adds the rest itself.
+        """
+        cursor = self._connection
+        cursor.execute(f"PRAGMA application_id = {GPKG_APPLICATION_ID}")
+        cursor.execute(f"PRAGMA user_version = {GPKG_USER_VERSION}")
+        cursor.execute("""
+            CREATE TABLE gpkg_spatial_ref_sys (
+                srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+                organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)""")
+        cursor.execute("""
+            CREATE TABLE gpkg_contents (
+                table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+                description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id))""")
+        # GDAL's feature count table, only made when GDAL creates the file itself
+        cursor.execute("CREATE TABLE gpkg_ogr_contents (table_name TEXT NOT NULL PRIMARY KEY, feature_count INTEGER DEFAULT NULL)")
+
+    def layer(self, name, fields=None, geometry_type="GEOMETRY"):
+        """
+        Writer replacing the layer.
+
+        The layer is overwritten by the first batch written, or on close with
+        an empty one if nothing was; a new layer is only created for features.
+        """
+        return GeoPackageLayer(self, name, fields, geometry_type)
+
+    def layer_info(self, name):
+        """pyogrio.read_info of an existing layer, or None if there is no such layer."""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return None
+        with self.lock:
+            if name not in pyogrio.list_layers(self.path)[:, 0]:
+                return None
+            return pyogrio.read_info(self.path, layer=name)
+
+    def layer_fields(self, name):
+        """{column: SQL type} of an existing layer without fid and geom, or None if there is no such layer."""
+        info = self.layer_info(name)
+        if info is None:
+            return None
+        return {field: DTYPE_SQL_TYPES.get(dtype, "TEXT") for field, dtype in zip(info["fields"], info["dtypes"])}
+
+    def update_layer(self, name, key_fields):
+        """
+        Edit an existing layer in place: delete features by key, then append.
+
+        key_fields are the columns identifying a feature (e.g. osm_type,
+        osm_id), indexed on first use.
+        """
+        return GeoPackageLayerUpdate(self, name, key_fields)
+
+    def close(self):
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GeoPackageLayer:
+    """
+    Writer for one feature layer, flushed to GDAL every batch_size features.
+
+    Without fields given the columns and their types are inferred from the
+    properties of the first batch.
+    """
+
+    def __init__(self, gpkg, name, fields=None, geometry_type="GEOMETRY"):
+        self.gpkg = gpkg
+        self.name = name
+        self.fields = dict(fields) if fields else None
+        self.geometry_type = GEOMETRY_TYPE_NAMES.get(geometry_type.upper(), geometry_type)
+        self.count = 0
+        self._rows = []
+        self._append = False
+        self._closed = False
+
+    def write(self, feature):
+        if hasattr(feature, "wkb"):
+            # Encoded in bulk by geometry_batch.PolygonBatch, no GeoJSON round trip
+            self.write_wkb(feature.wkb, feature.properties)
+            return
+        with self.gpkg.lock:
+            self._add(feature["geometry"], feature.get("properties") or {})
+
+    def write_wkb(self, wkb, properties):
+        """Write an already encoded geometry."""
+        with self.gpkg.lock:
+            self._add(wkb, properties)
+
+    def _add(self, geometry, properties):
+        self.count += 1
+        self._rows.append((geometry, properties))
+        if len(self._rows) >= self.gpkg.batch_size:
+            self._flush()
+
+    def _flush(self, empty=False):
+        if not self._rows and not empty:
+            return
+        with get_default_recorder().stage("serialize"):
+            if self.fields is None:
+                self.fields = _infer_fields(self._rows)
+            geometries = _wkbs([geometry for geometry, _ in self._rows])
+            columns = [
+                _column(self.name, field, sql_type, [properties.get(field) for _, properties in self._rows])
+                for field, sql_type in self.fields.items()
+            ]
+            pyogrio.raw.write(
+                self.gpkg.path, geometries, [values for values, _ in columns], list(self.fields),
+                field_mask=[mask for _, mask in columns] if columns else None, layer=self.name, driver="GPKG",
+                geometry_type=self.geometry_type, crs=self.gpkg.crs,
+                # Keep the layer single-typed so QGIS does not split it into sublayers
+                promote_to_multi=self.geometry_type.startswith("Multi"), append=self._append,
+            )
+        self._append = True
+        self._rows = []
+
+    def close(self):
+        with self.gpkg.lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._rows:
+                self._flush()
+            elif not self._append:
+                # Nothing written: an existing layer is still replaced, keeping its columns
+                existing = self.gpkg.layer_fields(self.name)
+                if existing is not None:
+                    self.fields = self.fields or existing
+                    self._flush(empty=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GeoPackageLayerUpdate(GeoPackageLayer):
+    """
+    Writer appending to an existing layer.
+
+    Deletes go through sqlite3 and the key index; the triggers GDAL put on
+    the layer keep its R-tree and feature count up to date.
+    """
+
+    def __init__(self, gpkg, name, key_fields):
+        info = gpkg.layer_info(name)
+        if info is None:
+            raise ValueError(f"No layer {name!r} in {gpkg.path}")
+        super().__init__(gpkg, name, gpkg.layer_fields(name), info["geometry_type"])
+        self.key_fields = tuple(key_fields)
+        self._append = True
+        key_list = ", ".join(f'"{field}"' for field in self.key_fields)
+        self._delete_sql = f'DELETE FROM "{name}" WHERE ' + " AND ".join(f'"{field}" = ?' for field in self.key_fields)
+        with gpkg.lock:
+            gpkg.connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}_key" ON "{name}" ({key_list})')
+
+    def delete(self, keys):
+        """Delete every feature whose key fields equal one of the key tuples."""
+        with self.gpkg.lock:
+            self._flush()
+            cursor = self.gpkg.connection
+            cursor.execute("BEGIN")
+            cursor.executemany(self._delete_sql, keys)
+            cursor.execute("COMMIT")
+
+
+class _OwnedLayer(GeoPackageLayer):
+    def close(self):
+        super().close()
+        self.gpkg.close()
+
+
+def frame_output_path(name, theme, output_format="gpkg", directory=""):
+    """
+    One GeoPackage per frame holding every theme, or one GeoJSON per frame and theme.
+
+    The frame name may contain a subdirectory (e.g. "Arkusze_Miasta/Warsaw"),
+    which is created if needed.
+    """
+    subdirectory, name = os.path.split(name)
+    directory = os.path.join(directory, subdirectory)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if output_format == "gpkg":
+        return os.path.join(directory, f"{name}.gpkg")
+    return os.path.join(directory, f"{theme}_{name}.geojson")
+
+
+def open_writer(path, layer=None, fields=None, geometry_type="GEOMETRY"):
+    """Pick the writer backend from the file extension (.gpkg or .geojson)."""
+    if os.path.splitext(path)[1].lower() == ".gpkg":
+        layer = layer or os.path.splitext(os.path.basename(path))[0]
+        return _OwnedLayer(GeoPackage(path), layer, fields, geometry_type)
+    return GeoJSONWriter(path)
+
+
+class FrameWriters:
+    """Lazily opened writers for many (frame, theme) pairs, one GeoPackage per frame."""
+
+    def __init__(self, output_format="gpkg", directory=""):
+        self.output_format = output_format
+        self.directory = directory
+        self.writers = {}
+        self._gpkgs = {}
+        self._lock = threading.Lock()
+
+    def get(self, frame, theme, fields=None, geometry_type="GEOMETRY"):
+        with self._lock:
+            writer = self.writers.get((frame, theme))
+            if writer is None:
+                path = frame_output_path(frame, theme, self.output_format, self.directory)
+                if self.output_format == "gpkg":
+                    if frame not in self._gpkgs:
+                        self._gpkgs[frame] = GeoPackage(path)
+                    writer = self._gpkgs[frame].layer(theme, fields, geometry_type)
+                else:
+                    writer = GeoJSONWriter(path)
+                self.writers[(frame, theme)] = writer
+            return writer
+
+    def counts(self):
+        return {key: writer.count for key, writer in self.writers.items()}
+
+    def close(self):
+        with self._lock:
+            for writer in self.writers.values():
+                writer.close()
+            for gpkg in self._gpkgs.values():
+                gpkg.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,18 +1,27 @@
+import multiprocessing
+import os
+import sys
+
 from PyQt5.QtCore import QCoreApplication
-from qgis.core import (QgsProcessing, QgsProcessingFeatureBasedAlgorithm, 
-    QgsProcessingParameterDistance, QgsPoint, QgsFeature, QgsGeometry, 
-    QgsWkbTypes, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsProject)
-    
+from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingException,
+    QgsProcessingParameterFeatureSource, QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterDistance, QgsProcessingParameterNumber, QgsFeatureSink,
+    QgsGeometry, QgsWkbTypes)
+
+sys.path.append(r"C:\Users\Asus\OneDrive\Pulpit\Rozne\QGIS\Git")
+from osm_pipeline.equidistance import equidistance_buffers
+
 
-class EquidistanceBuffer(QgsProcessingFeatureBasedAlgorithm ):
+class EquidistanceBuffer(QgsProcessingAlgorithm):
     """
     This algorithm takes a vectorlayer and creates equidistance bufers.
     """
+    INPUT = 'INPUT'
+    OUTPUT = 'OUTPUT'
     DISTANCE = 'DISTANCE'
+    ACCURACY = 'ACCURACY'
+    WORKERS = 'WORKERS'
     SEGMENTS = 5   
-    END_CAP_STYLE = QgsGeometry.CapRound 
-    JOIN_STYLE = QgsGeometry.JoinStyleRound
-    MITER_LIMIT = 2.0
     
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -31,57 +40,82 @@ class EquidistanceBuffer(QgsProcessingFeatureBasedAlgorithm ):
 
     def groupId(self):
         return 'scripts'
-
-    def outputName(self):
-        return self.tr('buffers')
         
     def shortHelpString(self):
         return self.tr(
             'This algorithm creates equidistant buffers for vector layers. \
             Each geometry is transformed to a Azimuthal Equidistant projection \
             centered at that geometry, buffered and transformed back to the \
-            original projection.')
+            original projection. With an accuracy above 0, geometries whose \
+            centroids are close enough share one projection, trading at most \
+            that many meters of buffer error for speed. Workers above 1 spread \
+            the work over several processes.')
 
     def __init__(self):
         super().__init__()
-    
-    def inputLayerTypes(self):
-        return [QgsProcessing.TypeVector]
         
-    def outputWkbType(self, input_wkb_type):
-        return QgsWkbTypes.Polygon
-        
-    def initParameters(self, config=None):
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                self.tr('Input layer'),
+                [QgsProcessing.TypeVector]
+                ))
         self.addParameter(
             QgsProcessingParameterDistance(
                 self.DISTANCE,
                 'Buffer Distance (meters)',
                 defaultValue=10000
                 ))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.ACCURACY,
+                'Accepted buffer error (meters, 0 = exact)',
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                minValue=0.0
+                ))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                'Worker processes',
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                minValue=1
+                ))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr('buffers')
+                ))
                 
-    def prepareAlgorithm(self, parameters, context, feedback):
-        self.distance = self.parameterAsDouble(
-            parameters,
-            self.DISTANCE,
-            context)
-        source = self.parameterAsSource(parameters, 'INPUT', context)
-        self.source_crs = source.sourceCrs()
-        if not self.source_crs.isGeographic():
-            feedback.reportError('Layer CRS must be a Geograhpic CRS for this algorithm')
-            return False
-        return super().prepareAlgorithm(parameters, context, feedback)
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        distance = self.parameterAsDouble(parameters, self.DISTANCE, context)
+        accuracy = self.parameterAsDouble(parameters, self.ACCURACY, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        source_crs = source.sourceCrs()
+        if not source_crs.isGeographic():
+            raise QgsProcessingException('Layer CRS must be a Geograhpic CRS for this algorithm')
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.OUTPUT, context, source.fields(), QgsWkbTypes.Polygon, source_crs)
+
+        features = list(source.getFeatures())
+        wkbs = [bytes(feature.geometry().asWkb()) if feature.hasGeometry() else None for feature in features]
+        if workers > 1 and sys.platform == 'win32':
+            # Inside QGIS sys.executable is qgis.exe, the pool needs the bundled interpreter
+            multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+        buffers = equidistance_buffers(
+            wkbs, source_crs.authid() or source_crs.toWkt(), distance, accuracy, self.SEGMENTS, workers,
+            progress=lambda fraction: feedback.setProgress(90 * fraction))
 
-    def processFeature(self, feature, context, feedback):
-        geometry = feature.geometry()
-        # For point features, centroid() returns the point itself
-        centroid = geometry.centroid()
-        x = centroid.asPoint().x()
-        y = centroid.asPoint().y()
-        proj_string = 'PROJ4:+proj=aeqd +ellps=WGS84 +lat_0={} +lon_0={} +x_0=0 +y_0=0'.format(y, x)
-        dest_crs = QgsCoordinateReferenceSystem(proj_string)
-        xform = QgsCoordinateTransform(self.source_crs, dest_crs, QgsProject.instance())
-        geometry.transform(xform)
-        buffer = geometry.buffer(self.distance, self.SEGMENTS, self.END_CAP_STYLE, self.JOIN_STYLE, self.MITER_LIMIT)
-        buffer.transform(xform, QgsCoordinateTransform.ReverseTransform)
-        feature.setGeometry(buffer)
-        return [feature]
\ No newline at end of file
+        for feature, wkb in zip(features, buffers):
+            if feedback.isCanceled():
+                break
+            if wkb is not None:
+                geometry = QgsGeometry()
+                geometry.fromWkb(wkb)
+                feature.setGeometry(geometry)
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        feedback.setProgress(100)
+        return {self.OUTPUT: dest_id}
@@ -0,0 +1,26 @@
+import pytest
+
+from bench_suite import PIPELINES, run_pipeline
+from server import StandInServer
+
+
+@pytest.fixture(scope="module")
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.mark.parametrize("pipeline", list(PIPELINES))
+def test_every_fetcher_runs_against_the_fixtures(server, pipeline):
+    # The pipelines call the fetch functions of the scripts, a script that changes shape fails here
+    run = run_pipeline(pipeline, server, "small")
+    assert run.counts["features"] > 0
+    assert all(measurement["seconds"] >= 0 for measurement in run.stages.values())
+
+
+def test_recorded_stages_are_reported(server):
+    run = run_pipeline("roads", server, "small")
+    assert list(run.stages)[0] == "fetch"
+    assert {"first_byte", "transfer", "parse", "filter", "serialize"} <= set(run.stages)
+    # The stages interleave within the fetch, none can take longer than it
+    assert all(run.stages[name]["seconds"] <= run.stages["fetch"]["seconds"] for name in run.stages)
@@ -0,0 +1,65 @@
+import gzip
+import os
+import time
+
+import pytest
+
+from osm_pipeline.cache import OverpassCache
+
+DATA = b'{"elements": []}' * 100
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return OverpassCache(str(tmp_path / "overpass"))
+
+
+def test_responses_round_trip_gzipped(cache):
+    key = cache.key("[out:json][timeout:25];\n  node(1);  out;")
+    assert key == cache.key("[out:json]; node(1); out;")
+    cache.put(key, DATA)
+    with open(cache.path(key), "rb") as f:
+        assert gzip.decompress(f.read()) == DATA
+    assert cache.get(key) == DATA
+    # A truncated entry is a miss and goes away
+    with open(cache.path(key), "r+b") as f:
+        f.truncate(10)
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.path(key))
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_expired_entries_are_misses(cache):
+    cache.put("old", DATA)
+    downloaded = time.time() - cache.max_age - 1
+    os.utime(cache.path("old"), (time.time(), downloaded))
+    assert cache.get("old") is None
+    assert not os.path.exists(cache.path("old"))
+
+
+def test_least_recently_read_goes_first(tmp_path):
+    payloads = {key: os.urandom(1000) for key in "abcd"}
+    size = len(gzip.compress(payloads["a"]))
+    cache = OverpassCache(str(tmp_path / "overpass"), max_bytes=int(3.5 * size))
+    for key in "abc":
+        cache.put(key, payloads[key])
+    now = time.time()
+    # a is the newest download but the oldest read, b the oldest download but read since
+    os.utime(cache.path("a"), (now - 300, now))
+    os.utime(cache.path("b"), (now - 100, now - 1000))
+    os.utime(cache.path("c"), (now - 200, now - 500))
+    cache.put("d", payloads["d"])
+    assert sorted(entry.name[0] for entry in os.scandir(cache.cache_dir)) == ["b", "c", "d"]
+
+
+def test_directory_is_scanned_only_past_max_bytes(cache, monkeypatch):
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+    for i in range(5):
+        cache.put(str(i), DATA)
+    # The first put learns the size of the directory, the rest keep count
+    assert len(scans) == 1
+    cache.max_bytes = 3 * os.path.getsize(cache.path("0"))
+    cache.put("5", DATA)
+    assert len(scans) == 2 and len(os.listdir(cache.cache_dir)) == 3
@@ -0,0 +1,64 @@
+from osm_pipeline.compiler import compile_theme_ids, compile_themes, merge_types, merge_values, output_mode
+
+BBOX = (21.0, 52.2, 21.1, 52.3)
+SETTINGS = "[out:json][timeout:600][bbox:52.2,21.0,52.3,21.1];"
+GASTRONOMY = [
+    "(",
+    '  nwr["amenity"~"^restaurant$|^bar$|^pub$|^nightclub$|^cafe$|^fast_food$"];',
+    ")->.t_gastronomy;",
+]
+ROADS = '"primary|secondary|tertiary|motorway|trunk"'
+STRUCTURES = [
+    "(",
+    f'  way["highway"~{ROADS}]["tunnel"="yes"];',
+    f'  way["highway"~{ROADS}]["bridge"]["bridge"!="no"];',
+    '  way["construction"~"primary|secondary|tertiary|motorway|trunk|rail|subway|tram|light_rail"]["tunnel"="yes"];',
+    '  way["construction"~"primary|secondary|tertiary|motorway|trunk|rail|subway|tram|light_rail"]["bridge"]["bridge"!="no"];',
+    '  way["railway"~"rail|subway|tram|light_rail|construction"]["tunnel"="yes"];',
+    '  way["railway"~"rail|subway|tram|light_rail|construction"]["bridge"]["bridge"!="no"];',
+    ")->.t_structures;",
+]
+
+
+def test_gastronomy_folds_eighteen_clauses_into_one_statement():
+    # Six amenities on nodes, ways and relations: one regex union on nwr
+    query = compile_themes(["gastronomy"], BBOX, mode=output_mode(["gastronomy"]))
+    assert query.split("\n") == [SETTINGS, *GASTRONOMY, "(.t_gastronomy;)->.themes;", ".themes;", "out center qt;"]
+
+
+def test_structures_keep_their_regex_conditions_apart():
+    query = compile_themes(["structures"], BBOX, mode=output_mode(["structures"]))
+    assert query.split("\n") == [SETTINGS, *STRUCTURES, "(.t_structures;)->.themes;", ".themes;", "out geom qt;"]
+
+
+def test_themes_share_one_query_in_the_mode_of_the_costliest():
+    names = ["gastronomy", "structures"]
+    assert output_mode(names) == "geom"
+    query = compile_themes(names, BBOX, mode="body")
+    assert query.split("\n") == [
+        SETTINGS, *GASTRONOMY, *STRUCTURES, "(.t_gastronomy; .t_structures;)->.themes;", "(.themes; .themes >;);", "out body;"
+    ]
+
+
+def test_delta_and_id_queries():
+    newer = "2026-01-01T00:00:00Z"
+    query = compile_themes(["gastronomy"], BBOX, mode="center", meta=True, newer=newer).split("\n")
+    assert query[1] == f'node(newer:"{newer}")->.changed;'
+    assert query[5] == GASTRONOMY[1].replace("nwr[", "nwr.changed[")
+    assert query[-1] == "out meta center qt;"
+    assert compile_theme_ids(["gastronomy"], BBOX).split("\n")[-3:] == [
+        'make theme name="gastronomy";', "out;", ".t_gastronomy out ids qt;"
+    ]
+
+
+def test_merge_values_escapes_exact_values_and_keeps_patterns():
+    clauses = [("way", [("name", "=", "a.b")]), ("way", [("name", "~", "^c")]), ("way", [("name", "=", "a.b")])]
+    assert merge_values(clauses) == [("way", [("name", "~", "^a\\.b$|^c")])]
+    # Only clauses equal in everything else fold, other element types stay apart
+    clauses = [("way", [("a", "=", "1"), ("b", "exists", None)]), ("way", [("a", "=", "2")]), ("node", [("a", "=", "3")])]
+    assert merge_values(clauses) == clauses
+
+
+def test_merge_types_combines_element_types_of_equal_conditions():
+    clauses = [("node", [("a", "=", "1")]), ("relation", [("a", "=", "1")]), ("way", [("b", "exists", None)])]
+    assert merge_types(clauses) == [("nr", [("a", "=", "1")]), ("way", [("b", "exists", None)])]
@@ -0,0 +1,33 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from osm_pipeline.dissolve import _union_groups, dissolve_files
+
+
+def _squares(count, step=1.0):
+    return [shapely.box(i * step, 0, i * step + 1, 1) for i in range(count)]
+
+
+def test_union_groups_drops_null_keys():
+    values = np.array(["house", None, "house", 3, None], dtype=object)
+    geometries = np.array(_squares(5, step=0.5))
+    groups = _union_groups(values, geometries)
+    assert set(groups) == {"house", 3}
+    assert shapely.from_wkb(groups["house"]).area == 2.0
+
+
+def test_dissolve_files_matches_geopandas_with_null_keys(tmp_path):
+    buildings = ["house", None, "house", "garage", None, "garage"] * 20
+    gdf = gpd.GeoDataFrame({"building": buildings, "name": [f"b{i}" for i in range(len(buildings))]},
+                           geometry=_squares(len(buildings), step=0.8), crs="EPSG:2180")
+    source, output = tmp_path / "buildings.gpkg", tmp_path / "dissolved.gpkg"
+    gdf.to_file(source)
+
+    for streaming in (False, True):
+        counts = dissolve_files([(str(source), str(output))], max_workers=1, tile_features=10, streaming=streaming)
+        expected = gdf.dissolve(by="building")
+        result = gpd.read_file(output).set_index("building")
+        assert counts[str(source)] == len(expected) == 2
+        for value in expected.index:
+            assert abs(result.geometry[value].area - expected.geometry[value].area) < 1e-6
@@ -0,0 +1,80 @@
+import numpy as np
+
+from osm_pipeline.element_store import ElementStore
+
+
+def _node(osm_id, lon, lat, **tags):
+    return {"type": "node", "id": osm_id, "lon": lon, "lat": lat, "tags": tags}
+
+
+# Printed by quadtile rather than by id, with a node and a way the response does not hold
+ELEMENTS = [
+    _node(30, 3.0, 0.0),
+    _node(10, 1.0, 0.0, amenity="bench"),
+    _node(40, 4.0, 0.0),
+    _node(20, 2.0, 0.0),
+    {"type": "way", "id": 200, "nodes": [10, 99, 20], "tags": {"highway": "footway", "name": "Aleja"}},
+    {"type": "way", "id": 100, "nodes": [20, 30, 40], "tags": {"highway": "service"}},
+    {"type": "way", "id": 300, "nodes": [99, 40], "tags": {"highway": "footway", "name": "Brzozowa"}},
+    {"type": "relation", "id": 7, "tags": {"type": "multipolygon"}, "members": [
+        {"type": "way", "ref": 100, "role": "outer"},
+        {"type": "way", "ref": 999, "role": "outer"},
+        {"type": "node", "ref": 10, "role": "label"},
+        {"type": "way", "ref": 200, "role": "inner"},
+    ]},
+]
+
+
+def _store():
+    return ElementStore.from_elements(iter(ELEMENTS))
+
+
+def test_elements_are_sorted_by_id_with_their_tags_and_refs():
+    store = _store()
+    assert store.ids["node"].tolist() == [10, 20, 30, 40]
+    assert store.node_xy[:, 0].tolist() == [1.0, 2.0, 3.0, 4.0]
+    assert store.ids["way"].tolist() == [100, 200, 300]
+    assert store.way_node_refs(1).tolist() == [10, 99, 20]
+    assert store.element_tags("way", 1) == {"highway": "footway", "name": "Aleja"}
+    assert store.tag_values("way", "name").tolist() == [None, "Aleja", "Brzozowa"]
+    assert store.tag_values("node", "amenity", "").tolist() == ["bench", "", "", ""]
+
+
+def test_index_marks_unknown_ids():
+    store = _store()
+    assert store.index("node", [40, 10, 15, 5, 50]).tolist() == [3, 0, -1, -1, -1]
+    assert store.index("relation", [7, 8]).tolist() == [0, -1]
+    assert ElementStore().index("way", [1, 2]).tolist() == [-1, -1]
+
+
+def test_way_coords_leave_out_missing_nodes():
+    store = _store()
+    xy, offsets = store.way_coords()
+    assert offsets.tolist() == [0, 3, 5, 6]
+    assert xy[:, 0].tolist() == [2.0, 3.0, 4.0, 1.0, 2.0, 4.0]
+    xy, offsets = store.way_coords([2, 0])
+    assert offsets.tolist() == [0, 1, 4]
+    # One node left of way 300, too few for a line
+    lines, rows = store.linestrings()
+    assert rows.tolist() == [0, 1] and [line.length for line in lines] == [2.0, 1.0]
+
+
+def test_relation_ways_skip_missing_ways_and_nodes():
+    store = _store()
+    assert store.relation_members(0)[1:3] == [("way", 999, "outer"), ("node", 10, "label")]
+    members = store.relation_ways(0)
+    assert [(role, refs) for role, _, refs in members] == [("outer", [20, 30, 40]), ("inner", [10, 20])]
+    assert members[1][1] == [[1.0, 0.0], [2.0, 0.0]]
+
+
+def test_theme_mask_ors_the_clauses_of_its_kind():
+    store = _store()
+    theme = {"filters": [
+        ("way", [("highway", "=", "footway"), ("name", "~", "^A")]),
+        ("way", [("highway", "=", "service")]),
+        ("node", [("highway", "exists", None)]),
+    ]}
+    assert store.theme_mask(theme, "way").tolist() == [True, True, False]
+    assert not store.theme_mask(theme, "node").any()
+    # An absent key is not equal to anything
+    assert np.array_equal(store.match("node", [("amenity", "!=", "bench")]), [False, True, True, True])
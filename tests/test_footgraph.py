@@ -0,0 +1,77 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, Polygon, shape
+
+from osm_pipeline import footgraph
+from osm_pipeline.footgraph import FootGraph, compute_isochrones
+from osm_pipeline.isochrones import IsochroneJournal
+from osm_pipeline.lengths import EARTH_RADIUS
+
+SIZE = 15  # nodes per side of the grid
+STEP = math.degrees(100 / EARTH_RADIUS)  # 100 m at the equator, 72 s of walking
+
+
+def _grid_ways(size=SIZE):
+    """Footways along every row and column of a size x size grid at the equator."""
+    def node(i, j):
+        return i * size + j + 1, (i * STEP, j * STEP)
+
+    for i in range(size):
+        yield tuple(zip(*(node(i, j) for j in range(size))))
+        yield tuple(zip(*(node(j, i) for j in range(size))))
+
+
+@pytest.fixture
+def graph():
+    # A two-node path next to the grid, its nodes closer to the stray stop than any grid node
+    fragment = ((1001, 1002), ((-3 * STEP, 7 * STEP), (-3.5 * STEP, 7 * STEP)))
+    return FootGraph.from_ways(list(_grid_ways()) + [fragment])
+
+
+def test_graph_is_csr_without_duplicate_edges(graph):
+    assert len(graph) == SIZE * SIZE + 2
+    # Every grid edge both ways: 2 directions x 2 orientations x size rows of size - 1 edges, plus the fragment
+    assert len(graph.indices) == 4 * SIZE * (SIZE - 1) + 2
+    # 72 s per 100 m block, 36 s for the 50 m fragment
+    expected = [36.0] * 2 + [72.0] * (len(graph.weights) - 2)
+    assert np.allclose(np.sort(graph.weights), expected, rtol=1e-3)
+
+
+def test_search_reaches_the_diamond_of_the_time_limit(graph):
+    footgraph._init_worker(graph.xy, graph.indptr, graph.indices, graph.weights)
+    center = graph.nearest([7 * STEP], [7 * STEP])[0]
+    # 480 s is 666 m: six 100 m blocks in every direction, not seven
+    [polygon] = footgraph._search([center], 480.0)
+    polygon = shape(polygon)
+    diamond = Polygon([(1 * STEP, 7 * STEP), (7 * STEP, 1 * STEP), (13 * STEP, 7 * STEP), (7 * STEP, 13 * STEP)])
+    assert polygon.convex_hull.symmetric_difference(diamond).area < 1e-6 * diamond.area
+    reached = [(i, j) for i in range(SIZE) for j in range(SIZE) if abs(i - 7) + abs(j - 7) <= 6]
+    assert len(reached) == 85
+    assert all(polygon.buffer(1e-9).covers(Point(i * STEP, j * STEP)) for i, j in reached)
+
+
+def test_stops_do_not_snap_to_a_fragment(graph):
+    fragment_nodes = np.flatnonzero(~graph.snappable())
+    assert len(fragment_nodes) == 2
+    # Nearest to the fragment, yet snapped to the grid's edge
+    assert graph.nearest([-2.9 * STEP], [7 * STEP])[0] == 7  # node (0, 7), numbered in way order
+
+
+def test_compute_isochrones_journals_every_stop(graph, tmp_path):
+    stops = pd.DataFrame({
+        "id": [1, 2],
+        "railway": ["tram", "tram"],
+        "longitude": [7 * STEP, -2.9 * STEP],
+        "latitude": [7 * STEP, 7 * STEP],
+    })
+    with IsochroneJournal(str(tmp_path / "journal.sqlite")) as journal:
+        assert compute_isochrones(stops, journal, graph, max_workers=1) == 2
+        assert journal.done() == {1, 2}
+        areas = {row["id"]: row["geometry"].area for row in journal.rows()}
+        # Another run has nothing left to do
+        assert compute_isochrones(stops, journal, graph, max_workers=1) == 0
+    # The stop at the grid's edge reaches half a diamond, not a two-node sliver
+    assert areas[2] > 0.3 * areas[1]
@@ -0,0 +1,88 @@
+import overpy
+import pytest
+import shapely
+
+from osm_pipeline import frames
+from osm_pipeline.frames import Frame, fetch_root
+from osm_pipeline.streaming import iter_inline
+
+THEMES = {"lines": {"filters": [("way", [("highway", "exists", None)])], "geometry": "line",
+                    "properties": {"highway": ("highway", None)}}}
+# Horizontal ways across the root at y = 0.5, 1.5, ..., each from x = 0.1 to 3.9
+WAYS = [{"type": "way", "id": i, "tags": {"highway": "primary"},
+         "geometry": [{"lon": 0.1, "lat": i + 0.5}, {"lon": 3.9, "lat": i + 0.5}]} for i in range(4)]
+
+
+class _Writer:
+    def __init__(self):
+        self.features = []
+
+    def write(self, feature):
+        self.features.append(feature)
+
+
+class _Writers:
+    def __init__(self):
+        self.writers = {}
+
+    def get(self, frame, theme, fields=None, geometry_type="GEOMETRY"):
+        return self.writers.setdefault((frame, theme), _Writer())
+
+
+def _fake_stream_query(fail=lambda bbox: None):
+    def stream_query(query, bbox=None, max_retries=5, inline=False, **kwargs):
+        error = fail(bbox)
+        if error is not None:
+            raise error
+        minx, miny, maxx, maxy = bbox
+        tile = shapely.box(minx, miny, maxx, maxy)
+        elements = [way for way in WAYS if shapely.intersects(
+            tile, shapely.linestrings([(p["lon"], p["lat"]) for p in way["geometry"]]))]
+        return iter_inline(iter(elements))
+    return stream_query
+
+
+@pytest.fixture
+def plan_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(frames, "DEFAULT_PLAN_DIR", str(tmp_path))
+
+
+def _frames():
+    root = Frame("Aglomeracje", "root", shapely.box(0, 0, 4, 4))
+    inner = Frame("Miasta", "inner", shapely.box(1, 1, 3, 3))
+    return root, [root, inner]
+
+
+def test_root_timeout_is_split_and_features_are_clipped(monkeypatch, plan_dir):
+    root, members = _frames()
+    monkeypatch.setattr(frames, "stream_query", _fake_stream_query(
+        lambda bbox: overpy.exception.OverpassGatewayTimeout() if bbox == root.bbox else None))
+    writers = _Writers()
+    counts, failed = fetch_root(root, members, ["lines"], writers, themes=THEMES, max_workers=1)
+    assert failed == {}
+    # Every way once in the root, the two crossing the inner frame cut to it
+    assert counts == {"Aglomeracje/root": {"lines": 4}, "Miasta/inner": {"lines": 2}}
+    inner = [shapely.geometry.shape(f["geometry"]) for f in writers.writers[("Miasta/inner", "lines")].features]
+    assert all(shapely.equals_exact(line, shapely.box(1, 1, 3, 3).intersection(line), 1e-9) for line in inner)
+    assert [line.bounds[0] for line in inner] == [1.0, 1.0]
+
+
+def test_failed_tiles_fall_back_to_the_frames_they_touch(monkeypatch, plan_dir):
+    root, members = _frames()
+    calls = []
+
+    def fail(bbox):
+        calls.append(bbox)
+        if bbox == root.bbox:
+            return overpy.exception.OverpassGatewayTimeout()
+        if bbox == (2.0, 2.0, 4.0, 4.0):  # the NE quadrant keeps failing
+            return overpy.exception.OverpassTooManyRequests()
+        return None
+
+    monkeypatch.setattr(frames, "stream_query", _fake_stream_query(fail))
+    counts, failed = fetch_root(root, members, ["lines"], _Writers(), themes=THEMES, max_workers=1)
+    # Both frames touch the failed quadrant and are fetched again, the root failing once more
+    assert (1, 1, 3, 3) in calls
+    assert list(failed) == ["Aglomeracje/root"]
+    # Nothing is written twice: the ways of the other quadrants were written by the root pass
+    assert counts == {"Aglomeracje/root": {"lines": 4}, "Miasta/inner": {"lines": 2}}
@@ -0,0 +1,59 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+
+from osm_pipeline.generalize import generalize_geometries
+
+
+def _building_grid(side=60, size=8.0, gap=3.0):
+    """A dense grid of small square buildings in metres, gap apart."""
+    step = size + gap
+    return np.array([shapely.box(i * step, j * step, i * step + size, j * step + size)
+                     for i in range(side) for j in range(side)])
+
+
+def _blocks(tile_features):
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        return generalize_geometries(executor, _building_grid(), True, (25000, 200000), tile_features)
+
+
+def test_aggregated_blocks_do_not_depend_on_tiling():
+    whole, tiled = _blocks(10 ** 9), _blocks(200)
+    for scale in (25000, 200000):
+        whole_sources, whole_geometries = whole[scale]
+        tiled_sources, tiled_geometries = tiled[scale]
+        assert len(tiled_geometries) == len(whole_geometries)
+        assert abs(shapely.area(tiled_geometries).sum() - shapely.area(whole_geometries).sum()) < 1.0
+    # At 1:200k the whole grid is one block, no cuts along tile lines
+    sources, geometries = tiled[200000]
+    assert len(geometries) == 1 and sources[0] == -1
+    assert shapely.get_num_interior_rings(shapely.get_parts(geometries)).sum() == 0
+
+
+def test_large_polygons_keep_their_source_rows():
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        levels = generalize_geometries(executor, np.array([shapely.box(0, 0, 500, 500)]), True, (25000,))
+    sources, geometries = levels[25000]
+    assert sources.tolist() == [0] and shapely.area(geometries[0]) == 250000
+
+
+def test_neighbours_keep_their_shared_edge():
+    # Two parcels split along a curve with jags under the 2.5 m tolerance of 1:25k
+    edge = [(100 + 3 * math.sin(math.pi * y / 100) + (0.5 if y % 4 else 0.0), float(y)) for y in range(0, 101, 2)]
+    west = shapely.Polygon([(0, 100), (0, 0)] + edge)
+    # The ring of the east parcel starts half way along the edge, where simplified on its own it bends elsewhere
+    ring = edge[::-1] + [(200, 0), (200, 100)]
+    east = shapely.Polygon(ring[13:] + ring[:13])
+    # An overlapping pair is no coverage, it is simplified polygon by polygon
+    overlapping = [shapely.box(0, 300, 100, 400), shapely.box(50, 350, 150, 450)]
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        levels = generalize_geometries(executor, np.array([west, east] + overlapping), True, (25000,), 2)
+    sources, geometries = levels[25000]
+    assert sorted(sources.tolist()) == [0, 1, 2, 3]
+    parcels = geometries[np.argsort(sources)][:2]
+    assert shapely.get_num_coordinates(parcels).sum() < shapely.get_num_coordinates(np.array([west, east])).sum()
+    # No slivers or overlaps along the simplified edge
+    assert shapely.coverage_is_valid(parcels)
+    assert abs(shapely.area(parcels).sum() - 20000) < 1e-6
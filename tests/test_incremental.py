@@ -0,0 +1,79 @@
+import os
+
+import pyogrio
+import pytest
+
+from osm_pipeline.cache import OverpassCache
+from osm_pipeline.incremental import SyncState, refresh_frame
+from osm_pipeline.scheduler import EndpointLimiter
+from osm_pipeline.writers import GeoPackage
+from server import StandInServer
+
+BBOX = (21.00, 52.225, 21.03, 52.24)
+
+
+def _node(osm_id, version, name, amenity="cafe"):
+    return {"type": "node", "id": osm_id, "lat": 52.23, "lon": 21.01 + osm_id / 1000, "version": version,
+            "timestamp": f"2026-01-0{version}T00:00:00Z", "tags": {"amenity": amenity, "name": name}}
+
+
+def _response(timestamp, elements):
+    return {"version": 0.6, "osm3s": {"timestamp_osm_base": timestamp}, "elements": elements}
+
+
+def _ids(*osm_ids):
+    theme = {"type": "theme", "id": 1, "tags": {"name": "gastronomy"}}
+    return _response("2026-02-01T00:00:00Z", [theme] + [{"type": "node", "id": osm_id} for osm_id in osm_ids])
+
+
+@pytest.fixture
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+def _refresh(server, gpkg):
+    options = {
+        "url": server.overpass_url("small", "gastronomy"),
+        "cache": OverpassCache(os.path.join(os.path.dirname(gpkg.path), "overpass")),
+        "limiter": EndpointLimiter(rate=1e6, capacity=1e6),
+    }
+    return refresh_frame(BBOX, "Test", ["gastronomy"], gpkg, max_retries=0, **options)["gastronomy"]
+
+
+def _names(gpkg):
+    table = pyogrio.read_dataframe(gpkg.path, layer="gastronomy", read_geometry=False)
+    return dict(zip(table["osm_id"], table["name"]))
+
+
+def test_delta_replaces_changed_and_drops_deleted_elements(server, tmp_path):
+    with GeoPackage(str(tmp_path / "Test.gpkg")) as gpkg:
+        server.respond("overpass", _response("2026-01-10T00:00:00Z", [_node(1, 1, "A"), _node(2, 1, "B"), _node(3, 1, "C")]))
+        assert _refresh(server, gpkg) == {"added": 3, "modified": 0, "deleted": 0}
+        state = SyncState(gpkg)
+        assert state.synced_at("gastronomy") == "2026-01-10T00:00:00Z"
+
+        # 2 renamed, 3 deleted, 4 new; 1 comes from a mirror that has not caught up with the last sync
+        server.respond("overpass", _response("2026-02-01T00:00:00Z", [_node(1, 0, "stale"), _node(2, 2, "B2"), _node(4, 1, "D")]))
+        server.respond("overpass", _ids(1, 2, 4))
+        assert _refresh(server, gpkg) == {"added": 1, "modified": 1, "deleted": 1}
+        assert _names(gpkg) == {1: "A", 2: "B2", 4: "D"}
+        assert state.versions("gastronomy") == {("node", 1): 1, ("node", 2): 2, ("node", 4): 1}
+        assert state.synced_at("gastronomy") == "2026-02-01T00:00:00Z"
+    assert server.requests["overpass"] == 3
+
+
+def test_layer_without_key_columns_is_synced_from_scratch(server, tmp_path):
+    with GeoPackage(str(tmp_path / "Test.gpkg")) as gpkg:
+        # Synced once, then rewritten by a full fetch without the OSM id columns
+        SyncState(gpkg).save("gastronomy", "2026-01-10T00:00:00Z", {("node", 1): (1, None)})
+        with gpkg.layer("gastronomy", geometry_type="Point") as layer:
+            layer.write({"type": "Feature", "geometry": {"type": "Point", "coordinates": [21.01, 52.23]},
+                         "properties": {"amenity": "cafe", "name": "A"}})
+        assert SyncState(gpkg).synced_at("gastronomy") is None
+        server.respond("overpass", _response("2026-02-01T00:00:00Z", [_node(1, 1, "A"), _node(2, 1, "B")]))
+        assert _refresh(server, gpkg) == {"added": 2, "modified": 0, "deleted": 0}
+        assert _names(gpkg) == {1: "A", 2: "B"}
+        assert SyncState(gpkg).versions("gastronomy") == {("node", 1): 1, ("node", 2): 1}
+    # One full query, no delta and no id listing
+    assert server.requests["overpass"] == 1
@@ -0,0 +1,52 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+
+import pytest
+
+from osm_pipeline.instrumentation import Recorder
+
+
+def _work(recorder, parent, results, index):
+    with recorder.span("tile", str(index), parent=parent):
+        with recorder.stage("parse"):
+            results[index] = sum(i * i for i in range(20000))
+
+
+@pytest.mark.skipif(sys.version_info >= (3, 12), reason="one cProfile per process on sys.monitoring")
+def test_cprofile_with_spans_in_worker_threads(tmp_path):
+    recorder = Recorder(cprofile=True, profile_dir=str(tmp_path))
+    results = [None] * 4
+    with recorder.span("frame", "test") as frame:
+        with recorder.stage("download"):
+            threads = [threading.Thread(target=_work, args=(recorder, frame, results, i)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    assert all(result is not None for result in results)
+    assert recorder.summary()["tile"]["count"] == 4
+    # One profile per label and thread, merged per label when dumped
+    assert sorted({label for label, _ in recorder._profiles}) == ["frame", "stage-download", "stage-parse", "tile"]
+    paths = recorder.dump_profiles()
+    assert sorted(os.path.basename(path) for path in paths) == [
+        "frame.prof", "stage-download.prof", "stage-parse.prof", "tile.prof"]
+    # The workers' sums are in their stage, not in the span around it
+    calls = {label: {function[2] for function in pstats.Stats(path).stats}
+             for label, path in ((os.path.basename(path)[:-5], path) for path in paths)}
+    assert "<genexpr>" in calls["stage-parse"]
+    assert "<genexpr>" not in calls["tile"]
+
+
+def test_cprofile_next_to_an_outside_profiler(tmp_path):
+    recorder = Recorder(cprofile=True, profile_dir=str(tmp_path))
+    outside = cProfile.Profile()
+    outside.enable()
+    try:
+        with recorder.span("frame", "test"), recorder.stage("parse"):
+            sum(range(1000))
+    finally:
+        outside.disable()
+    assert recorder.summary()["frame"]["count"] == 1
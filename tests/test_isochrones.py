@@ -0,0 +1,122 @@
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import pdist
+
+from fixtures import load_isochrones
+from osm_pipeline.isochrones import (
+    METRES_PER_DEGREE, IsochroneCache, IsochroneJournal, RateLimitPacer, cluster_labels, coalesce_stops, fetch_isochrones,
+)
+from server import StandInServer
+
+
+@pytest.fixture
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.fixture
+def stops():
+    return pd.DataFrame(load_isochrones("small")[0])
+
+
+def test_clusters_stay_within_the_radius():
+    # Stops every 30 m along a street at the equator, and a pair of platforms 5 m apart off it
+    longitude = np.append(np.arange(10) * 30.0, [500.0, 505.0]) / METRES_PER_DEGREE
+    latitude = np.zeros(12)
+    labels = cluster_labels(longitude, latitude, 50)
+    # A chain is not one cluster: at most two consecutive stops fit within 50 m
+    assert len(np.unique(labels[:10])) >= 5
+    for label in np.unique(labels):
+        members = longitude[labels == label] * METRES_PER_DEGREE
+        assert len(members) == 1 or pdist(members[:, None]).max() <= 50
+    assert labels[10] == labels[11]
+    assert labels[10] not in labels[:10]
+
+
+def test_pacer_spreads_the_spare_credits_over_the_window():
+    pacer = RateLimitPacer(reserve=150, min_interval=0.0)
+    pacer.update({"X-RateLimit-Remaining": "160", "X-RateLimit-Reset": "1"})
+    assert pacer.interval == pytest.approx(0.1)
+    start = time.monotonic()
+    assert pacer.wait() and pacer.wait() and pacer.wait()
+    assert time.monotonic() - start >= 0.2
+    # Without a reset header the last interval holds
+    pacer.update({"X-RateLimit-Remaining": "155"})
+    assert pacer.interval == pytest.approx(0.1) and pacer.remaining == 155
+
+
+def test_pacer_stops_at_the_reserve():
+    pacer = RateLimitPacer(reserve=150)
+    pacer.update({"X-RateLimit-Remaining": "150", "X-RateLimit-Reset": "60"})
+    assert pacer.exhausted
+    assert not pacer.wait()
+
+
+def test_pacer_pause_delays_the_next_slot():
+    pacer = RateLimitPacer(min_interval=0.0)
+    pacer.pause(0.2)
+    start = time.monotonic()
+    assert pacer.wait()
+    assert time.monotonic() - start >= 0.2
+
+
+def test_journal_survives_reopening(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    polygon = {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]]}
+    with IsochroneJournal(path) as journal:
+        journal.record(1, "tram", 480, [polygon])
+        journal.record(2, "train", 900, [polygon, polygon])
+        # A stop fetched again replaces its row
+        journal.record(1, "tram", 480, [polygon])
+    with IsochroneJournal(path) as journal:
+        assert journal.done() == {1, 2}
+        assert [(row["id"], row["railway"]) for row in journal.rows()] == [(1, "tram"), (2, "train"), (2, "train")]
+        assert journal.export(str(tmp_path / "isochrones.gpkg")) == 3
+
+
+def test_run_stopped_by_the_rate_limit_resumes_where_it_left_off(server, stops, tmp_path):
+    url = server.graphhopper_url("small")
+    requests = len(coalesce_stops(stops))
+    server.credits = 150 + 5
+    cache = IsochroneCache(str(tmp_path / "cache.sqlite"))
+    with IsochroneJournal(str(tmp_path / "journal.sqlite")) as journal:
+        first = fetch_isochrones(stops, journal, "key", url, max_workers=1, pacer=RateLimitPacer(min_interval=0.0),
+                                 cache=cache)
+        # The answer that reports the reserve is still journaled, then nothing more is sent
+        assert server.requests["graphhopper"] == 5
+        assert 5 <= first < len(stops)
+
+        server.credits = 100000
+        second = fetch_isochrones(stops, journal, "key", url, max_workers=2, pacer=RateLimitPacer(min_interval=0.0),
+                                  cache=cache)
+        assert first + second == len(stops)
+        assert journal.done() == set(stops["id"])
+        # Every cluster was requested exactly once over both runs
+        assert server.requests["graphhopper"] == requests
+        output = str(tmp_path / "isochrones.gpkg")
+        assert journal.export(output) == len(stops)
+    assert len(gpd.read_file(output)) == len(stops)
+    cache.close()
+
+
+def test_failed_requests_are_fetched_by_the_next_run(server, stops, tmp_path):
+    url = server.graphhopper_url("small")
+    server.fail("graphhopper", 429)
+    server.fail("graphhopper", 500)
+    cache = IsochroneCache(str(tmp_path / "cache.sqlite"))
+    with IsochroneJournal(str(tmp_path / "journal.sqlite")) as journal:
+        pacer = RateLimitPacer(min_interval=0.0)
+        first = fetch_isochrones(stops, journal, "key", url, max_workers=1, pacer=pacer, error_pause=0.1, cache=cache)
+        assert first < len(stops)
+        assert not pacer.exhausted
+        second = fetch_isochrones(stops, journal, "key", url, max_workers=1, pacer=RateLimitPacer(min_interval=0.0),
+                                  cache=cache)
+        assert first + second == len(stops)
+        # Only the two failed clusters were asked again
+        assert server.requests["graphhopper"] == len(coalesce_stops(stops)) + 2
+    cache.close()
@@ -0,0 +1,26 @@
+import math
+
+from osm_pipeline.lengths import EARTH_RADIUS
+from osm_pipeline.multitheme import drop_short
+
+METRE = math.degrees(1 / EARTH_RADIUS)  # at the equator
+THEMES = {"structures": {"min_length": 50}, "bridges": {"min_length": 10}, "roads": {}}
+
+
+def _line(metres):
+    return {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [(0.0, 0.0), (metres * METRE, 0.0)]}}
+
+
+def test_drop_short_measures_lines_in_batches():
+    items = [
+        ("structures", 1, [_line(60), _line(40)]),
+        ("roads", 2, [_line(5)]),
+        ("bridges", 3, [_line(40)]),
+        ("structures", 4, []),
+        ("structures", 5, [_line(49)]),
+    ]
+    # Two items a batch: the threshold of every line is its own theme's
+    kept = list(drop_short(items, THEMES, batch_size=2))
+    assert sorted((item[1], len(item[-1])) for item in kept) == [(1, 1), (2, 1), (3, 1), (4, 0), (5, 0)]
+    [(_, _, [long_line])] = [item for item in kept if item[1] == 1]
+    assert long_line["geometry"]["coordinates"][1][0] == 60 * METRE
@@ -0,0 +1,39 @@
+import json
+
+from shapely.geometry import box
+
+from osm_pipeline.pbf import extract_frames, split_frames
+from osm_pipeline.themes import THEMES
+
+# Four frames in a row, a cafe in each and one on the seam of the middle two
+FRAMES = [(f"Arkusze_Test/{i}", box(i, 0, i + 1, 1)) for i in range(4)]
+CAFES = [(0.5, 0.5), (1.5, 0.5), (2.0, 0.5), (2.5, 0.5), (3.5, 0.5), (9.5, 0.5)]
+
+
+def _extract(tmp_path):
+    nodes = "\n".join(
+        f'<node id="{i + 1}" version="1" lat="{lat}" lon="{lon}"><tag k="amenity" v="cafe"/></node>'
+        for i, (lon, lat) in enumerate(CAFES)
+    )
+    path = tmp_path / "test.osm"
+    path.write_text(f'<?xml version="1.0"?>\n<osm version="0.6">\n{nodes}\n</osm>\n')
+    return str(path)
+
+
+def test_groups_of_frames_write_what_one_pass_writes(tmp_path):
+    path = _extract(tmp_path)
+    themes = {"gastronomy": THEMES["gastronomy"]}
+    whole = extract_frames(path, FRAMES, themes, "geojson", str(tmp_path / "whole"))
+    groups = split_frames(FRAMES, 2)
+    assert [[name for name, _ in group] for group in groups] == [[name for name, _ in FRAMES[:2]], [name for name, _ in FRAMES[2:]]]
+    split = {}
+    for group in groups:
+        split.update(extract_frames(path, group, themes, "geojson", str(tmp_path / "split")))
+    assert split == whole == {
+        ("Arkusze_Test/0", "gastronomy"): 1,
+        ("Arkusze_Test/1", "gastronomy"): 2,
+        ("Arkusze_Test/2", "gastronomy"): 2,
+        ("Arkusze_Test/3", "gastronomy"): 1,
+    }
+    with open(tmp_path / "split" / "Arkusze_Test" / "gastronomy_2.geojson") as f:
+        assert [feature["geometry"]["coordinates"] for feature in json.load(f)["features"]] == [[2.0, 0.5], [2.5, 0.5]]
@@ -0,0 +1,50 @@
+from osm_pipeline.rings import assemble_multipolygon, join_ways
+
+
+def _way(*refs):
+    """A way over nodes numbered around a grid: node n sits at (n % 10, n // 10)."""
+    return list(refs), [(ref % 10, ref // 10) for ref in refs]
+
+
+def _member(role, *refs):
+    refs, coords = _way(*refs)
+    return role, coords, refs
+
+
+def test_ways_join_whatever_their_direction():
+    # A square drawn in three pieces, the middle one reversed and listed last
+    rings, broken = join_ways([_way(0, 5), _way(55, 50, 0), _way(55, 5)])
+    assert broken == []
+    [ring] = rings
+    assert ring[0] == ring[-1] and len(ring) == 5
+    assert sorted(set(ring)) == [(0, 0), (0, 5), (5, 0), (5, 5)]
+
+
+def test_unclosed_chains_are_broken():
+    rings, broken = join_ways([_way(0, 5, 55), _way(60, 66), _way(70, 77, 7, 70)])
+    assert len(rings) == 1
+    assert sorted(broken) == [[0, 5, 55], [60, 66]]
+    # Two nodes back and forth is no ring
+    rings, broken = join_ways([_way(0, 5), _way(5, 0)])
+    assert rings == [] and broken == [[0, 5, 0]]
+
+
+def test_inner_rings_go_to_the_smallest_outer_around_them():
+    members = [
+        _member("outer", 0, 9, 99, 90, 0),  # 9 x 9
+        _member("outer", 22, 27, 77, 72, 22),  # 5 x 5 inside the hole of the first
+        _member("inner", 11, 18, 88, 81),
+        _member("inner", 81, 11),  # closes the first hole, 7 x 7
+        _member("inner", 33, 35, 55, 53, 33),  # 2 x 2, inside the small outer
+        _member("outer", 200, 201, 211),  # broken
+    ]
+    geometry, broken = assemble_multipolygon(members)
+    assert broken == [[200, 201, 211]]
+    big, small = sorted(geometry.geoms, key=lambda polygon: -polygon.area)
+    assert big.area == 81 - 49 and len(big.interiors) == 1
+    assert small.area == 25 - 4 and len(small.interiors) == 1
+
+
+def test_relation_without_outer_ring_has_no_geometry():
+    geometry, broken = assemble_multipolygon([_member("inner", 0, 5, 55, 50, 0), _member("outer", 0, 5)])
+    assert geometry is None and broken == [[0, 5]]
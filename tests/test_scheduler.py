@@ -0,0 +1,105 @@
+import time
+
+import overpy
+import pytest
+
+from osm_pipeline import scheduler
+from osm_pipeline.scheduler import EndpointLimiter, TokenBucket, call_with_backoff, parse_slot_wait
+from server import StandInServer
+
+QUERY = "[out:json];way(52.225,21.00,52.24,21.03);out body;"
+
+
+class _PauseLog(EndpointLimiter):
+    def __init__(self):
+        super().__init__()
+        self.pauses = []
+
+    def pause(self, endpoint, seconds):
+        self.pauses.append((endpoint, seconds))
+
+
+@pytest.fixture
+def server():
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff sleeps are recorded instead of slept."""
+    slept = []
+    monkeypatch.setattr(scheduler.time, "sleep", slept.append)
+    return slept
+
+
+def _query(server):
+    return lambda: overpy.Overpass(url=server.overpass_url("small", "water_bodies")).query(QUERY)
+
+
+def test_parse_slot_wait():
+    assert parse_slot_wait("Rate limit: 2\n2 slots available now.\n") == 0
+    assert parse_slot_wait("Rate limit: 2\n1 slot available now.\n") == 0
+    status = (
+        "Rate limit: 2\n"
+        "Slot available after: 2024-05-01T10:00:41Z, in 41 seconds.\n"
+        "Slot available after: 2024-05-01T10:00:12Z, in 12 seconds.\n"
+    )
+    assert parse_slot_wait(status) == 12
+    # A slot that freed up while the page was served
+    assert parse_slot_wait("Slot available after: 2024-05-01T10:00:00Z, in -3 seconds.\n") == 0
+    assert parse_slot_wait("<html>Service unavailable</html>") is None
+
+
+def test_token_bucket_spends_the_burst_then_paces():
+    bucket = TokenBucket(rate=20, capacity=2)
+    start = time.monotonic()
+    bucket.acquire()
+    bucket.acquire()
+    assert time.monotonic() - start < 0.04
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.04
+
+
+def test_token_bucket_pause_holds_everyone_back():
+    bucket = TokenBucket(rate=20, capacity=2)
+    bucket.pause(0.2)
+    start = time.monotonic()
+    bucket.acquire()
+    # 0.2 s of pause plus the time for one token
+    assert time.monotonic() - start >= 0.2
+
+
+def test_too_many_requests_waits_for_the_next_slot(server, sleeps):
+    server.fail("overpass", 429)
+    server.status_text = "Rate limit: 2\nSlot available after: 2024-05-01T10:00:30Z, in 30 seconds.\n"
+    limiter = _PauseLog()
+    endpoint = server.overpass_status_endpoint
+    result = call_with_backoff(_query(server), endpoint=endpoint, base_delay=1.0, limiter=limiter)
+    assert result.ways
+    assert server.requests["overpass"] == 2
+    # The wait comes from /status, not the exponential backoff, and pauses the endpoint for every worker
+    [(paused_endpoint, delay)] = limiter.pauses
+    assert paused_endpoint == endpoint
+    assert 30 <= delay <= 31
+    assert sleeps == [delay]
+
+
+def test_gateway_timeout_backs_off_until_retries_run_out(server, sleeps):
+    server.fail("overpass", 504, times=3)
+    limiter = _PauseLog()
+    with pytest.raises(overpy.exception.OverpassGatewayTimeout):
+        call_with_backoff(_query(server), endpoint=server.overpass_status_endpoint, max_retries=2,
+                          base_delay=1.0, max_delay=3.0, limiter=limiter)
+    assert server.requests["overpass"] == 3
+    assert len(sleeps) == 2
+    # Full jitter under the exponential cap of every attempt
+    assert 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+
+
+def test_gateway_timeout_recovers(server, sleeps):
+    server.fail("overpass", 504, times=2)
+    result = call_with_backoff(_query(server), endpoint=server.overpass_status_endpoint, base_delay=0.0,
+                               limiter=_PauseLog())
+    assert result.ways
+    assert server.requests["overpass"] == 3
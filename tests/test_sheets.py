@@ -0,0 +1,37 @@
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+from osm_pipeline import atlas, frames, multitheme
+from osm_pipeline.sheets import read_sheet
+
+
+@pytest.fixture
+def sheet_path(tmp_path):
+    # Three frames in the Polish grid, the second and third without a usable English name
+    gdf = gpd.GeoDataFrame(
+        {"Name_EN": ["Warsaw", None, ""], "City_Name": ["Warszawa", "Kraków", "Łódź"]},
+        geometry=[box(630000, 480000, 640000, 490000), box(560000, 240000, 570000, 250000),
+                  box(530000, 410000, 540000, 420000)],
+        crs="EPSG:2180",
+    )
+    path = tmp_path / "Arkusze_Test.shp"
+    gdf.to_file(path)
+    return path
+
+
+def test_read_sheet_names_and_reprojects(sheet_path):
+    sheet = read_sheet(sheet_path)
+    assert [name for name, _ in sheet] == ["Warsaw", "1", "2"]
+    minx, miny, maxx, maxy = sheet[0][1].bounds
+    assert 20 < minx < maxx < 22 and 52 < miny < maxy < 53
+
+
+def test_every_backend_names_frames_alike(sheet_path):
+    assert [name for name, _ in multitheme.sheet_frames(sheet_path)] == ["Warsaw", "1", "2"]
+    assert [frame.name for frame in frames.load_frames([sheet_path])] == ["Warsaw", "1", "2"]
+    assert [frame.key for frame in frames.load_frames([sheet_path])] == ["Arkusze_Test/Warsaw", "Arkusze_Test/1", "Arkusze_Test/2"]
+    assert [name for name, _ in atlas.sheet_frames("Arkusze_Test", "City_Name", str(sheet_path.parent))] == [
+        "Warszawa", "Kraków", "Łódź"
+    ]
+    assert [name for name, _ in atlas.sheet_frames("Arkusze_Test", "Missing", str(sheet_path.parent))] == ["0", "1", "2"]
@@ -0,0 +1,26 @@
+import math
+
+import pandas as pd
+
+from osm_pipeline.tags import parse_height_m, parse_lanes, parse_power_mw
+
+
+def _values(series):
+    return [None if isinstance(value, float) and math.isnan(value) else value for value in series.tolist()]
+
+
+def test_height_in_metres_feet_and_inches():
+    heights = parse_height_m(["12", "12.5 m", "12,5", "40 ft", "12'6\"", "6'", "3;4", "abc", None])
+    assert _values(heights) == [12.0, 12.5, 12.5, 12.19, 3.81, 1.83, 3.0, None, None]
+
+
+def test_power_in_megawatts_from_kilowatts_and_gigawatts():
+    power = parse_power_mw(["240kW", "0,996MW", "1.2 GW", "5", "yes", None])
+    assert _values(power) == [0.24, 0.996, 1200.0, 5.0, None, None]
+
+
+def test_lanes_from_the_first_whole_value():
+    lanes = parse_lanes(pd.Series(["2", "3;4", "2,1", " 4 ", "1.5", "yes", None], index=range(10, 17)))
+    assert lanes.tolist() == [2, 3, 2, 4, 0, 0, 0]
+    assert lanes.index.tolist() == list(range(10, 17))
+    assert parse_lanes(["x"], default=1).tolist() == [1]
@@ -0,0 +1,86 @@
+import json
+
+import overpy
+import pytest
+
+from bench_suite import load_script
+from osm_pipeline.cache import OverpassCache
+from osm_pipeline.tiling import TileFetchError, fetch_tiled, path_bbox
+from server import StandInServer
+
+BBOX = (0.0, 0.0, 4.0, 4.0)
+
+
+def _fetch_tile(fail_tile=None):
+    """Whole frame times out; quadrants return a shared border element and one of their own."""
+    def fetch_tile(tile_bbox):
+        if tile_bbox == BBOX:
+            raise overpy.exception.OverpassGatewayTimeout()
+        if tile_bbox == fail_tile:
+            raise overpy.exception.OverpassTooManyRequests()
+        yield ("way", 1), {"id": "border"}
+        yield ("way", hash(tile_bbox)), {"id": str(tile_bbox)}
+    return fetch_tile
+
+
+def test_split_tiles_write_each_element_once(tmp_path):
+    plan_path = tmp_path / "plan.json"
+    features = fetch_tiled(BBOX, _fetch_tile(), str(plan_path), sparse_threshold=3)
+    assert len(features) == 5
+    # Written counts, not raw ones: 5 features over the quartet stay above the threshold of 3
+    assert json.loads(plan_path.read_text())["tiles"] == ["0", "1", "2", "3"]
+
+
+def test_sparse_quartet_is_merged_by_written_count(tmp_path):
+    plan_path = tmp_path / "plan.json"
+    # 5 written but 8 fetched: the quartet collapses below 6
+    fetch_tiled(BBOX, _fetch_tile(), str(plan_path), sparse_threshold=6)
+    assert json.loads(plan_path.read_text())["tiles"] == [""]
+
+
+def test_features_of_a_tile_split_half_way_count_for_its_children(tmp_path):
+    plan_path = tmp_path / "plan.json"
+    quadrants = _fetch_tile()
+
+    def fetch_tile(tile_bbox):
+        if tile_bbox == path_bbox(BBOX, "0"):
+            yield ("way", 10), {"id": "south-west"}
+        if tile_bbox == BBOX:
+            # The whole frame writes two elements before it times out
+            yield ("way", 10), {"id": "south-west"}
+            yield ("way", 1), {"id": "border"}
+        yield from quadrants(tile_bbox)
+
+    written = []
+    assert fetch_tiled(BBOX, fetch_tile, str(plan_path), written.append, max_workers=1, sparse_threshold=6) == 6
+    assert sorted(feature["id"] for feature in written).count("south-west") == 1 and len(written) == 6
+    # The quartet counts all 6, so it is not merged back into the frame that timed out
+    assert json.loads(plan_path.read_text())["tiles"] == ["0", "1", "2", "3"]
+
+
+def test_failed_tile_raises_after_the_others(tmp_path):
+    plan_path = tmp_path / "plan.json"
+    written = []
+    failing = path_bbox(BBOX, "2")
+    with pytest.raises(TileFetchError) as raised:
+        fetch_tiled(BBOX, _fetch_tile(failing), str(plan_path), written.append, max_workers=1)
+    assert list(raised.value.failed) == ["2"]
+    assert len(written) == 4
+    # The failed tile stays in the plan for the next run
+    assert "2" in json.loads(plan_path.read_text())["tiles"]
+
+
+def test_response_cut_off_half_way_fails_the_frame(tmp_path):
+    water = load_script("Water/get_water.py")
+    output = str(tmp_path / "water.gpkg")
+    with StandInServer() as server:
+        # 50 kB is well into the node list of the small water fixture
+        server.cut_off("overpass", 50000)
+        cache = OverpassCache(str(tmp_path / "overpass"))
+        with pytest.raises(TileFetchError):
+            water.fetch_water_bodies(BBOX, output, max_retries=0, plan_dir=str(tmp_path),
+                                     url=server.overpass_url("small", "water_bodies"), cache=cache)
+        # Nothing of the cut response was cached, the next run fetches the whole frame
+        count = water.fetch_water_bodies(BBOX, output, plan_dir=str(tmp_path),
+                                         url=server.overpass_url("small", "water_bodies"), cache=cache)
+    assert count == 40
@@ -0,0 +1,22 @@
+from osm_pipeline.transit_network import build_network
+
+
+def _route(relation_id, mode, ref, refs):
+    element = {"type": "relation", "id": relation_id, "tags": {"type": "route", "route": mode, "ref": ref}}
+    return element, [("", [(float(ref), 0.0) for ref in refs], refs)]
+
+
+def test_shared_stretch_is_one_line_with_the_main_mode():
+    network = build_network([
+        _route(1, "bus", "10", [1, 2, 3]),
+        _route(2, "bus", "2", [1, 2, 3]),
+        _route(3, "tram", "²", [1, 2, 3, 4]),
+    ])
+    features = sorted(network.features(), key=lambda feature: len(feature["geometry"]["coordinates"]))
+    assert [feature["geometry"]["coordinates"] for feature in features] == [[(3.0, 0.0), (4.0, 0.0)],
+                                                                            [(1.0, 0.0), (2.0, 0.0), (3.0, 0.0)]]
+    tram, shared = (feature["properties"] for feature in features)
+    assert tram == {"type": "route", "route": "tram", "modes": "tram", "route_count": 1, "line_count": 1, "refs": "²"}
+    # Two bus routes outweigh one tram; refs in natural order, a superscript digit is not a number
+    assert shared["route"] == "bus" and shared["modes"] == "bus;tram"
+    assert shared["refs"] == "2;10;²"
@@ -0,0 +1,95 @@
+import sqlite3
+
+import pyogrio
+import shapely
+
+from osm_pipeline.geometry_batch import PolygonBatch
+from osm_pipeline.incremental import SyncState
+from osm_pipeline.writers import FrameWriters, GeoPackage, open_writer
+
+
+def _square(x, y, size=1.0):
+    return [[(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]]
+
+
+def _feature(x, properties):
+    return {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": _square(x, 0)}, "properties": properties}
+
+
+def test_round_trip_types_nulls_and_multi_promotion(tmp_path):
+    path = str(tmp_path / "frame.gpkg")
+    with GeoPackage(path, batch_size=2) as gpkg, gpkg.layer("buildings", geometry_type="MULTIPOLYGON") as layer:
+        layer.write(_feature(0, {"name": "a", "levels": 2, "height": 7.5}))
+        layer.write(_feature(2, {"name": None, "levels": None, "height": 3}))
+        layer.write(_feature(4, {"name": "c", "levels": 1, "height": None}))
+    info = pyogrio.read_info(path, layer="buildings")
+    assert info["geometry_type"] == "MultiPolygon"
+    assert info["features"] == 3
+    assert dict(zip(info["fields"], info["dtypes"])) == {"name": "object", "levels": "int64", "height": "float64"}
+    gdf = pyogrio.read_dataframe(path, layer="buildings")
+    assert gdf["name"].tolist()[::2] == ["a", "c"] and gdf["name"].isna().tolist() == [False, True, False]
+    assert gdf["levels"].isna().tolist() == [False, True, False]
+    assert gdf["height"].isna().tolist() == [False, False, True]
+    assert set(gdf.geometry.geom_type) == {"MultiPolygon"}
+    # GDAL's own bookkeeping, which QGIS reads for the feature count
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT feature_count FROM gpkg_ogr_contents WHERE table_name = 'buildings'").fetchone() == (3,)
+        assert connection.execute("SELECT count(*) FROM rtree_buildings_geom").fetchone() == (3,)
+
+
+def test_encoded_features_and_several_layers(tmp_path):
+    batch = PolygonBatch()
+    for i in range(5):
+        batch.add(("way", i), _square(i * 2, 0)[0], {"building": "yes"})
+    with FrameWriters(directory=str(tmp_path)) as writers:
+        for _, feature in batch.encode():
+            writers.get("Warsaw", "buildings", geometry_type="MULTIPOLYGON").write(feature)
+        writers.get("Warsaw", "water", geometry_type="MULTIPOLYGON").write(_feature(0, {"natural": "water"}))
+        assert writers.counts() == {("Warsaw", "buildings"): 5, ("Warsaw", "water"): 1}
+    path = str(tmp_path / "Warsaw.gpkg")
+    assert sorted(pyogrio.list_layers(path)[:, 0]) == ["buildings", "water"]
+    assert pyogrio.read_dataframe(path, layer="buildings")["building"].tolist() == ["yes"] * 5
+
+
+def test_rewrite_replaces_the_layer(tmp_path):
+    path = str(tmp_path / "water.gpkg")
+    with open_writer(path, "water", {"natural": "TEXT"}, "MULTIPOLYGON") as writer:
+        for x in range(3):
+            writer.write(_feature(x, {"natural": "water"}))
+    with open_writer(path, "water", {"natural": "TEXT"}, "MULTIPOLYGON") as writer:
+        writer.write(_feature(0, {"natural": "bay"}))
+    assert pyogrio.read_dataframe(path, layer="water")["natural"].tolist() == ["bay"]
+    # Nothing written: the layer is emptied, not left stale or dropped
+    with open_writer(path, "water", geometry_type="MULTIPOLYGON"):
+        pass
+    info = pyogrio.read_info(path, layer="water")
+    assert info["features"] == 0 and list(info["fields"]) == ["natural"]
+
+
+def test_update_layer_deletes_by_key_and_appends(tmp_path):
+    path = str(tmp_path / "frame.gpkg")
+    with GeoPackage(path) as gpkg:
+        # The sync tables come first on a new file, GDAL must keep them
+        state = SyncState(gpkg)
+        with gpkg.layer("roads", geometry_type="LINESTRING") as layer:
+            for i in range(4):
+                layer.write({
+                    "type": "Feature",
+                    "geometry": {"type": "LineString", "coordinates": [(i, 0), (i, 1)]},
+                    "properties": {"osm_type": "way", "osm_id": i},
+                })
+        state.save("roads", "2024-01-01T00:00:00Z", {("way", i): (1, None) for i in range(4)})
+        with gpkg.update_layer("roads", ("osm_type", "osm_id")) as layer:
+            layer.delete([("way", 1), ("way", 2)])
+            layer.write({
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": [(9, 0), (9, 1)]},
+                "properties": {"osm_type": "way", "osm_id": 2},
+            })
+        assert state.synced_at("roads") == "2024-01-01T00:00:00Z"
+    gdf = pyogrio.read_dataframe(path, layer="roads")
+    assert sorted(gdf["osm_id"]) == [0, 2, 3]
+    assert shapely.equals(gdf.loc[gdf["osm_id"] == 2, "geometry"].iloc[0], shapely.LineString([(9, 0), (9, 1)]))
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT count(*) FROM rtree_roads_geom").fetchone() == (3,)
+        assert connection.execute("SELECT feature_count FROM gpkg_ogr_contents WHERE table_name = 'roads'").fetchone() == (3,)